@@ -0,0 +1,97 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+
+# What the *_bench.py scripts have in common: timing the fastest of a few runs, measuring peak memory, and reporting
+# a run over named inputs as JSON, so that runs can be compared across versions.
+
+DEFAULT_REPEAT = 3
+
+
+### MEASUREMENT
+
+def best_time(run, repeat, setup=None):
+    """
+    Returns (seconds, result): the fastest of `repeat` calls of run(), and what the last one returned. With setup,
+    each call is run(setup()), and only run() is timed.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            result = run()
+        else:
+            argument = setup()
+            start = time.perf_counter()
+            result = run(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+
+def peak_memory(run):
+    """
+    The most memory allocated at once during one more call of run(), in bytes, under tracemalloc.
+    """
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+### REPORTING
+
+def run_inputs(inputs, measure):
+    """
+    Returns an entry for each of `inputs` (name -> input, in order): {"name": name}, updated with measure(input).
+    """
+    entries = []
+    for name, input_ in inputs.items():
+        entry = {"name": name}
+        entry.update(measure(input_))
+        entries.append(entry)
+    return entries
+
+
+def report(entries, environment=None, **settings):
+    """
+    The JSON report for a run: where it ran (python and platform, plus anything in `environment`), the settings it
+    ran with, and the entries for its inputs.
+    """
+    result = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            **(environment or {}),
+        },
+    }
+    result.update(settings)
+    result["inputs"] = entries
+    return result
+
+
+def argument_parser(description):
+    """
+    An ArgumentParser with the options every benchmark has, --repeat and --output, for it to add its own to.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Time the fastest of this many runs")
+    parser.add_argument("--output", help="Write the JSON report here rather than to stdout")
+    return parser
+
+
+def write_report(report, path=None):
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
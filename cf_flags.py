@@ -11,8 +11,20 @@ class FormatMode(enum.Enum):
     COMPACT_EXPRESSIONS = "COMPACT_EXPRESSIONS"
 
 
+class Dialect(enum.Enum):
+    GENERIC = "GENERIC"
+    ANSI = "ANSI"
+    BIGQUERY = "BIGQUERY"
+    MYSQL = "MYSQL"
+    POSTGRES = "POSTGRES"
+    SNOWFLAKE = "SNOWFLAKE"
+
+
 FORMAT_MODE = FormatMode.DEFAULT
 LOWER_CASE = False
+DIALECT = Dialect.GENERIC
+MAX_WIDTH = None # None for no limit, otherwise the width that long expressions are broken to fit within
+FILL_LITERAL_LISTS = False # with MAX_WIDTH, whether lists of literals are filled up to it rather than broken at every comma
 
 
 def reset_to_defaults():
@@ -21,3 +33,12 @@ def reset_to_defaults():
 
     global LOWER_CASE
     LOWER_CASE = False
+
+    global DIALECT
+    DIALECT = Dialect.GENERIC
+
+    global MAX_WIDTH
+    MAX_WIDTH = None
+
+    global FILL_LITERAL_LISTS
+    FILL_LITERAL_LISTS = False
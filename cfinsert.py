@@ -0,0 +1,311 @@
+import cf_flags
+from cftoken import CFToken, CFTokenKind, KeywordIds, SymbolIds, Whitespace
+from clause_formatter import (
+    COMMENT_KINDS,
+    STATEMENT_START_MASK,
+    CompoundStatement,
+    LiteralList,
+    literal_list_end,
+    parse_expression,
+)
+
+
+# Streaming formatting of INSERT ... VALUES statements. A bulk-load script can have millions of rows, far too many to
+# lex into one list of tokens and parse into a tree like other statements, and nothing about the layout of one row
+# depends on any other. So the rows are read from a stream of tokens one at a time, and each is rendered and written
+# out before the next is read: memory stays the same however many rows there are, and time is linear in them.
+#
+# Everything up to VALUES (the table, and its column list) is small, and is laid out like a select list, commas-first:
+#     insert into t (a
+#                  , b)
+#     values (1, 'x')
+#          , (2, 'y')
+# Each row is joined onto one line (unless it has a line comment in it) and rendered as an expression would be (so as
+# it is, trimmed or compacted, and broken to fit --max-width), and anything after the rows (e.g. ON CONFLICT ...) goes
+# on a line of its own, up to the ";" ending the statement. Comments between rows are kept, on the line of the row
+# before if that's where they were, and a comma after the last row stays with it. INSERT ... DEFAULT VALUES has no
+# rows, and its header is laid out the same way, VALUES and all.
+#
+# The first statement that isn't an INSERT ... VALUES is left to CompoundStatement, along with everything after it.
+
+
+DEFAULT = CFToken(CFTokenKind.WORD, "default")
+
+
+def is_comment(token):
+    return token.kind in COMMENT_KINDS
+
+
+def is_semicolon(token):
+    return token.kind == CFTokenKind.SYMBOL and token.value == ";"
+
+
+def starts_with_insert(tokens):
+    """
+    Whether the first of the tokens that isn't whitespace or a comment is INSERT.
+    """
+    for t in tokens:
+        if not (t.is_whitespace or is_comment(t)):
+            return t.keyword_id == KeywordIds.INSERT
+    return False
+
+
+def read_header(tokens):
+    """
+    Reads the start of the next statement from an iterator of tokens. Returns (consumed, start): every token read,
+    and the index among them of INSERT if the statement is an INSERT ... VALUES, in which case the last token read is
+    the VALUES, or None if it isn't, in which case reading stopped as soon as that was clear.
+    """
+    consumed = []
+    start = None
+    depth = 0
+    for t in tokens:
+        consumed.append(t)
+        keyword_id = t.keyword_id
+        if start is None:
+            if t.is_whitespace or is_comment(t):
+                continue
+            if keyword_id != KeywordIds.INSERT:
+                return (consumed, None)
+            start = len(consumed) - 1
+        elif keyword_id == SymbolIds.LEFT_PAREN:
+            depth += 1
+        elif keyword_id == SymbolIds.RIGHT_PAREN:
+            depth -= 1
+        elif depth == 0:
+            if keyword_id == KeywordIds.VALUES:
+                return (consumed, start)
+            if STATEMENT_START_MASK >> keyword_id & 1 or is_semicolon(t):
+                # e.g. INSERT ... SELECT
+                return (consumed, None)
+    return (consumed, None)
+
+
+def read_row(left_paren, tokens):
+    # the tokens of a row, up to the ")" matching its "(" (or the end, if there isn't one)
+    row = [left_paren]
+    depth = 1
+    for t in tokens:
+        row.append(t)
+        keyword_id = t.keyword_id
+        if keyword_id == SymbolIds.LEFT_PAREN:
+            depth += 1
+        elif keyword_id == SymbolIds.RIGHT_PAREN:
+            depth -= 1
+            if depth == 0:
+                break
+    return row
+
+
+def join_lines(row):
+    # the row with each run of whitespace that has a line break in it replaced by a space, or by nothing after a "("
+    # or before a ")" or ","
+    joined = []
+    i = 0
+    length = len(row)
+    while i < length:
+        t = row[i]
+        if not t.is_whitespace:
+            joined.append(t)
+            i += 1
+            continue
+        j = i
+        while j < length and row[j].is_whitespace:
+            j += 1
+        if not any(row[k].kind == CFTokenKind.NEWLINE for k in range(i, j)):
+            joined.extend(row[i:j])
+        elif not (
+                joined[-1].keyword_id == SymbolIds.LEFT_PAREN
+             or (j < length and row[j].keyword_id in (SymbolIds.RIGHT_PAREN, SymbolIds.COMMA))
+            ):
+            joined.append(Whitespace.ONE_SPACE)
+        i = j
+    return joined
+
+
+def render_row(row, indent):
+    kinds = {t.kind for t in row}
+    if CFTokenKind.NEWLINE in kinds and CFTokenKind.LINE_COMMENT not in kinds:
+        row = join_lines(row)
+    length = len(row)
+    if row[-1].keyword_id == SymbolIds.RIGHT_PAREN and literal_list_end(row, 0, length) == length - 1:
+        # the usual row, nothing but literals, which needs no parsing
+        literal_list = LiteralList(row, 1, length - 1)
+        if cf_flags.FORMAT_MODE == cf_flags.FormatMode.COMPACT_EXPRESSIONS:
+            literal_list = literal_list.compacted()
+        text = "(" + literal_list.text + ")"
+        if cf_flags.MAX_WIDTH is None or indent + len(text) <= cf_flags.MAX_WIDTH:
+            return text
+    return parse_expression(row).render(indent)
+
+
+def render_header(header, writer):
+    # INSERT INTO and the table, then the column list, if there is one, commas-first and lined up after its "("
+    left_paren = None
+    right_paren = None
+    depth = 0
+    for i, t in enumerate(header):
+        if t.keyword_id == SymbolIds.LEFT_PAREN:
+            if depth == 0 and left_paren is None:
+                left_paren = i
+            depth += 1
+        elif t.keyword_id == SymbolIds.RIGHT_PAREN:
+            depth -= 1
+            if depth == 0 and right_paren is None:
+                right_paren = i
+
+    if left_paren is None or right_paren is None:
+        writer.write(parse_expression(header).render(0))
+        return
+
+    writer.write(parse_expression(header[:left_paren]).render(0) + " (")
+    column = writer.column
+    items = []
+    item_start = left_paren + 1
+    depth = 0
+    for i in range(left_paren + 1, right_paren):
+        keyword_id = header[i].keyword_id
+        if keyword_id == SymbolIds.LEFT_PAREN:
+            depth += 1
+        elif keyword_id == SymbolIds.RIGHT_PAREN:
+            depth -= 1
+        elif keyword_id == SymbolIds.COMMA and depth == 0:
+            items.append(header[item_start:i])
+            item_start = i + 1
+    items.append(header[item_start:right_paren])
+
+    for i, item in enumerate(items):
+        if i > 0:
+            writer.write("\n" + " " * (column - 2) + ", ")
+        writer.write(parse_expression(item).render(column))
+    writer.write(")")
+
+    # anything between the column list and VALUES
+    rest = header[right_paren + 1:]
+    if not all(t.is_whitespace for t in rest):
+        writer.write(" ")
+        writer.write(parse_expression(rest).render(writer.column))
+
+
+def render_rows(indent, tokens, writer):
+    """
+    Renders the rows after VALUES, each on a line of its own, commas-first, reading them from tokens. Returns (t,
+    after_line_comment): the token after them (or None at the end), and whether what was written last was a line
+    comment. A comma after the last row is written straight after it.
+    """
+    comma = "\n" + " " * (indent - 2) + ", "
+    rows = 0
+    after_line_comment = False # in which case whatever comes next has to start a new line
+    while True:
+        # whitespace, comments, and (after the first row) a comma. The comments are held back until it's clear whether
+        # another row follows, since if one doesn't, the comma goes before them.
+        seen_newline = False
+        seen_comma = False
+        comments = []
+        t = None
+        for t in tokens:
+            if t.is_whitespace:
+                seen_newline = seen_newline or t.kind == CFTokenKind.NEWLINE
+            elif is_comment(t):
+                if seen_newline or after_line_comment:
+                    comments.append("\n" + " " * (indent - 2))
+                else:
+                    comments.append(" ")
+                comments.append(t.value.rstrip("\n"))
+                after_line_comment = t.kind == CFTokenKind.LINE_COMMENT
+            elif t.keyword_id == SymbolIds.COMMA and rows > 0 and not seen_comma:
+                seen_comma = True
+            else:
+                break
+        else:
+            t = None
+
+        if t is None or t.keyword_id != SymbolIds.LEFT_PAREN or (rows > 0 and not seen_comma):
+            if seen_comma:
+                writer.write(",")
+            writer.write("".join(comments))
+            break
+        writer.write("".join(comments))
+
+        row = read_row(t, tokens)
+        if rows > 0:
+            writer.write(comma)
+        elif after_line_comment:
+            writer.write("\n" + " " * indent)
+        else:
+            writer.write(" ")
+        writer.write(render_row(row, indent))
+        after_line_comment = False
+        rows += 1
+    return (t, after_line_comment)
+
+
+def render_insert(consumed, start, tokens, writer):
+    """
+    Renders an INSERT ... VALUES statement, given what read_header() returned for it, reading the rest of it from
+    tokens, up to and including the ";" that ends it (if any).
+    """
+    # any comments before it, each on a line of its own
+    for t in consumed[:start]:
+        if is_comment(t):
+            writer.write(t.value.rstrip("\n") + "\n")
+
+    values = consumed[-1]
+    before_values = next(t for t in reversed(consumed[:-1]) if not (t.is_whitespace or is_comment(t)))
+    if before_values == DEFAULT:
+        # INSERT ... DEFAULT VALUES, which has no rows
+        render_header(consumed[start:], writer)
+        t = next(tokens, None)
+        after_line_comment = False
+    else:
+        render_header(consumed[start:-1], writer)
+        writer.write("\n" + values.value)
+        t, after_line_comment = render_rows(len(values.value) + 1, tokens, writer)
+
+    # anything after the rows, up to the end of the statement
+    rest = []
+    semicolon = None
+    depth = 0
+    while t is not None:
+        keyword_id = t.keyword_id
+        if keyword_id == SymbolIds.LEFT_PAREN:
+            depth += 1
+        elif keyword_id == SymbolIds.RIGHT_PAREN:
+            depth -= 1
+        elif depth == 0 and is_semicolon(t):
+            semicolon = t
+            break
+        rest.append(t)
+        t = next(tokens, None)
+
+    if not all(t.is_whitespace for t in rest):
+        writer.write("\n" + parse_expression(rest).render(0))
+        last = next(t for t in reversed(rest) if not t.is_whitespace)
+        after_line_comment = last.kind == CFTokenKind.LINE_COMMENT
+    if semicolon is not None:
+        if after_line_comment:
+            writer.write("\n")
+        writer.write(semicolon.value)
+
+
+def render_statements(tokens, writer):
+    """
+    Renders the statements in an iterable of tokens into writer, each INSERT ... VALUES as it's read (see above),
+    until one that isn't, which is rendered along with everything after it as a CompoundStatement.
+    """
+    tokens = iter(tokens)
+    first = True
+    while True:
+        consumed, start = read_header(tokens)
+        if start is None:
+            rest = consumed + list(tokens)
+            if first or not all(t.is_whitespace for t in rest):
+                if not first:
+                    writer.write("\n")
+                CompoundStatement(rest).render_into(writer, indent=0)
+            return
+
+        if not first:
+            writer.write("\n")
+        render_insert(consumed, start, tokens, writer)
+        first = False
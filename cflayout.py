@@ -0,0 +1,289 @@
+from cftoken import CFToken, Keywords, KeywordIds, SymbolIds, keyword_mask
+
+
+# Width-aware layout of an expression that would otherwise run past the maximum width, in the manner of Oppen's pretty
+# printer (and Wadler's "prettier printer"): the tokens are turned into a document of text, nested groups, and places
+# where each group may break; one pass works out how wide every group is, and another prints the document, breaking a
+# group only if it doesn't fit in what's left of its line. Each step is linear, and nothing is printed more than once,
+# so there's no rendering of alternatives to see which fits.
+#
+# The groups follow the structure of the expression, at each level of parens (and at the top):
+#   - the level as a whole, which breaks before ORDER BY and PARTITION BY, lined up with the start of the level:
+#         over(partition by a, b
+#              order by c)
+#   - each segment of the level (the part after each ORDER BY etc), which breaks before its commas, commas-first and
+#     right-aligned so that the items line up:
+#         coalesce(a
+#                , b)
+#   - each item of a segment, which breaks before AND and OR (outside BETWEEN ... AND and CASE ... END), right-aligned
+#     in the same way, where ON starts a group of its own so that the predicate after it lines up:
+#         u on a.x = b.x
+#          and a.y = b.y
+# When a group breaks, any whitespace around the operator or comma it breaks at is replaced by one space after it.
+#
+# A list of literals (a LiteralList, e.g. the values of `in (1, 2, ...)`) is a segment like any other, with an item
+# per value, unless it's to be filled: then its commas are places to break that each decide for themselves, so that a
+# line of values is only broken before the first one that doesn't fit:
+#         in (1, 2, 3
+#           , 4, 5)
+
+# document ops, each a tuple starting with one of these
+TEXT = 0 # (TEXT, text)
+BEGIN = 1 # (BEGIN,) starts a group
+END = 2 # (END,) ends the innermost group
+BREAK = 3 # (BREAK, flat text, broken text, hang) where the innermost group may break; when it does, the broken text
+          # starts a new line, `hang` columns left of where the group started
+FILL = 4 # (FILL, flat text, broken text, hang) like BREAK, but only if the innermost group breaks and what follows
+         # up to the next place to break doesn't fit
+
+SEGMENT_KEYWORD_MASK = keyword_mask([Keywords.ORDER_BY, Keywords.PARTITION_BY])
+AND_OR_MASK = keyword_mask([Keywords.AND, Keywords.OR])
+
+# groups waiting for the next token to open, see build_document()
+OPEN_SEGMENT = 1 # a segment, and the first item in it
+OPEN_ITEM = 2
+OPEN_PREDICATE = 3
+
+
+class _Level:
+    # the state of one level of parens, while building a document
+    __slots__ = (
+        "open_groups", # how many groups of this level are open, including the level's own
+        "pending", # one of the OPEN_ constants, or None
+        "has_segment", # whether any segment has been opened yet
+        "between_depth",
+        "case_depth",
+    )
+
+    def __init__(self):
+        self.open_groups = 1
+        self.pending = OPEN_SEGMENT
+        self.has_segment = False
+        self.between_depth = 0
+        self.case_depth = 0
+
+
+def build_document(elements, start, end, first=None, fill_literal_lists=False):
+    """
+    The document for the tokens elements[start:end], with `first` in place of the first one if given. The tokens
+    must not include subqueries or line breaks, but may include lists of literals.
+    """
+    ops = [(BEGIN,)]
+    levels = [_Level()]
+    space = "" # whitespace since the last token that isn't whitespace, not yet added
+    last_break = None # index of the BREAK that any whitespace right after it belongs to
+
+    def open_pending(level):
+        if level.pending == OPEN_SEGMENT:
+            ops.append((BEGIN,))
+            ops.append((BEGIN,))
+            level.open_groups += 2
+            level.has_segment = True
+        elif level.pending is not None:
+            ops.append((BEGIN,))
+            level.open_groups += 1
+        level.pending = None
+
+    def close_to(level, open_groups):
+        ops.extend([(END,)] * (level.open_groups - open_groups))
+        level.open_groups = open_groups
+
+    for i in range(start, end):
+        t = first if (i == start and first is not None) else elements[i]
+
+        if type(t) is not CFToken:
+            # a list of literals, which is all there is inside its parens
+            level = levels[-1]
+            leading, items, separators, trailing = t.pieces()
+            if space or leading:
+                ops.append((TEXT, space + leading))
+            open_pending(level)
+            ops.append((TEXT, items[0]))
+            for separator, item in zip(separators, items[1:]):
+                if fill_literal_lists:
+                    ops.append((FILL, separator, ", ", 2))
+                else:
+                    ops.append((END,))
+                    ops.append((BREAK, separator, ", ", 2))
+                    ops.append((BEGIN,))
+                ops.append((TEXT, item))
+            space = trailing
+            last_break = None
+            continue
+
+        value = t.value
+
+        if t.is_whitespace:
+            if last_break is None:
+                space += value
+            else:
+                _, flat, broken, hang = ops[last_break]
+                ops[last_break] = (BREAK, flat + value, broken, hang)
+            continue
+
+        level = levels[-1]
+        keyword_id = t.keyword_id
+
+        if SEGMENT_KEYWORD_MASK >> keyword_id & 1 and level.has_segment:
+            # a new segment, starting on a new line under the start of the level
+            close_to(level, 1)
+            last_break = len(ops)
+            ops.append((BREAK, space + value, value + " ", 0))
+            space = ""
+            level.pending = OPEN_SEGMENT
+            continue
+
+        if keyword_id == SymbolIds.COMMA:
+            # a new item in this segment
+            open_pending(level)
+            close_to(level, 2)
+            last_break = len(ops)
+            ops.append((BREAK, space + value, value + " ", 2))
+            space = ""
+            level.pending = OPEN_ITEM
+            continue
+
+        if AND_OR_MASK >> keyword_id & 1 and level.between_depth == 0 and level.case_depth == 0:
+            open_pending(level)
+            last_break = len(ops)
+            ops.append((BREAK, space + value, value + " ", len(value) + 1))
+            space = ""
+            continue
+
+        if keyword_id == SymbolIds.RIGHT_PAREN and len(levels) > 1:
+            if space:
+                ops.append((TEXT, space))
+                space = ""
+            close_to(level, 0)
+            levels.pop()
+            ops.append((TEXT, value))
+            last_break = None
+            continue
+
+        if space:
+            ops.append((TEXT, space))
+            space = ""
+        if not SEGMENT_KEYWORD_MASK >> keyword_id & 1:
+            # (a segment's leading keyword isn't part of it, so its items line up after the keyword)
+            open_pending(level)
+        ops.append((TEXT, value))
+        last_break = None
+
+        if keyword_id == SymbolIds.LEFT_PAREN:
+            ops.append((BEGIN,))
+            levels.append(_Level())
+        elif keyword_id == KeywordIds.ON:
+            level.pending = OPEN_PREDICATE
+        elif keyword_id == KeywordIds.BETWEEN:
+            level.between_depth += 1
+        elif keyword_id == KeywordIds.AND and level.between_depth > 0:
+            level.between_depth -= 1
+        elif keyword_id == KeywordIds.CASE:
+            level.case_depth += 1
+        elif keyword_id == KeywordIds.END and level.case_depth > 0:
+            level.case_depth -= 1
+
+    if space:
+        ops.append((TEXT, space))
+    for level in reversed(levels):
+        close_to(level, 0)
+
+    return ops
+
+
+def measure_document(ops):
+    """
+    For each BEGIN in ops, the width of its group laid out flat, and of what follows the group up to the next place
+    any group may break (and for each FILL, of what follows it), returned as two lists indexed like ops.
+    """
+    sizes = [0] * len(ops)
+    trails = [0] * len(ops)
+
+    # forward, for sizes: the width so far, at each open group's BEGIN
+    width = 0
+    begins = []
+    for i, op in enumerate(ops):
+        kind = op[0]
+        if kind == TEXT:
+            width += len(op[1])
+        elif kind == BREAK or kind == FILL:
+            width += len(op[1])
+        elif kind == BEGIN:
+            begins.append((i, width))
+        else:
+            j, begin_width = begins.pop()
+            sizes[j] = width - begin_width
+
+    # backward, for trails: the width up to the next break of any group. That may be in a later group which doesn't
+    # break there after all, but only because the whole group fits, so (as in Wadler's algorithm) each group decides
+    # assuming that the rest of its line will be laid out as well as it can be. Each FILL gets a trail too.
+    rest = 0
+    after_groups = []
+    for i in range(len(ops) - 1, -1, -1):
+        op = ops[i]
+        kind = op[0]
+        if kind == TEXT:
+            rest += len(op[1])
+        elif kind == BREAK:
+            rest = 0
+        elif kind == FILL:
+            trails[i] = rest
+            rest = 0
+        elif kind == END:
+            after_groups.append(rest)
+        else:
+            trails[i] = after_groups.pop()
+
+    return sizes, trails
+
+
+def print_document(ops, column, max_width):
+    """
+    Lays out the document starting at `column`, breaking each group that doesn't fit within max_width (as long as
+    the group enclosing it broke too), and returns the text. No line starts left of `column`, which is the indent
+    that Expression would pad any line out to anyway.
+    """
+    sizes, trails = measure_document(ops)
+    min_indent = column
+    out = []
+    # for each open group, whether it's broken, and the column it started at
+    groups = [(True, column)]
+    for i, op in enumerate(ops):
+        kind = op[0]
+        if kind == TEXT:
+            out.append(op[1])
+            column += len(op[1])
+        elif kind == BREAK:
+            broken, group_column = groups[-1]
+            if broken:
+                indent = max(group_column - op[3], min_indent)
+                out.append("\n" + " " * indent + op[2])
+                column = indent + len(op[2])
+            else:
+                out.append(op[1])
+                column += len(op[1])
+        elif kind == FILL:
+            broken, group_column = groups[-1]
+            if broken and column + len(op[1]) + trails[i] > max_width:
+                indent = max(group_column - op[3], min_indent)
+                out.append("\n" + " " * indent + op[2])
+                column = indent + len(op[2])
+            else:
+                out.append(op[1])
+                column += len(op[1])
+        elif kind == BEGIN:
+            # a group inside one laid out flat is flat too, since it fits if its parent does
+            broken = groups[-1][0] and column + sizes[i] + trails[i] > max_width
+            groups.append((broken, column))
+        else:
+            groups.pop()
+
+    return "".join(out)
+
+
+def layout_expression(elements, start, end, first, column, max_width, fill_literal_lists=False):
+    """
+    The text of the expression made of elements[start:end] (with `first` in place of the first one if given),
+    starting at `column`, broken to fit within max_width where it can be (see above).
+    """
+    return print_document(build_document(elements, start, end, first, fill_literal_lists), column, max_width)
@@ -1,7 +1,12 @@
 import re
+import bisect
+import functools
+import collections
+import itertools
+from array import array
 
 import cf_flags
-from cftoken import CFToken, CFTokenKind, Symbols
+from cftoken import CFToken, CFTokenKind, Symbols, Whitespace
 
 
 SINGLE_QUOTE = "'"
@@ -53,127 +58,772 @@ TWO_WORD_PHRASES = [
 ]
 
 
-def lex(input_string):
+def _quoted(quote, backslash_escapes=True):
+    """
+    Pattern for a string or identifier between `quote`s, where a doubled quote stands for itself.
+
+    The loop is unrolled so that runs of ordinary characters are consumed without backtracking, and a quote that is
+    never closed runs to the end of the input rather than failing. Either way the pattern matches in a single linear
+    pass once it has started, so a stray opening quote can't make each later position rescan the rest of the input.
+    (An escape also allows a newline, or nothing at all right at the end.)
+    """
+    q = re.escape(quote)
+    if backslash_escapes:
+        return rf"{q}[^{q}\\]*(?:(?:{q}{q}|\\(?s:.|\Z))[^{q}\\]*)*(?:{q}|\Z)"
+    return rf"{q}[^{q}]*(?:{q}{q}[^{q}]*)*(?:{q}|\Z)"
+
+
+def _triple_quoted(quote):
+    # BigQuery's triple-quoted strings, which may contain lone quotes and escapes
+    q = re.escape(quote)
+    return rf"{q}{{3}}[^{q}\\]*(?:(?:\\(?s:.|\Z)|{q}(?!{q}{q}))[^{q}\\]*)*(?:{q}{{3}}|\Z)"
+
+
+# supposedly the (ANTLR) grammar for quotes...
+# fragment DQUOTA_STRING : '"' ( '\\'. | '""' | ~('"' | '\\') )* '"';
+# fragment SQUOTA_STRING : '\'' ('\\'. | '\'\'' | ~('\'' | '\\'))* '\'';
+# fragment BQUOTA_STRING : '`' ( '\\'. | '``' | ~('`' | '\\'))* '`';
+SINGLE_QUOTED = _quoted(SINGLE_QUOTE)
+DOUBLE_QUOTED = _quoted(DOUBLE_QUOTE)
+BACKTICK_QUOTED = _quoted(BACKTICK)
+DOLLAR_QUOTED = r"(?P<dollar_tag>\$[A-Za-z0-9_]*\$)(?s:.*?)(?:(?P=dollar_tag)|\Z)"
+# alphanumeric word (incl. underscore)
+# TODO: also PG allows dollar-number placeholders e.g. $1
+# TODO: and dollar signs in identifiers e.g. foo$bar (not SQL standard?)
+ALPHANUMERIC_WORD = r"[A-Za-z_][A-Za-z0-9_]*"
+
+
+# What each --dialect actually has, so that its scanner only tries those things.
+#   literals: string literals and quoted identifiers, tried in order
+#   identifier_quotes: the subset of literals that can be part of a qualified identifier
+#   line_comments: what starts a comment that runs to the end of the line
+#   operators: multi-character operators, which come out as a single SYMBOL rather than one per character
+# GENERIC is what cflexer has always done: a bit of everything, and no multi-character operators.
+DIALECT_PROFILES = {
+    cf_flags.Dialect.GENERIC: dict(
+        literals=[SINGLE_QUOTED, DOUBLE_QUOTED, BACKTICK_QUOTED, DOLLAR_QUOTED],
+        identifier_quotes=[DOUBLE_QUOTED, BACKTICK_QUOTED],
+        line_comments=["--"],
+        operators=[],
+    ),
+    cf_flags.Dialect.ANSI: dict(
+        literals=[_quoted(SINGLE_QUOTE, False), _quoted(DOUBLE_QUOTE, False)],
+        identifier_quotes=[_quoted(DOUBLE_QUOTE, False)],
+        line_comments=["--"],
+        operators=["<>", ">=", "<=", "!=", "||"],
+    ),
+    cf_flags.Dialect.POSTGRES: dict(
+        # backslashes only escape in E'...' strings, which we don't distinguish
+        literals=[_quoted(SINGLE_QUOTE, False), _quoted(DOUBLE_QUOTE, False), DOLLAR_QUOTED],
+        identifier_quotes=[_quoted(DOUBLE_QUOTE, False)],
+        line_comments=["--"],
+        # see archived/hand_written_lexer/lexer_design.md
+        operators=(
+            "|| ** >= <= <> != -> => #> @> <@ ?| ?& #- @? @@ |/ << >> ## && &< &> <^ >^ ?# ?- ~= !! :: !~ ~* "
+            "->> #>> ||/ @-@ <-> <<| |>> &<| |&> ?-| ?|| <<= >>= @@@ -|- !~*"
+        ).split(),
+    ),
+    cf_flags.Dialect.MYSQL: dict(
+        literals=[SINGLE_QUOTED, DOUBLE_QUOTED, BACKTICK_QUOTED],
+        identifier_quotes=[BACKTICK_QUOTED],
+        line_comments=["--", "#"],
+        operators=["<=>", "<>", ">=", "<=", "!=", "||", "&&", "<<", ">>", ":=", "->>", "->"],
+    ),
+    cf_flags.Dialect.BIGQUERY: dict(
+        literals=[
+            _triple_quoted(SINGLE_QUOTE),
+            _triple_quoted(DOUBLE_QUOTE),
+            SINGLE_QUOTED,
+            DOUBLE_QUOTED,
+            BACKTICK_QUOTED,
+        ],
+        identifier_quotes=[BACKTICK_QUOTED],
+        line_comments=["--", "#"],
+        operators=["<>", ">=", "<=", "!=", "||", "<<", ">>"],
+    ),
+    cf_flags.Dialect.SNOWFLAKE: dict(
+        literals=[SINGLE_QUOTED, _quoted(DOUBLE_QUOTE, False), r"\$\$(?s:.*?)(?:\$\$|\Z)"],
+        identifier_quotes=[_quoted(DOUBLE_QUOTE, False)],
+        line_comments=["--", "//"],
+        operators=["=>", "->", "::", "||", "<>", ">=", "<=", "!="],
+    ),
+}
+
+# how far past the start of a SYMBOL the scanner may have looked, in any dialect
+MAX_OPERATOR_LENGTH = max(len(op) for profile in DIALECT_PROFILES.values() for op in profile["operators"])
+
+
+def _token_pattern(profile, qualified_identifiers):
+    """
+    The scanner is a single alternation of named groups, matched at the current position without slicing the input.
+    Order matters: the first alternative that matches wins, so e.g. quotes beat comments.
+    Numeric literals are only matched here for ASCII digits, see _scan_number() for the rest of the sloppy rule.
+    """
+    identifier_part = "(?:" + "|".join([ALPHANUMERIC_WORD] + profile["identifier_quotes"]) + ")"
+    line_comment_start = "|".join([re.escape(start) for start in profile["line_comments"]])
+    # longest first, so that e.g. ->> isn't taken for ->
+    operators = "|".join([re.escape(op) for op in sorted(profile["operators"], key=len, reverse=True)])
+    return re.compile(
+        r"(?P<newline>\n)"
+        r"|(?P<spaces>[ ]+)"
+        # foo.bar, "Foo"."Bar" etc. as one token, if asked for; a lone name falls through to word/literal below
+        + (rf"|(?P<qualified>{identifier_part}(?:\.{identifier_part})+)" if qualified_identifiers else "")
+        + r"|(?P<literal>" + "|".join(profile["literals"]) + ")"
+        + rf"|(?P<line_comment>(?:{line_comment_start}).*?(?:\n|$))"
+        r"|(?P<block_comment>/\*(?s:.*?)(?:\*/|\Z))"
+        rf"|(?P<word>{ALPHANUMERIC_WORD})"
+        r"|(?P<number>(?:[0-9]|\.[0-9])[0-9.eE]*)"
+        + (f"|(?P<operator>{operators})" if operators else "")
+    )
+
+
+LexerTables = collections.namedtuple(
+    "LexerTables", ["token", "qualified_token", "token_bytes", "qualified_token_bytes", "identifier_part"]
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_lexer_tables(dialect):
+    profile = DIALECT_PROFILES[dialect]
+    token = _token_pattern(profile, qualified_identifiers=False)
+    qualified_token = _token_pattern(profile, qualified_identifiers=True)
+    # The same patterns over UTF-8 bytes (e.g. an mmap'd file): everything they match is ASCII, and the bytes of a
+    # multi-byte character never are, so they split the input in exactly the same places.
+    return LexerTables(
+        token,
+        qualified_token,
+        re.compile(token.pattern.encode()),
+        re.compile(qualified_token.pattern.encode()),
+        # for lower-casing just the unquoted parts of a qualified identifier, see _fold_case()
+        re.compile("(?P<quoted>" + "|".join(profile["identifier_quotes"]) + f")|{ALPHANUMERIC_WORD}"),
+    )
+
+
+def lexer_tables(dialect=None):
+    """
+    The compiled patterns for a dialect (by default the --dialect), built the first time they're asked for.
+    """
+    return _build_lexer_tables(cf_flags.DIALECT if dialect is None else dialect)
+
+
+RE_TOKEN, RE_QUALIFIED_TOKEN, RE_TOKEN_BYTES, RE_QUALIFIED_TOKEN_BYTES, RE_IDENTIFIER_PART = lexer_tables(
+    cf_flags.Dialect.GENERIC
+)
+
+GROUP_KIND_MAP = {
+    "newline": CFTokenKind.NEWLINE,
+    "spaces": CFTokenKind.SPACES,
+    "literal": CFTokenKind.LITERAL,
+    "line_comment": CFTokenKind.LINE_COMMENT,
+    "block_comment": CFTokenKind.BLOCK_COMMENT,
+    "word": CFTokenKind.WORD,
+    "number": CFTokenKind.WORD,
+    "operator": CFTokenKind.SYMBOL,
+}
+
+# groups whose text is subject to --lower-case
+CASE_FOLDED_GROUPS = set(["word"])
+
+QUOTES = (SINGLE_QUOTE, DOUBLE_QUOTE, BACKTICK)
+RE_DOLLAR_TAG_PREFIX = re.compile(r"\$[A-Za-z0-9_]*")
+RE_DOLLAR_TAG_CHARS = re.compile(r"[A-Za-z0-9_]*")
+RE_NEWLINE_BYTES = re.compile(rb"\n")
+
+COMMENT_KINDS = (CFTokenKind.LINE_COMMENT, CFTokenKind.BLOCK_COMMENT)
+
+
+def _build_keyphrase_trie(phrases):
+    # nested dicts keyed by (folded) word, where the key None marks the end of a complete phrase
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for word in phrase.split(" "):
+            node = node.setdefault(word, {})
+        node[None] = phrase
+    return trie
+
+KEYPHRASE_TRIE = _build_keyphrase_trie(FOUR_WORD_PHRASES + THREE_WORD_PHRASES + TWO_WORD_PHRASES)
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+RELEX_CHUNK_SIZE = 1024
+
+
+def is_numeric_char(c):
+    # btw there are some wonky characters where isdigit()=True like "¹"
+    return c.isdigit() or c in (".", "e", "E")
+
+
+# numeric word (integer literals, float literals, scientific literals)
+# r"[0-9]+"
+# r"[0-9]+\.([0-9]+)?([eE][-+]?[0-9]+)?"
+# r"([0-9]+)?\.[0-9]+([eE][-+]?[0-9]+)?"
+# r"[0-9]+[eE][-+]?[0-9]+"
+# but, it may be preferable to use the sloppy approach below, or a regex equivalent...
+# RE_TOKEN handles the common ASCII case, and this is the fallback for everything else.
+def _scan_number(input_string, i):
+    """
+    Returns the end position of the numeric word starting at i, or None if there isn't one.
+    """
+    length = len(input_string)
+    if not (
+        input_string[i].isdigit()
+        or ("." == input_string[i] and i+1 < length and input_string[i+1].isdigit())
+    ):
+        return None
+
+    j = i + 1
+    while j < length and is_numeric_char(input_string[j]):
+        j += 1
+    return j
+
+
+def _scan(input_string, i, pattern=RE_TOKEN):
+    """
+    Scans one token starting at position i, returning (kind, end, case_folded).
+    Every position produces a token: anything we can't otherwise match is a single-character SYMBOL.
+    """
+    match_res = pattern.match(input_string, i)
+    if match_res:
+        group = match_res.lastgroup
+        end = match_res.end()
+        if group == "qualified":
+            # only the unquoted parts get lower-cased, see _fold_case()
+            text = match_res.group()
+            kind = CFTokenKind.LITERAL if DOUBLE_QUOTE in text or BACKTICK in text else CFTokenKind.WORD
+            return (kind, end, True)
+        elif group == "number":
+            # RE_TOKEN only knows ASCII digits, so finish the job for any wonky ones that follow
+            length = len(input_string)
+            while end < length and is_numeric_char(input_string[end]):
+                end += 1
+        return (GROUP_KIND_MAP[group], end, group in CASE_FOLDED_GROUPS)
+
+    end = _scan_number(input_string, i)
+    if end is not None:
+        return (CFTokenKind.WORD, end, False)
+
+    # symbol
+    #   this is our dumping ground... if we haven't matched anything else, it must(?) be a symbol, which in practice means
+    #   actual symbols, control characters, plus most weird unicode stuff if it appears outside of quotes
+    return (CFTokenKind.SYMBOL, i + 1, False)
+
+
+class SourceError(ValueError):
+    """
+    Something wrong with the input itself, at a known offset into it (in bytes, for byte sources).
+    """
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+def _utf8_char(buffer, i):
+    """
+    Decodes just the one character starting at byte i of a UTF-8 buffer, returning (char, end).
+    """
+    lead = buffer[i]
+    if lead < 0x80:
+        return (chr(lead), i + 1)
+
+    end = i + (2 if lead < 0xE0 else 3 if lead < 0xF0 else 4)
+    try:
+        return (buffer[i:end].decode("utf-8"), end)
+    except UnicodeDecodeError:
+        raise SourceError("invalid UTF-8", i) from None
+
+
+def _scan_number_bytes(buffer, j):
+    # the rest of a numeric word, see _scan_number()
+    length = len(buffer)
+    while j < length:
+        char, char_end = _utf8_char(buffer, j)
+        if not is_numeric_char(char):
+            break
+        j = char_end
+    return j
+
+
+def _scan_bytes(buffer, i, pattern=RE_TOKEN_BYTES):
+    """
+    Same as _scan(), but over a UTF-8 bytes-like object, with byte offsets. Only characters the patterns don't
+    handle (i.e. non-ASCII ones outside of quotes and comments) get decoded.
+    """
+    match_res = pattern.match(buffer, i)
+    if match_res:
+        group = match_res.lastgroup
+        end = match_res.end()
+        if group == "qualified":
+            text = match_res.group()
+            kind = CFTokenKind.LITERAL if b'"' in text or b"`" in text else CFTokenKind.WORD
+            return (kind, end, True)
+        elif group == "number":
+            end = _scan_number_bytes(buffer, end)
+        return (GROUP_KIND_MAP[group], end, group in CASE_FOLDED_GROUPS)
+
+    char, end = _utf8_char(buffer, i)
+    if char.isdigit() or (char == "." and end < len(buffer) and _utf8_char(buffer, end)[0].isdigit()):
+        return (CFTokenKind.WORD, _scan_number_bytes(buffer, end), False)
+
+    return (CFTokenKind.SYMBOL, end, False)
+
+
+def _fold_case(kind, value):
+    if kind == CFTokenKind.WORD:
+        return value.lower()
+    # a qualified identifier with some quoted parts, e.g. Foo."Bar", split up the way the --dialect quotes them
+    return lexer_tables().identifier_part.sub(lambda m: m.group() if m.group("quoted") else m.group().lower(), value)
+
+
+def scan(input_string, lower_case=None, qualified_identifiers=False):
+    """
+    Splits input_string into tokens without assembling keyphrases. The token values concatenate back into the input,
+    unless words are lower-cased (which defaults to --lower-case).
+    With qualified_identifiers, dotted names such as foo.bar or "Foo"."Bar" come out as a single token, as
+    collapse_identifiers() would produce.
+    """
+    # https://www.postgresql.org/docs/current/sql-syntax-lexical.html
     if input_string is None or len(input_string) == 0:
         return []
 
-    RE_SPACES = re.compile(r"[ ]+")
-    RE_SINGLE_QUOTED_STRING = re.compile(r"(')(\\.|''|[^'\\])*(')")
-    RE_DOUBLE_QUOTED_STRING = re.compile(r'(")(\\.|""|[^"\\])*(")')
-    RE_BACKTICK_QUOTED_STRING = re.compile(r"(`)(\\.|``|[^`\\])*(`)")
-    RE_DOLLAR_QUOTED_STRING = re.compile(r"(\$[A-Za-z0-9_]*\$)(.*?)(\1)", flags=re.DOTALL)
-    RE_LINE_COMMENT = re.compile(r"--.*?(\n|$)")
-    RE_BLOCK_COMMENT = re.compile(r"(/\*)(.*?)(\*/)", flags=re.DOTALL)
-    RE_ALPHANUMERIC_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
-    RE_FOUR_WORD_KEYPHRASE = re.compile(f"({'|'.join(FOUR_WORD_PHRASES)})", flags=re.IGNORECASE)
-    RE_THREE_WORD_KEYPHRASE = re.compile(f"({'|'.join(THREE_WORD_PHRASES)})", flags=re.IGNORECASE)
-    RE_TWO_WORD_KEYPHRASE = re.compile(f"({'|'.join(TWO_WORD_PHRASES)})", flags=re.IGNORECASE)
-
+    if lower_case is None:
+        lower_case = cf_flags.LOWER_CASE
+    tables = lexer_tables()
+    pattern = tables.qualified_token if qualified_identifiers else tables.token
     tokens = []
 
     i = 0
-    while i < len(input_string):
-        # https://www.postgresql.org/docs/current/sql-syntax-lexical.html
+    length = len(input_string)
+    while i < length:
+        kind, end, case_folded = _scan(input_string, i, pattern)
+        value = input_string[i:end]
+        if case_folded and lower_case:
+            value = _fold_case(kind, value)
+        tokens.append(CFToken.unchecked(kind, value))
+        i = end
 
-        # newline
-        if "\n" == input_string[i]:
-            tokens.append(CFToken(CFTokenKind.NEWLINE, "\n"))
-            i += 1
-            continue
+    return tokens
 
-        # space(s)
-        match_res = RE_SPACES.match(input_string[i:])
-        if match_res:
-            string_of_spaces = match_res[0]
-            tokens.append(CFToken(CFTokenKind.SPACES, string_of_spaces))
-            i += len(string_of_spaces)
-            continue
 
-        # supposedly the (ANTLR) grammar for quotes...
-        # fragment DQUOTA_STRING : '"' ( '\\'. | '""' | ~('"' | '\\') )* '"';
-        # fragment SQUOTA_STRING : '\'' ('\\'. | '\'\'' | ~('\'' | '\\'))* '\'';
-        # fragment BQUOTA_STRING : '`' ( '\\'. | '``' | ~('`' | '\\'))* '`';
-
-        # all kinds of quoted strings
-        match_res = RE_SINGLE_QUOTED_STRING.match(input_string[i:])
-        if not match_res:
-            match_res = RE_DOUBLE_QUOTED_STRING.match(input_string[i:])
-        if not match_res:
-            match_res = RE_BACKTICK_QUOTED_STRING.match(input_string[i:])
-        if not match_res:
-            match_res = RE_DOLLAR_QUOTED_STRING.match(input_string[i:])
-        if match_res:
-            string_literal = match_res[0]
-            tokens.append(CFToken(CFTokenKind.LITERAL, string_literal))
-            i += len(string_literal)
-            continue
+def _match_keyphrase(peek):
+    """
+    Looks for a keyphrase starting at the current token. peek(k) returns the k-th token from the current one, or None
+    past the end. Any whitespace and comments may appear between the words of a phrase.
+    Returns (word_offsets, length) for the longest phrase found, or None.
+    """
+    first_token = peek(0)
+    if first_token.kind != CFTokenKind.WORD:
+        return None
+    node = KEYPHRASE_TRIE.get(first_token.key)
+    if node is None:
+        return None
 
-        # line comment
-        match_res = RE_LINE_COMMENT.match(input_string[i:])
-        if match_res:
-            line_comment = match_res[0]
-            tokens.append(CFToken(CFTokenKind.LINE_COMMENT, line_comment))
-            i += len(line_comment)
+    word_offsets = [0]
+    longest = None
+    k = 1
+    while True:
+        token = peek(k)
+        if token is None:
+            break
+        elif token.is_whitespace or token.kind in COMMENT_KINDS:
+            k += 1
             continue
+        elif token.kind != CFTokenKind.WORD:
+            break
 
-        # block comment
-        match_res = RE_BLOCK_COMMENT.match(input_string[i:])
-        if match_res:
-            block_comment = match_res[0]
-            tokens.append(CFToken(CFTokenKind.BLOCK_COMMENT, block_comment))
-            i += len(block_comment)
-            continue
+        node = node.get(token.key)
+        if node is None:
+            break
+        word_offsets.append(k)
+        k += 1
+        if None in node:
+            longest = (word_offsets.copy(), k)
 
-        # keyphrases
-        match_res = RE_FOUR_WORD_KEYPHRASE.match(input_string[i:])
-        if not match_res:
-            match_res = RE_THREE_WORD_KEYPHRASE.match(input_string[i:])
-        if not match_res:
-            match_res = RE_TWO_WORD_KEYPHRASE.match(input_string[i:])
-        if match_res:
-            keyphrase = match_res[0]
-            keyphrase = keyphrase.lower() if cf_flags.LOWER_CASE else keyphrase
-            tokens.append(CFToken(CFTokenKind.WORD, keyphrase))
-            i += len(keyphrase)
-            continue
+    return longest
 
-        # alphanumeric word (incl. underscore)
-        # TODO: also PG allows dollar-number placeholders e.g. $1
-        # TODO: and dollar signs in identifiers e.g. foo$bar (not SQL standard?)
-        match_res = RE_ALPHANUMERIC_WORD.match(input_string[i:])
-        if match_res:
-            word = match_res[0]
-            word = word.lower() if cf_flags.LOWER_CASE else word
-            tokens.append(CFToken(CFTokenKind.WORD, word))
-            i += len(word)
-            continue
 
-        # numeric word (integer literals, float literals, scientific literals)
-        # r"[0-9]+"
-        # r"[0-9]+\.([0-9]+)?([eE][-+]?[0-9]+)?"
-        # r"([0-9]+)?\.[0-9]+([eE][-+]?[0-9]+)?"
-        # r"[0-9]+[eE][-+]?[0-9]+"
-        # but, it may be preferable to use the sloppy approach below, or a regex equivalent...
-        if input_string[i].isdigit() or (
-            "." == input_string[i] and len(input_string) >= 2 and input_string[i+1].isdigit()
-        ): # btw there are some wonky characters where isdigit()=True like "¹"
-            j = i + 1
-            while j < len(input_string):
-                if not (input_string[j].isdigit() or input_string[j] in [".", "e", "E"]): # not strict, matches crap like 1.e37E5e.8. etc
-                    break
-                j += 1
-            numeric_word = input_string[i:j]
-            tokens.append(CFToken(CFTokenKind.WORD, numeric_word))
-            i = j
-            continue
+def _keyphrase_tokens(peek, word_offsets, length):
+    """
+    The tokens that replace a matched keyphrase: the phrase itself as one word, followed by any comments that were
+    inside it (each with a space in front), so that nothing is lost.
+    """
+    phrase = " ".join([peek(k).value for k in word_offsets])
+    out = [CFToken.unchecked(CFTokenKind.WORD, phrase)]
+    for k in range(length):
+        token = peek(k)
+        if token.kind in COMMENT_KINDS:
+            out.append(Whitespace.ONE_SPACE)
+            out.append(token)
+    return out
+
+
+def combine_keyphrases(tokens):
+    """
+    Assembles multi-word keyphrases like "group by" or "is not distinct from" into single WORD tokens.
+    """
+    out = []
+    i = 0
+    length = len(tokens)
+    peek = lambda k: tokens[i+k] if i+k < length else None
+    while i < length:
+        if tokens[i].kind == CFTokenKind.WORD and tokens[i].key in KEYPHRASE_TRIE:
+            keyphrase = _match_keyphrase(peek)
+            if keyphrase:
+                word_offsets, tokens_consumed = keyphrase
+                out += _keyphrase_tokens(peek, word_offsets, tokens_consumed)
+                i += tokens_consumed
+                continue
 
-        # symbol
-        #   this is our dumping ground... if we haven't matched anything else, it must(?) be a symbol, which in practice means
-        #   actual symbols, control characters, plus most weird unicode stuff if it appears outside of quotes
-        tokens.append(CFToken(CFTokenKind.SYMBOL, input_string[i]))
+        out.append(tokens[i])
         i += 1
-        continue
 
+    return out
+
+
+def iter_combine_keyphrases(tokens):
+    """
+    Lazy version of combine_keyphrases(), accepts any iterable of tokens.
+    """
+    tokens = iter(tokens)
+    lookahead = collections.deque()
+    def peek(k):
+        while len(lookahead) <= k:
+            token = next(tokens, None)
+            if token is None:
+                return None
+            lookahead.append(token)
+        return lookahead[k]
+
+    word = CFTokenKind.WORD
+    while True:
+        if not lookahead:
+            # the common case: a token that can't start a keyphrase goes straight through, without any lookahead
+            token = next(tokens, None)
+            if token is None:
+                return
+            if token.kind is not word or token.key not in KEYPHRASE_TRIE:
+                yield token
+                continue
+            lookahead.append(token)
+
+        keyphrase = _match_keyphrase(peek)
+        if keyphrase:
+            word_offsets, tokens_consumed = keyphrase
+            yield from _keyphrase_tokens(peek, word_offsets, tokens_consumed)
+            for _ in range(tokens_consumed):
+                lookahead.popleft()
+        else:
+            yield lookahead.popleft()
+
+
+def lex(input_string):
+    return combine_keyphrases(scan(input_string))
+
+
+def tokenize(input_string):
+    """
+    Like collapse_identifiers(lex(input_string)), but qualified identifiers are assembled by the scanner rather than
+    by a second pass over the tokens. Names are formed first, and only from words and quoted identifiers, so the
+    output differs where the old pipeline's window or order of passes got in the way:
+      - names of any number of parts are one token (a.b.c.d, not a.b.c then . d)
+      - a string or dollar-quoted literal isn't part of a name ($$x$$.y is $$x$$ . y)
+      - a name takes a word after a dot before keyphrases are formed (t.left join is t.left then join, and
+        group by.x is group then by.x, where the old pipeline formed the keyphrase first)
+    """
+    return combine_keyphrases(scan(input_string, qualified_identifiers=True))
+
+
+def _is_ambiguous(input_string, i, kind, end):
+    """
+    Whether the token scanned at i might have come out differently if input_string were longer,
+    i.e. whether a streaming lexer has to read more input before it can emit it.
+    """
+    length = len(input_string)
+    if end >= length:
+        # e.g. a word that might continue, or a quote or comment that hasn't been closed (yet)
+        return True
+
+    if input_string[end] == "." and kind in (CFTokenKind.WORD, CFTokenKind.LITERAL):
+        # a qualified identifier whose next part we haven't seen yet, e.g. foo.
+        return end + 1 >= length
+    elif kind == CFTokenKind.SYMBOL:
+        if input_string[i] == "$":
+            # a $tag that might still become a $tag$
+            return RE_DOLLAR_TAG_PREFIX.match(input_string, i).end() >= length
+        # an operator that might still get longer, e.g. - might be the start of ->>
+        return i + MAX_OPERATOR_LENGTH - 1 >= length
+
+    return False
+
+
+def _iter_scan(read, chunk_size, lower_case, pattern=RE_TOKEN):
+    buffer = ""
+    i = 0
+    at_eof = False
+    while True:
+        if i < len(buffer):
+            kind, end, case_folded = _scan(buffer, i, pattern)
+            if at_eof or not _is_ambiguous(buffer, i, kind, end):
+                value = buffer[i:end]
+                if case_folded and lower_case:
+                    value = _fold_case(kind, value)
+                yield CFToken.unchecked(kind, value)
+                i = end
+                continue
+        elif at_eof:
+            return
+
+        # Read at least as much as we're already holding, so that a very long token gets rescanned a logarithmic
+        # number of times rather than once per chunk.
+        more = read(max(chunk_size, len(buffer) - i))
+        if not more:
+            at_eof = True
+        buffer = buffer[i:] + more
+        i = 0
+
+
+def iter_lex(fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Lazily lexes the contents of a file-like object, yielding the same tokens as lex() would for the whole thing.
+    Only the current token and whatever is left of the current chunk are held in memory, so tokens that span chunk
+    boundaries (long literals, comments) are handled by reading more and scanning again.
+    """
+    scanned = _iter_scan(fileobj.read, chunk_size, cf_flags.LOWER_CASE, lexer_tables().token)
+    return iter_combine_keyphrases(scanned)
+
+
+def iter_tokenize(fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Lazy version of tokenize(), see iter_lex().
+    """
+    scanned = _iter_scan(fileobj.read, chunk_size, cf_flags.LOWER_CASE, lexer_tables().qualified_token)
+    return iter_combine_keyphrases(scanned)
+
+
+def iter_tokenize_buffer(buffer):
+    """
+    Lazy version of TokenArray.tokenize() for UTF-8 bytes or anything bytes-like, such as an mmap of a file: tokens
+    are scanned and decoded one at a time, so only the current one is held in memory. Errors have byte offsets.
+    """
+    def scanned():
+        pattern = lexer_tables().qualified_token_bytes
+        lower_case = cf_flags.LOWER_CASE
+        length = len(buffer)
+        i = 0
+        while i < length:
+            kind, end, case_folded = _scan_bytes(buffer, i, pattern)
+            try:
+                value = buffer[i:end].decode("utf-8")
+            except UnicodeDecodeError as e:
+                raise SourceError("invalid UTF-8", i + e.start) from None
+            if case_folded and lower_case:
+                value = _fold_case(kind, value)
+            yield CFToken.unchecked(kind, value)
+            i = end
+
+    return iter_combine_keyphrases(scanned())
+
+
+class TokenOffsets:
+    """
+    Where each of a list of tokens starts in the text they make up, and at index len(tokens) where it ends, for
+    relex(). Offsets are kept relative to the start of blocks of up to BLOCK tokens, so an edit only rebuilds the
+    blocks it touches and moves the start of each block after it: keeping them up to date costs time that grows with
+    the edit, plus a little per block, rather than with the text.
+    """
+    __slots__ = (
+        "_blocks", # per block, the offset of each of its tokens from the block's start, then the block's length
+        "_block_starts", # the offset of each block
+        "_block_firsts", # the index of each block's first token
+        "_count", # how many tokens
+    )
+    BLOCK = 512
+
+    def __init__(self, tokens):
+        self._blocks = []
+        self._block_starts = []
+        self._block_firsts = []
+        self._count = 0
+        self._replace_blocks(0, 0, [len(t.value) for t in tokens])
+
+
+    def __len__(self):
+        return self._count + 1
+
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count + 1
+        if not 0 <= i <= self._count:
+            raise IndexError("token offset index out of range")
+        if not self._blocks:
+            return 0
+        if i == self._count:
+            return self._block_starts[-1] + self._blocks[-1][-1]
+        b = bisect.bisect_right(self._block_firsts, i) - 1
+        return self._block_starts[b] + self._blocks[b][i - self._block_firsts[b]]
+
+
+    def index(self, offset):
+        """
+        The index of the last token starting at or before offset, i.e. bisect.bisect_right(offsets, offset) - 1, so
+        len(tokens) from the end of the text on.
+        """
+        b = bisect.bisect_right(self._block_starts, offset) - 1
+        if b < 0:
+            return -1 if offset < 0 else 0
+        return self._block_firsts[b] + bisect.bisect_right(self._blocks[b], offset - self._block_starts[b]) - 1
+
+
+    def splice(self, start, end, tokens):
+        """
+        Updates the offsets for tokens[start:end] of the list having been replaced with `tokens`.
+        """
+        if not 0 <= start <= end <= self._count:
+            raise IndexError(f"invalid token range [{start}, {end}) for {self._count} tokens")
+        first_block = max(bisect.bisect_right(self._block_firsts, start) - 1, 0)
+        last_block = max(bisect.bisect_right(self._block_firsts, max(end - 1, start)) - 1, 0)
+        if first_block < len(self._blocks):
+            region_first = self._block_firsts[first_block]
+        else:
+            region_first = 0
+        lengths = []
+        for block in self._blocks[first_block:last_block+1]:
+            lengths.extend([block[j+1] - block[j] for j in range(len(block) - 1)])
+        lengths[start - region_first:end - region_first] = [len(t.value) for t in tokens]
+        # fold what's left of a small block into the next one, so that edits don't leave more and more tiny blocks
+        if len(lengths) < self.BLOCK // 2 and last_block + 1 < len(self._blocks):
+            last_block += 1
+            block = self._blocks[last_block]
+            lengths.extend([block[j+1] - block[j] for j in range(len(block) - 1)])
+        self._replace_blocks(first_block, last_block + 1, lengths)
+
+
+    def _replace_blocks(self, first_block, end_block, lengths):
+        # replaces blocks [first_block, end_block) with evenly-sized blocks of tokens of the given lengths
+        count = len(lengths)
+        pieces = -(-count // self.BLOCK)
+        self._blocks[first_block:end_block] = [
+            list(itertools.accumulate(lengths[p * count // pieces:(p+1) * count // pieces], initial=0))
+            for p in range(pieces)
+        ]
+        # everything from the first replaced block on may have moved
+        del self._block_starts[first_block:]
+        del self._block_firsts[first_block:]
+        if first_block > 0:
+            start = self._block_starts[-1] + self._blocks[first_block-1][-1]
+            first = self._block_firsts[-1] + len(self._blocks[first_block-1]) - 1
+        else:
+            start = 0
+            first = 0
+        for block in itertools.islice(self._blocks, first_block, None):
+            self._block_starts.append(start)
+            self._block_firsts.append(first)
+            start += block[-1]
+            first += len(block) - 1
+        self._count = first
+
+
+def _lookahead_end(tokens, token_starts, i):
+    """
+    The offset of the last character that was looked at while lexing tokens[i]. An edit there or before it might
+    change how tokens[i] lexes.
+    """
+    end = token_starts[i+1]
+    if tokens[i].kind == CFTokenKind.SYMBOL:
+        if tokens[i].value == "$":
+            # whether this is a $tag$ depends on the characters up to the end of the tag-like prefix that follows
+            for j in range(i+1, len(tokens)):
+                value = tokens[j].value
+                prefix_length = RE_DOLLAR_TAG_CHARS.match(value).end()
+                end += prefix_length
+                if prefix_length < len(value):
+                    break
+        else:
+            # every operator of the dialect was tried
+            end = max(end, token_starts[i] + MAX_OPERATOR_LENGTH - 1)
+    # Everything else looks at most one character past its own end: quotes and comments that are never closed run
+    # to the end of the input instead of being given up on.
+    return end
+
+
+def relex(previous_tokens, edit_start, edit_end, new_text, offsets=None):
+    """
+    Given the tokens that scan(text, lower_case=False) produced, returns the same for the text after characters
+    [edit_start, edit_end) are replaced with new_text. Offsets are into the original text, i.e. the concatenation of
+    the token values, which is why they mustn't be lower-cased. Pass the result through combine_keyphrases() to get
+    what lex() would have returned.
+
+    Only the stretch from the nearest safe restart point before the edit to the first point after it where the new
+    tokens line up with the old ones again is actually lexed; the tokens on either side are reused as-is.
+
+    Finding the edit among the tokens takes their offsets, which cost O(n) to work out. So an editor that relexes
+    as the user types should keep a TokenOffsets(previous_tokens) from one edit to the next and pass it as `offsets`:
+    then previous_tokens is updated in place, along with offsets, and returned, and an edit costs time proportional
+    to the stretch relexed rather than to the whole text. Without offsets, previous_tokens is left as it was.
+    """
+    if offsets is None:
+        tokens = list(previous_tokens)
+        offsets = TokenOffsets(tokens)
+    else:
+        tokens = previous_tokens
+    text_length = offsets[-1]
+    if not (0 <= edit_start <= edit_end <= text_length):
+        raise ValueError(f"invalid edit range [{edit_start}, {edit_end}) for text of length {text_length}")
+
+    # Restart at a token boundary before the edit, far enough back that none of the earlier tokens could have
+    # looked at the edited text while being lexed. Token boundaries are never inside quotes or comments. Only symbols
+    # look further ahead than the next character: a $'s tag-like prefix spans at most a number and a word, and an
+    # operator at most two more symbols.
+    restart = offsets.index(edit_start)
+    for i in range(restart-1, max(restart-4, -1), -1):
+        if _lookahead_end(tokens, offsets, i) >= edit_start:
+            restart = i
+
+    # Reassemble the text from the restart point on: the edited stretch, then the untouched old tokens, lazily.
+    last_edited = min(offsets.index(edit_end), len(tokens) - 1)
+    restart_offset = offsets[restart]
+    old_stretch = "".join([t.value for t in tokens[restart:last_edited+1]])
+    new_stretch = (
+          old_stretch[:edit_start - restart_offset]
+        + new_text
+        + old_stretch[edit_end - restart_offset:]
+    )
+
+    def pieces():
+        yield new_stretch
+        for i in range(last_edited+1, len(tokens)):
+            yield tokens[i].value
+
+    piece_iter = pieces()
+    def read(size):
+        out = []
+        out_length = 0
+        for piece in piece_iter:
+            out.append(piece)
+            out_length += len(piece)
+            if out_length >= size:
+                break
+        return "".join(out)
+
+    # Lex until a token boundary after the edit coincides with a token boundary in the old text. From there on the
+    # text is identical, so the old tokens are too.
+    shift = len(new_text) - (edit_end - edit_start)
+    new_edit_end = edit_start + len(new_text)
+    new_tokens = []
+    position = restart_offset
+    resume = len(tokens)
+    for token in _iter_scan(read, RELEX_CHUNK_SIZE, lower_case=False, pattern=lexer_tables().token):
+        new_tokens.append(token)
+        position += len(token.value)
+        if position >= new_edit_end:
+            old_position = position - shift
+            i = offsets.index(old_position)
+            if offsets[i] == old_position:
+                resume = i
+                break
+
+    tokens[restart:resume] = new_tokens
+    offsets.splice(restart, resume, new_tokens)
     return tokens
 
 
@@ -210,24 +860,323 @@ def get_qualified_identifier(tokens):
         out_kind = CFTokenKind.LITERAL
     else:
         out_kind = CFTokenKind.WORD    
-    assembled_token = CFToken(out_kind, ''.join([t.value for t in consumed]))
+    assembled_token = CFToken.unchecked(out_kind, ''.join([t.value for t in consumed]))
     return (assembled_token, len(consumed))
 
 
-def collapse_identifiers(tokens):
-    out = []
-    i = 0
-    length = len(tokens)
-    while i < length:
-        if i+2 < length:
-            phrase = tokens[i:i+5]
-            qualified_identifier, tokens_consumed = get_qualified_identifier(phrase)
+def iter_collapse_identifiers(tokens):
+    """
+    Lazy version of collapse_identifiers(), accepts any iterable of tokens (e.g. from iter_lex()).
+    """
+    tokens = iter(tokens)
+    window = collections.deque(itertools.islice(tokens, 5))
+    while window:
+        if len(window) >= 3:
+            qualified_identifier, tokens_consumed = get_qualified_identifier(list(window))
             if qualified_identifier:
-                out.append(qualified_identifier)
-                i += tokens_consumed
+                yield qualified_identifier
+                for _ in range(tokens_consumed):
+                    window.popleft()
+                window.extend(itertools.islice(tokens, tokens_consumed))
                 continue
 
-        out.append(tokens[i])
-        i += 1
+        yield window.popleft()
+        window.extend(itertools.islice(tokens, 1))
 
-    return out
+
+def collapse_identifiers(tokens):
+    return list(iter_collapse_identifiers(tokens))
+
+
+# TokenArray stores each token's kind as one byte, with this bit set if the value gets lower-cased (--lower-case)
+KIND_CODES = {kind: code for code, kind in enumerate(CFTokenKind)}
+CODE_KINDS = list(CFTokenKind)
+CASE_FOLDED_FLAG = 0x80
+WORD_CODE = KIND_CODES[CFTokenKind.WORD]
+LITERAL_CODE = KIND_CODES[CFTokenKind.LITERAL]
+SYMBOL_CODE = KIND_CODES[CFTokenKind.SYMBOL]
+COMMENT_CODES = (KIND_CODES[CFTokenKind.LINE_COMMENT], KIND_CODES[CFTokenKind.BLOCK_COMMENT])
+
+
+def byte_location(buffer, offset):
+    """
+    The 1-based (line, column) of a byte offset into a UTF-8 buffer, with the column counted in characters.
+    """
+    line_start = buffer.rfind(b"\n", 0, offset) + 1
+    line = 1 + sum(1 for _ in RE_NEWLINE_BYTES.finditer(buffer, 0, line_start))
+    column = 1 + len(buffer[line_start:offset].decode("utf-8", errors="replace"))
+    return (line, column)
+
+
+class TokenArray:
+    """
+    A compact alternative to a list of CFTokens: kinds are kept in an array('B') and each token's value is a
+    [start, end) range of offsets into the original source, so no per-token objects or strings exist until a token is
+    actually looked at. Indexing materializes a CFToken; slicing returns a view sharing the same arrays. Anything that
+    only indexes, slices, iterates or takes len() of a token list (e.g. CompoundStatement) can consume one unchanged.
+
+    The source can also be UTF-8 bytes, or anything bytes-like such as an mmap of a file, in which case the offsets
+    are byte offsets and only the text of the tokens that are looked at ever gets decoded.
+    """
+    __slots__ = (
+        "source",
+        "kinds",
+        "starts",
+        "ends",
+        "overrides", # index -> CFToken, for the rare token whose value isn't simply its source range
+        "encoding", # None for a str source
+        "_offset",
+        "_length",
+    )
+
+    def __init__(self, source, kinds, starts, ends, overrides=None, encoding=None, _offset=0, _length=None):
+        self.source = source
+        self.kinds = kinds
+        self.starts = starts
+        self.ends = ends
+        self.overrides = overrides if overrides is not None else {}
+        self.encoding = encoding
+        self._offset = _offset
+        self._length = len(kinds) if _length is None else _length
+
+
+    @classmethod
+    def lex(cls, source):
+        return cls.scan(source).combine_keyphrases()
+
+
+    @classmethod
+    def tokenize(cls, source):
+        return cls.scan(source, qualified_identifiers=True).combine_keyphrases()
+
+
+    @classmethod
+    def scan(cls, source, qualified_identifiers=False):
+        tables = lexer_tables()
+        if isinstance(source, str):
+            scan_one = _scan
+            pattern = tables.qualified_token if qualified_identifiers else tables.token
+            encoding = None
+        else:
+            scan_one = _scan_bytes
+            pattern = tables.qualified_token_bytes if qualified_identifiers else tables.token_bytes
+            encoding = "utf-8"
+
+        if not source:
+            return cls(source, array("B"), array("I"), array("I"), encoding=encoding)
+
+        length = len(source)
+        # a 4 GB file is plausible, the offsets just need to be wider
+        offset_type = "I" if length < 2**32 else "Q"
+        kinds = array("B")
+        starts = array(offset_type)
+        ends = array(offset_type)
+        folded_flag = CASE_FOLDED_FLAG if cf_flags.LOWER_CASE else 0
+
+        i = 0
+        while i < length:
+            kind, end, case_folded = scan_one(source, i, pattern)
+            kinds.append(KIND_CODES[kind] | folded_flag if case_folded else KIND_CODES[kind])
+            starts.append(i)
+            ends.append(end)
+            i = end
+
+        return cls(source, kinds, starts, ends, encoding=encoding)
+
+
+    def _text(self, start, end):
+        text = self.source[start:end]
+        if self.encoding is None:
+            return text
+        try:
+            return text.decode(self.encoding)
+        except UnicodeDecodeError as e:
+            raise SourceError(f"invalid {self.encoding}", start + e.start) from None
+
+
+    def _first_char(self, i):
+        # only ever compared against ASCII, so there's no need to decode a whole character
+        c = self.source[self.starts[i]]
+        return c if self.encoding is None else chr(c)
+
+
+    def _new(self, kinds, starts, ends, overrides):
+        return TokenArray(self.source, kinds, starts, ends, overrides, encoding=self.encoding)
+
+
+    def _materialize(self, i):
+        # i is an absolute index into the arrays
+        token = self.overrides.get(i)
+        if token is not None:
+            return token
+
+        code = self.kinds[i]
+        kind = CODE_KINDS[code & ~CASE_FOLDED_FLAG]
+        value = self._text(self.starts[i], self.ends[i])
+        if code & CASE_FOLDED_FLAG:
+            value = _fold_case(kind, value)
+        return CFToken.unchecked(kind, value)
+
+
+    def location(self, index):
+        """
+        The (line, column) where token index starts, for a byte source, see byte_location().
+        """
+        if index < 0:
+            index += self._length
+        return byte_location(self.source, self.starts[self._offset + index])
+
+
+    def __len__(self):
+        return self._length
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return TokenArray(
+                self.source, self.kinds, self.starts, self.ends, self.overrides, self.encoding,
+                _offset=self._offset + start,
+                _length=max(stop - start, 0),
+            )
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("TokenArray index out of range")
+        return self._materialize(self._offset + index)
+
+
+    def __iter__(self):
+        for i in range(self._offset, self._offset + self._length):
+            yield self._materialize(i)
+
+
+    def __eq__(self, other):
+        if isinstance(other, (TokenArray, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+
+    def copy(self):
+        return list(self)
+
+
+    def __repr__(self):
+        return f"TokenArray({list(self)!r})"
+
+
+    def _is_potential_identifier(self, i):
+        code = self.kinds[i] & ~CASE_FOLDED_FLAG
+        return code == WORD_CODE or (code == LITERAL_CODE and self._first_char(i) != SINGLE_QUOTE)
+
+
+    def _is_dot(self, i):
+        return self.kinds[i] == SYMBOL_CODE and self._first_char(i) == "."
+
+
+    def combine_keyphrases(self):
+        """
+        Same as combine_keyphrases(), but returns a new TokenArray over the same source.
+        """
+        kinds = array("B")
+        starts = array(self.starts.typecode)
+        ends = array(self.ends.typecode)
+        overrides = {}
+
+        i = self._offset
+        end_index = self._offset + self._length
+        peek = lambda k: self._materialize(i+k) if i+k < end_index else None
+        while i < end_index:
+            keyphrase = None
+            if (self.kinds[i] & ~CASE_FOLDED_FLAG) == WORD_CODE:
+                keyphrase = _match_keyphrase(peek)
+
+            if not keyphrase:
+                if i in self.overrides:
+                    overrides[len(kinds)] = self.overrides[i]
+                kinds.append(self.kinds[i])
+                starts.append(self.starts[i])
+                ends.append(self.ends[i])
+                i += 1
+                continue
+
+            word_offsets, tokens_consumed = keyphrase
+            replacements = iter(_keyphrase_tokens(peek, word_offsets, tokens_consumed))
+
+            # the phrase itself spans from its first word to its last
+            phrase = next(replacements)
+            phrase_start = self.starts[i + word_offsets[0]]
+            phrase_end = self.ends[i + word_offsets[-1]]
+            if phrase.value != self._text(phrase_start, phrase_end):
+                overrides[len(kinds)] = phrase
+            kinds.append(WORD_CODE)
+            starts.append(phrase_start)
+            ends.append(phrase_end)
+
+            # then (space, comment) pairs, where the space is made up and the comment is where it always was
+            for k in range(tokens_consumed):
+                if (self.kinds[i+k] & ~CASE_FOLDED_FLAG) in COMMENT_CODES:
+                    space = next(replacements)
+                    overrides[len(kinds)] = space
+                    kinds.append(KIND_CODES[space.kind])
+                    starts.append(self.starts[i+k])
+                    ends.append(self.starts[i+k])
+
+                    next(replacements)
+                    kinds.append(self.kinds[i+k])
+                    starts.append(self.starts[i+k])
+                    ends.append(self.ends[i+k])
+
+            i += tokens_consumed
+
+        return self._new(kinds, starts, ends, overrides)
+
+
+    def collapse_identifiers(self):
+        """
+        Same as collapse_identifiers(), but returns a new TokenArray over the same source.
+        """
+        kinds = array("B")
+        starts = array(self.starts.typecode)
+        ends = array(self.ends.typecode)
+        overrides = {}
+
+        i = self._offset
+        end_index = self._offset + self._length
+        while i < end_index:
+            # see collapse_identifiers() and get_qualified_identifier(), this is the same five-token window
+            j = i + 1
+            if i+2 < end_index and self._is_potential_identifier(i):
+                window_end = min(i + 5, end_index)
+                while j+1 < window_end and self._is_dot(j) and self._is_potential_identifier(j+1):
+                    j += 2
+
+            if j == i + 1:
+                if i in self.overrides:
+                    overrides[len(kinds)] = self.overrides[i]
+                kinds.append(self.kinds[i])
+            else:
+                parts = [self._materialize(k) for k in range(i, j)]
+                out_kind = CFTokenKind.LITERAL if any(p.kind == CFTokenKind.LITERAL for p in parts) else CFTokenKind.WORD
+                value = "".join([p.value for p in parts])
+                if value != self._text(self.starts[i], self.ends[j-1]):
+                    overrides[len(kinds)] = CFToken.unchecked(out_kind, value)
+                kinds.append(KIND_CODES[out_kind])
+            starts.append(self.starts[i])
+            ends.append(self.ends[j-1])
+            i = j
+
+        return self._new(kinds, starts, ends, overrides)
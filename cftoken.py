@@ -1,6 +1,6 @@
 import re
 import enum
-from dataclasses import dataclass
+from dataclasses import FrozenInstanceError
 from types import SimpleNamespace
 
 
@@ -28,27 +28,71 @@ class CFTokenKind(enum.Enum):
 # to warrant their own types. We'll see.
 
 
-@dataclass(frozen=True)
+# Tokens are immutable, so common ones (keywords, symbols, whitespace, short identifiers...) are interned: constructing
+# the same token twice gives back the same instance. This saves memory, and lets __eq__ short-circuit on identity.
+# Literals and comments are mostly unique and potentially huge, so they aren't interned. The table is capped so that a
+# long-running process lexing lots of distinct identifiers can't grow it without bound.
+INTERNED_KINDS = (CFTokenKind.WORD, CFTokenKind.SYMBOL, CFTokenKind.SPACES, CFTokenKind.NEWLINE)
+INTERN_MAX_LENGTH = 64
+INTERN_MAX_ENTRIES = 100_000
+
+_interned = {kind: {} for kind in CFTokenKind}
+_interned_count = 0
+
+# Keywords and Symbols (below) are numbered from 1, in one registry of (kind, key) -> ID, and every token is tagged with
+# its ID when it's made, or 0 if it's neither. Scope and delimiter checks can then be integer lookups into tables or
+# bitmasks (see keyword_mask()), instead of hashing and comparing strings.
+KEYWORD_IDS = {}
+
+
 class CFToken:
-    kind: CFTokenKind
-    value: str
-    is_whitespace: bool
+    __slots__ = (
+        "kind",
+        "value",
+        "is_whitespace",
+        "key", # the value as compared for equality, i.e. lower-cased for words
+        "keyword_id", # see KEYWORD_IDS
+        "_hash",
+    )
 
 
-    def __init__(self, kind, value):
+    def __new__(cls, kind, value):
         CFToken._validate(kind, value)
+        return CFToken.unchecked(kind, value)
 
-        object.__setattr__(self, "kind", kind)
-        object.__setattr__(self, "value", value)
 
-        object.__setattr__(self, "is_whitespace", kind in (CFTokenKind.SPACES, CFTokenKind.NEWLINE))
+    @staticmethod
+    def unchecked(kind, value):
+        """
+        Like the regular constructor but skips validation, for use by the lexer, which only produces valid tokens.
+        """
+        table = _interned[kind]
+        token = table.get(value)
+        if token is not None:
+            return token
+
+        token = object.__new__(CFToken)
+        key = value.lower() if kind == CFTokenKind.WORD else value
+        _set_kind(token, kind)
+        _set_value(token, value)
+        _set_is_whitespace(token, kind in (CFTokenKind.SPACES, CFTokenKind.NEWLINE))
+        _set_key(token, key)
+        _set_keyword_id(token, KEYWORD_IDS.get((kind, key), 0))
+        _set_hash(token, hash((kind, key)))
+
+        global _interned_count
+        if kind in INTERNED_KINDS and len(value) <= INTERN_MAX_LENGTH and _interned_count < INTERN_MAX_ENTRIES:
+            table[value] = token
+            _interned_count += 1
+
+        return token
 
 
     @staticmethod
     def _validate(kind, value):
         if kind == CFTokenKind.NEWLINE and value != "\n":
             raise ValueError("NEWLINE tokens can only have the value '\\n'")
-        elif kind == CFTokenKind.SPACES and (value == "" or any([c != " " for c in value])):
+        elif kind == CFTokenKind.SPACES and (value == "" or value.strip(" ") != ""):
             raise ValueError("SPACES tokens must consist only of space characters")
 
         return True
@@ -63,21 +107,33 @@ class CFToken:
         return self.value
 
 
+    def render_into(self, writer, indent):
+        writer.write(self.value)
+
+
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+
+    def __reduce__(self):
+        return (CFToken, (self.kind, self.value))
+
+
     def __eq__(self, other):
         # no need to include `is_whitespace` in the comparison since it is derived
+        if self is other:
+            return True
         if self.__class__ is other.__class__:
-            if self.kind == CFTokenKind.WORD:
-                return (self.kind, self.value.lower()) == (other.kind, other.value.lower())
-            else:
-                return (self.kind, self.value) == (other.kind, other.value)
+            return self.kind is other.kind and self.key == other.key
         return NotImplemented
 
 
     def __hash__(self):
-        if self.kind == CFTokenKind.WORD:
-            return hash((self.kind, self.value.lower()))
-        else:
-            return hash((self.kind, self.value))
+        return self._hash
 
 
     def __str__(self):
@@ -88,6 +144,15 @@ class CFToken:
         return f"CFToken(CFTokenKind.{self.kind.name}, '{self.value}')"
 
 
+# __setattr__ is disabled, so unchecked() writes the slots through their descriptors
+_set_kind = CFToken.kind.__set__
+_set_value = CFToken.value.__set__
+_set_is_whitespace = CFToken.is_whitespace.__set__
+_set_key = CFToken.key.__set__
+_set_keyword_id = CFToken.keyword_id.__set__
+_set_hash = CFToken._hash.__set__
+
+
 Keywords = SimpleNamespace(
     ALL                = CFToken(CFTokenKind.WORD, "all"),
     AND                = CFToken(CFTokenKind.WORD, "and"),
@@ -106,6 +171,7 @@ Keywords = SimpleNamespace(
     GROUP_BY           = CFToken(CFTokenKind.WORD, "group by"),
     HAVING             = CFToken(CFTokenKind.WORD, "having"),
     INNER_JOIN         = CFToken(CFTokenKind.WORD, "inner join"),
+    INSERT             = CFToken(CFTokenKind.WORD, "insert"),
     INTERSECT          = CFToken(CFTokenKind.WORD, "intersect"),
     INTERSECT_ALL      = CFToken(CFTokenKind.WORD, "intersect all"),
     INTERSECT_DISTINCT = CFToken(CFTokenKind.WORD, "intersect distinct"),
@@ -121,6 +187,7 @@ Keywords = SimpleNamespace(
     ON                 = CFToken(CFTokenKind.WORD, "on"),
     OR                 = CFToken(CFTokenKind.WORD, "or"),
     ORDER_BY           = CFToken(CFTokenKind.WORD, "order by"),
+    PARTITION_BY       = CFToken(CFTokenKind.WORD, "partition by"),
     RIGHT_JOIN         = CFToken(CFTokenKind.WORD, "right join"),
     RIGHT_OUTER_JOIN   = CFToken(CFTokenKind.WORD, "right outer join"),
     SELECT             = CFToken(CFTokenKind.WORD, "select"),
@@ -128,6 +195,7 @@ Keywords = SimpleNamespace(
     UNION_ALL          = CFToken(CFTokenKind.WORD, "union all"),
     UNION_DISTINCT     = CFToken(CFTokenKind.WORD, "union distinct"),
     USING              = CFToken(CFTokenKind.WORD, "using"),
+    VALUES             = CFToken(CFTokenKind.WORD, "values"),
     WHERE              = CFToken(CFTokenKind.WORD, "where"),
     WITH               = CFToken(CFTokenKind.WORD, "with"),
 )
@@ -139,6 +207,29 @@ Symbols = SimpleNamespace(
     RIGHT_PAREN = CFToken(CFTokenKind.SYMBOL, ")"),
 )
 
+# the registry is filled in after the fact, so the tokens above are tagged here rather than when they were made
+for _token in list(vars(Keywords).values()) + list(vars(Symbols).values()):
+    KEYWORD_IDS[(_token.kind, _token.key)] = len(KEYWORD_IDS) + 1
+    _set_keyword_id(_token, len(KEYWORD_IDS))
+del _token
+
+KeywordIds = SimpleNamespace(**{name: token.keyword_id for name, token in vars(Keywords).items()})
+SymbolIds = SimpleNamespace(**{name: token.keyword_id for name, token in vars(Symbols).items()})
+
+
+def keyword_mask(tokens):
+    """
+    A bitmask with the bit for each token's keyword ID set, so `mask >> token.keyword_id & 1` tests membership.
+    Bit 0 is never set, so tokens that aren't keywords are never members.
+    """
+    mask = 0
+    for token in tokens:
+        if token.keyword_id == 0:
+            raise ValueError(f"{token!r} is not a keyword or symbol")
+        mask |= 1 << token.keyword_id
+    return mask
+
+
 Whitespace = SimpleNamespace(
     NEWLINE   = CFToken(CFTokenKind.NEWLINE, "\n"),
     ONE_SPACE = CFToken(CFTokenKind.SPACES, " "),
@@ -0,0 +1,368 @@
+import collections
+
+from cftoken import CFToken
+
+
+class RenderWriter:
+    """
+    Where render_into() puts its output: either a list of fragments (see getvalue()) or a text stream such as stdout.
+
+    Renderables used to return strings, which their parents joined, post-processed and returned in turn, so text
+    nested n levels deep was copied n times. Instead everything is written here, and passed on a line at a time.
+    The post-processing that renderables did to their own output is done through the writer:
+      - a run of newlines is held back until something follows it, so rstrip_newlines() can drop the ones a
+        renderable wrote at its very end, as `out.rstrip("\\n")` used to
+      - with strip_trailing_whitespace, each line has its trailing whitespace stripped as it's passed on, exactly
+        like splitting the finished output into lines and rstrip()ing each one
+    """
+    __slots__ = (
+        "_fragments", # None when writing to a stream
+        "_stream",
+        "_strip_trailing_whitespace",
+        "_line", # fragments of the current line, which is passed on once it's complete
+        "_pending_newlines", # newlines written but not yet passed on
+        "_column", # column after the text written so far, not counting pending newlines
+        "_writes", # how many times text other than newlines has been written, to tell if anything was since a mark()
+        "cache", # a RenderCache for everything rendered into this writer, or None
+    )
+
+    def __init__(self, stream=None, strip_trailing_whitespace=False, cache=None):
+        self._fragments = [] if stream is None else None
+        self._stream = stream
+        self._strip_trailing_whitespace = strip_trailing_whitespace
+        self._line = []
+        self._pending_newlines = 0
+        self._column = 0
+        self._writes = 0
+        self.cache = cache
+
+
+    @property
+    def column(self):
+        """
+        The column the next character will be written at, counting from 0.
+        """
+        return 0 if self._pending_newlines > 0 else self._column
+
+
+    def write(self, text):
+        if "\n" not in text:
+            # the common case, and the fast path: part of a line
+            if text:
+                if self._pending_newlines > 0:
+                    self._end_lines()
+                self._line.append(text)
+                self._column += len(text)
+                self._writes += 1
+            return
+
+        body = text.rstrip("\n")
+        if body:
+            if self._pending_newlines > 0:
+                self._end_lines()
+            lines = body.split("\n")
+            self._line.append(lines[0])
+            for line in lines[1:]:
+                self._pending_newlines = 1
+                self._end_lines()
+                self._line.append(line)
+            self._column = len(lines[-1]) if len(lines) > 1 else self._column + len(body)
+            self._writes += 1
+
+        self._pending_newlines += len(text) - len(body)
+
+
+    def mark(self):
+        """
+        Remembers the current position, for rstrip_newlines() and ends_with_newline().
+        """
+        return (self._writes, self._pending_newlines)
+
+
+    def _newlines_since(self, mark):
+        writes, pending_newlines = mark
+        if self._writes == writes:
+            return self._pending_newlines - pending_newlines
+        return self._pending_newlines
+
+
+    def ends_with_newline(self, mark):
+        """
+        Whether the text written since `mark` ends with a newline.
+        """
+        return self._newlines_since(mark) > 0
+
+
+    def rstrip_newlines(self, mark):
+        """
+        Drops any newlines at the end of the text written since `mark`.
+        """
+        self._pending_newlines -= self._newlines_since(mark)
+
+
+    def finish(self):
+        """
+        Passes on everything written so far, including any newlines being held back and the last, incomplete line.
+        """
+        if self._pending_newlines > 0:
+            self._end_lines()
+        if self._line:
+            self._emit(self._take_line())
+
+
+    def getvalue(self):
+        if self._fragments is None:
+            raise ValueError("getvalue() is only available when not writing to a stream")
+        self.finish()
+        return "".join(self._fragments)
+
+
+    def _take_line(self):
+        line = "".join(self._line)
+        self._line = []
+        if self._strip_trailing_whitespace:
+            line = line.rstrip()
+        return line
+
+
+    def _end_lines(self):
+        # ends the current line, and passes it on along with the pending newlines
+        self._emit(self._take_line() + "\n" * self._pending_newlines)
+        self._pending_newlines = 0
+        self._column = 0
+
+
+    def _emit(self, text):
+        if self._fragments is None:
+            self._stream.write(text)
+        else:
+            self._fragments.append(text)
+
+
+class RenderCache:
+    """
+    Rendered text of subtrees, for reuse by identical subtrees later in the same render (see run_render_steps()).
+
+    Renderables that can be cached give a cache_key(), built from a structural hash of the tokens they span (see
+    span_hash()), so finding an identical subtree doesn't mean comparing or re-hashing its tokens. A subtree's text is
+    only kept the second time its key comes up, so text isn't copied for subtrees that never repeat. Cached text is
+    reused at the indent it was rendered at, or at any indent if it's a single line, since indent only affects what
+    follows a newline (unless single_lines_at_any_indent is False, as when layout depends on the width left, see
+    cf_flags.MAX_WIDTH). At most `max_entries` keys are kept, least recently used first out.
+
+    Everything is assumed to be rendered with the same cf_flags, so a RenderCache shouldn't outlive one render.
+    """
+    __slots__ = (
+        "max_entries",
+        "single_lines_at_any_indent",
+        "hits",
+        "misses",
+        "evictions",
+        "_entries", # key -> (indent, text), where text is None if the key has only come up once so far
+        "_list_hashes", # id of a token list -> (the list, hashes of its first 0, BLOCK, 2*BLOCK, ... elements)
+        "_block_hashes", # (id of a token list, block number) -> (the list, prefix hashes within the block)
+    )
+    DEFAULT_MAX_ENTRIES = 1024
+    # polynomial hashing modulo a Mersenne prime
+    MODULUS = 2**61 - 1
+    BASE = 1_000_003
+    # span_hash() keeps prefix hashes a block of elements at a time, for at most this many blocks and lists
+    BLOCK = 1024
+    MAX_BLOCKS = 64
+    MAX_LISTS = 256
+    BLOCK_POWERS = None # BASE ** i % MODULUS for i up to BLOCK, see below
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, single_lines_at_any_indent=True):
+        self.max_entries = max_entries
+        self.single_lines_at_any_indent = single_lines_at_any_indent
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._list_hashes = collections.OrderedDict()
+        self._block_hashes = collections.OrderedDict()
+
+
+    def span_hash(self, tokens, start, end):
+        """
+        A hash of tokens[start:end]. Tokens are hashed by their kind and value as written, so spans differing only in
+        case don't match, and elements with a cache_key(), i.e. subqueries in a list of clause elements, by that.
+
+        A span of up to BLOCK elements is hashed as it is. Longer ones are hashed from prefix hashes, which are worked
+        out a block of BLOCK elements at a time, as far into the list as needed, keeping only the hash of each block's
+        start for the whole list. So a hash costs O(BLOCK), or less, once the blocks up to it have been hashed,
+        whatever the size of the span, and memory is bounded by MAX_BLOCKS and MAX_LISTS.
+        """
+        if end - start <= self.BLOCK:
+            return self._hash_elements(tokens, start, end)
+        modulus = self.MODULUS
+        return (self._prefix_hash(tokens, end)
+                - self._prefix_hash(tokens, start) * pow(self.BASE, end - start, modulus)) % modulus
+
+
+    def _prefix_hash(self, tokens, i):
+        # the hash of tokens[:i]
+        block, offset = divmod(i, self.BLOCK)
+        starts = self._block_starts(tokens, block)
+        if offset == 0:
+            return starts[block]
+        return (starts[block] * self.BLOCK_POWERS[offset] + self._block_prefixes(tokens, block)[offset]) % self.MODULUS
+
+
+    def _block_starts(self, tokens, block):
+        # hashes of tokens[:0], tokens[:BLOCK], ..., at least as far as tokens[:block * BLOCK]
+        entry = self._list_hashes.get(id(tokens))
+        if entry is None:
+            # the list is kept alongside its hashes, so its id can't be reused by another list
+            entry = (tokens, [0])
+            self._list_hashes[id(tokens)] = entry
+            if len(self._list_hashes) > self.MAX_LISTS:
+                self._list_hashes.popitem(last=False)
+        else:
+            self._list_hashes.move_to_end(id(tokens))
+        starts = entry[1]
+        block_power = self.BLOCK_POWERS[self.BLOCK]
+        while len(starts) <= block:
+            b = len(starts) - 1
+            starts.append((starts[b] * block_power + self._block_prefixes(tokens, b)[-1]) % self.MODULUS)
+        return starts
+
+
+    def _block_prefixes(self, tokens, block):
+        # hashes of tokens[s:s], tokens[s:s+1], ..., tokens[s:s+BLOCK] where s = block * BLOCK (or to the list's end)
+        key = (id(tokens), block)
+        entry = self._block_hashes.get(key)
+        if entry is not None:
+            self._block_hashes.move_to_end(key)
+            return entry[1]
+
+        prefixes = [0]
+        start = block * self.BLOCK
+        self._hash_elements(tokens, start, min(len(tokens), start + self.BLOCK), prefixes)
+        self._block_hashes[key] = (tokens, prefixes)
+        if len(self._block_hashes) > self.MAX_BLOCKS:
+            self._block_hashes.popitem(last=False)
+        return prefixes
+
+
+    def _hash_elements(self, tokens, start, end, prefixes=None):
+        # the hash of tokens[start:end], appending the hash of each prefix of it to prefixes, if given
+        modulus = self.MODULUS
+        base = self.BASE
+        keyed_types = {} # type -> whether it has a cache_key()
+        h = 0
+        for i in range(start, end):
+            e = tokens[i]
+            t = type(e)
+            if t is CFToken:
+                # not hash(e), which folds the case of words
+                e_hash = hash((e.kind, e.value))
+            else:
+                keyed = keyed_types.get(t)
+                if keyed is None:
+                    keyed = keyed_types[t] = hasattr(t, "cache_key")
+                key = e.cache_key(self) if keyed else None
+                # an element that can't give a key only matches itself
+                e_hash = hash(e if key is None else key)
+            h = (h * base + e_hash) % modulus
+            if prefixes is not None:
+                prefixes.append(h)
+        return h
+
+
+    def lookup(self, key, indent):
+        """
+        Returns (text, store): the cached text for key at indent, or None, and whether the text rendered instead is
+        worth passing to store(), because key has come up before.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            self._put(key, (indent, None))
+            return (None, False)
+
+        self._entries.move_to_end(key)
+        cached_indent, text = entry
+        if text is not None and (cached_indent == indent or (self.single_lines_at_any_indent and "\n" not in text)):
+            self.hits += 1
+            return (text, False)
+        self.misses += 1
+        return (None, True)
+
+
+    def store(self, key, indent, text):
+        self._put(key, (indent, text))
+
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+        }
+
+
+RenderCache.BLOCK_POWERS = [pow(RenderCache.BASE, i, RenderCache.MODULUS) for i in range(RenderCache.BLOCK + 1)]
+
+
+def render_to_string(renderable, indent):
+    """
+    render_into() a fresh list of fragments and join it, for the string-returning render() methods.
+    """
+    writer = RenderWriter()
+    renderable.render_into(writer, indent)
+    return writer.getvalue()
+
+
+def run_render_steps(renderable, writer, indent):
+    """
+    Runs renderable.render_steps(writer, indent), a generator which writes the renderable's own text and yields a
+    (child, writer, indent) for each child it needs rendered before it can carry on. Children are run the same way,
+    from a stack of suspended generators rather than by recursion, so how deeply renderables can nest is only limited
+    by memory. A child without render_steps() (e.g. a CFToken) is simply render_into()ed.
+
+    If `writer` has a cache, a child with a cache_key() has its text taken from the cache when it can be, and is
+    otherwise rendered into a scratch writer if the cache wants to store its text.
+    """
+    cache = writer.cache
+    # each entry is a generator, and if its text is being stored, (key, indent, scratch writer, writer)
+    stack = [(renderable.render_steps(writer, indent), None)]
+    while stack:
+        steps, storing = stack[-1]
+        child = next(steps, None)
+        if child is None:
+            stack.pop()
+            if storing is not None:
+                key, indent, scratch, writer = storing
+                text = scratch.getvalue()
+                cache.store(key, indent, text)
+                writer.write(text)
+            continue
+
+        child, writer, indent = child
+        if not hasattr(child, "render_steps"):
+            child.render_into(writer, indent)
+            continue
+
+        storing = None
+        if cache is not None and hasattr(child, "cache_key"):
+            key = child.cache_key(cache)
+            if key is not None:
+                text, store = cache.lookup(key, indent)
+                if text is not None:
+                    writer.write(text)
+                    continue
+                if store:
+                    scratch = RenderWriter()
+                    storing = (key, indent, scratch, writer)
+                    writer = scratch
+        stack.append((child.render_steps(writer, indent), storing))
@@ -1,7 +1,9 @@
 import enum
 
 import cf_flags
-from cftoken import CFToken, CFTokenKind, Keywords, Symbols, Whitespace
+from cflayout import layout_expression
+from cftoken import KEYWORD_IDS, CFToken, CFTokenKind, KeywordIds, Keywords, SymbolIds, Symbols, Whitespace, keyword_mask
+from cfwriter import RenderWriter, render_to_string, run_render_steps
 
 
 def next_real_token(tokens):
@@ -25,24 +27,80 @@ def get_paren_block(tokens):
     if tokens[0] != Symbols.LEFT_PAREN:
         raise ValueError("first token must be \"(\"")
 
+    right_paren_index = find_matching_paren(tokens, 0)
+    if right_paren_index is None:
+        return None
+    else:
+        return tokens[:right_paren_index+1]
+
+
+def find_matching_paren(tokens, i, end=None):
+    """
+    Index of the ")" matching the "(" at tokens[i], or None if there isn't one before `end`.
+    """
     depth = 0
-    block = []
-    block_found = False
-    for t in tokens:
+    for j in range(i, len(tokens) if end is None else end):
+        t = tokens[j]
         if t == Symbols.LEFT_PAREN:
             depth += 1
         elif t == Symbols.RIGHT_PAREN:
             depth -= 1
-        block.append(t)
+            if depth == 0:
+                return j
+    return None
 
-        if t == Symbols.RIGHT_PAREN and depth == 0:
-            block_found = True
-            break
 
-    if block_found:
-        return block
-    else:
-        return None
+class TokenIndex:
+    """
+    Paren structure and whitespace skipping for a list of tokens, worked out in one pass up front, so that parsing
+    can look them up in constant time instead of rescanning (and copying) the rest of the list at every paren.
+
+    One index serves a whole tree: nested statements are spans of the same list, so they share their parent's index
+    and just check that what it finds falls inside their span.
+    """
+    __slots__ = (
+        "_matching_paren", # for each "(" the index of its ")", or None if it has none
+        "_next_real", # for each index, the index of the first non-whitespace token at or after it
+    )
+
+    def __init__(self, tokens):
+        length = len(tokens)
+        matching_paren = [None] * length
+        next_real = [length] * (length + 1)
+
+        left_paren = SymbolIds.LEFT_PAREN
+        right_paren = SymbolIds.RIGHT_PAREN
+        open_parens = []
+        for i, t in enumerate(tokens):
+            keyword_id = t.keyword_id
+            if keyword_id == left_paren:
+                open_parens.append(i)
+            elif keyword_id == right_paren:
+                if open_parens:
+                    matching_paren[open_parens.pop()] = i
+
+        j = length
+        for i in range(length - 1, -1, -1):
+            if not tokens[i].is_whitespace:
+                j = i
+            next_real[i] = j
+
+        self._matching_paren = matching_paren
+        self._next_real = next_real
+
+
+    def matching_paren(self, i):
+        """
+        Index of the ")" matching the "(" at i, or None if it has none.
+        """
+        return self._matching_paren[i]
+
+
+    def next_real(self, i):
+        """
+        Index of the first non-whitespace token at or after i, or the length of the list if there is none.
+        """
+        return self._next_real[i]
 
 
 # I'm not sure what my original concept for this function was. It's currently unused, and left here as a breadcrumb.
@@ -105,7 +163,7 @@ def trim_one_leading_space(tokens):
     else:
         # for multiple spaces, replace it with a token having 1 fewer spaces
         length = len(first_token.value)
-        one_shorter = CFToken(CFTokenKind.SPACES, " "*(length-1))
+        one_shorter = CFToken.unchecked(CFTokenKind.SPACES, " "*(length-1))
         return [one_shorter] + tokens[1:]
 
 
@@ -120,37 +178,52 @@ def make_compact(tokens):
     #- (word, space, left_paren) -> drop the space
 
     # The general pattern here is that after making any change that might affect future pattern matches,
-    # we jump back to the top of the loop. And if we changed the "current" token, we move the index variable
-    # back by one (if possible), again to make sure we can see any patterns that created.
+    # we jump back to the top of the loop. And if we changed the "current" token, we step back by one token
+    # (if possible), again to make sure we can see any patterns that created.
+    #
+    # The tokens are kept in two stacks either side of the current token, so that every change and every step
+    # (forward or back) is O(1): `out` holds everything before it, and `pending` holds the current token and
+    # everything after it, reversed, so the current token is pending[-1], the next is pending[-2] and so on.
+    # Tokens only ever move back onto `pending` one at a time, after a change, so the whole thing is linear.
 
-    out = tokens.copy()
+    out = []
+    pending = trim_leading_whitespace(trim_trailing_whitespace(tokens))[::-1]
 
-    out = trim_leading_whitespace(trim_trailing_whitespace(out))
+    def step_back():
+        if out:
+            pending.append(out.pop())
 
-    i = 0
-    while i < len(out):
-        tok = out[i]
+    while pending:
+        tok = pending[-1]
+
+        # a list of literals is compacted as a whole, see LiteralList
+        if type(tok) is LiteralList:
+            pending.pop()
+            out.append(tok.compacted())
+            continue
 
         # skip non-tokens (e.g. CompoundStatement)
         # this check is repeated in the multi-token blocks
         if type(tok) is not CFToken:
-            i += 1
+            out.append(pending.pop())
             continue
 
 
         # shrink all strings of spaces down to 1
         if tok.kind == CFTokenKind.SPACES and len(tok.value) > 1:
             tok = Whitespace.ONE_SPACE
-            out[i] = tok
+            pending[-1] = tok
 
 
         # 3-token sequences
-        if i+2 < len(out):
-            next_tok = out[i+1]
-            after_next_tok = out[i+2]
-
-            if type(after_next_tok) is not CFToken:
-                i += 1
+        if len(pending) >= 3:
+            next_tok = pending[-2]
+            after_next_tok = pending[-3]
+
+            # a list of literals (which always follows a "(") is never part of a pattern, but unlike a subquery it
+            # mustn't stop the tokens before it being matched
+            if type(after_next_tok) is not CFToken and type(after_next_tok) is not LiteralList:
+                out.append(pending.pop())
                 continue
 
             # "word", " ", "("
@@ -158,118 +231,451 @@ def make_compact(tokens):
             if (    tok.kind == CFTokenKind.WORD
                 and next_tok.kind == CFTokenKind.SPACES
                 and after_next_tok.value == "("
-                and tok.value.lower() != "in"
+                and tok.key != "in"
                 ):
-                out.pop(i+1)
+                del pending[-2]
                 continue
 
 
         # 2-token sequences
-        if i+1 < len(out):
-            next_tok = out[i+1]
+        if len(pending) >= 2:
+            next_tok = pending[-2]
 
             if type(next_tok) is not CFToken:
-                i += 1
+                out.append(pending.pop())
                 continue
 
             # " ", "\n"
             if tok.kind == CFTokenKind.SPACES and next_tok.kind == CFTokenKind.NEWLINE:
-                out.pop(i+1)
+                del pending[-2]
                 continue
 
             # "\n", " "
             if tok.kind == CFTokenKind.NEWLINE and next_tok.kind == CFTokenKind.SPACES:
-                out.pop(i)
-                i = max(i - 1, 0)
+                pending.pop()
+                step_back()
                 continue
 
             # " ", " "  (doesn't occur naturally but this process can create it as an intermediate state)
             if tok.kind == CFTokenKind.SPACES and next_tok.kind == CFTokenKind.SPACES:
-                out.pop(i)
-                i = max(i - 1, 0)
+                pending.pop()
+                step_back()
                 continue
 
             # "(", " "
             if tok.value == "(" and next_tok.kind == CFTokenKind.SPACES:
-                out.pop(i+1)
+                del pending[-2]
                 continue
 
             # " ", ")"
             if tok.kind == CFTokenKind.SPACES and next_tok.value == ")":
-                out.pop(i)
-                i = max(i - 1, 0)
+                pending.pop()
+                step_back()
                 continue
 
             # " ", ","
             if tok.kind == CFTokenKind.SPACES and next_tok.value == ",":
-                out.pop(i)
-                i = max(i - 1, 0)
+                pending.pop()
+                step_back()
                 continue
         # end of 2-token sequences
 
 
         # replace any newlines left (not caught by sequence matches) with a single space
         if tok.kind == CFTokenKind.NEWLINE:
-            out[i] = Whitespace.ONE_SPACE
-            i = max(i - 1, 0)
+            pending[-1] = Whitespace.ONE_SPACE
+            step_back()
             continue
 
-        i += 1
+        out.append(pending.pop())
 
     return out
 
 
-def is_parenthesized_subquery(elements):
+STATEMENT_START_MASK = keyword_mask([Keywords.SELECT, Keywords.WITH])
+
+
+def starts_subquery(tokens, token_index, i, end):
+    # a "(" followed by SELECT or WITH, ignoring whitespace
+    j = token_index.next_real(i+1)
+    return j < end and STATEMENT_START_MASK >> tokens[j].keyword_id & 1
+
+
+def subquery_right_paren(token_index, i, end):
+    # the ")" closing the subquery whose "(" is at i, or None if it isn't closed before `end`
+    right_paren_index = token_index.matching_paren(i)
+    if right_paren_index is not None and right_paren_index < end:
+        return right_paren_index
+    return None
+
+
+def is_parenthesized_subquery(elements, i=0, end=None):
+    # checks elements[i:i+3], without slicing
     return (
-            len(elements) >= 3
-        and elements[0] == Symbols.LEFT_PAREN
-        and (   isinstance(elements[1], Statement)
-             or isinstance(elements[1], CompoundStatement)
+            (len(elements) if end is None else end) >= i+3
+        and elements[i].keyword_id == SymbolIds.LEFT_PAREN
+        and (   isinstance(elements[i+1], Statement)
+             or isinstance(elements[i+1], CompoundStatement)
             )
-        and elements[2] == Symbols.RIGHT_PAREN
+        and elements[i+2].keyword_id == SymbolIds.RIGHT_PAREN
     )
 
 
-class Expression:
+LITERAL_WORDS = frozenset(["null", "true", "false"])
+SIGNS = frozenset(["-", "+"])
+
+
+def is_number(token):
+    # numbers are words (see cftoken), but ones that start like a number
+    return token.kind == CFTokenKind.WORD and token.value[0] in "0123456789."
+
+
+def literal_list_end(tokens, i, end):
+    """
+    If the "(" at tokens[i] starts a list of at least two literals (strings or quoted identifiers, numbers, maybe with
+    a sign, NULL, TRUE or FALSE) separated by commas, with nothing else in it but spaces and line breaks, the index of
+    its ")" (which is before `end`), otherwise None. Only the tokens up to the first one that doesn't fit are looked at.
+    """
+    spaces = CFTokenKind.SPACES
+    newline = CFTokenKind.NEWLINE
+    literal = CFTokenKind.LITERAL
+    symbol = CFTokenKind.SYMBOL
+    comma = SymbolIds.COMMA
+    right_paren = SymbolIds.RIGHT_PAREN
+    items = 0
+    expect_item = True
+    j = i+1
+    while j < end:
+        t = tokens[j]
+        if type(t) is not CFToken:
+            # a subquery
+            return None
+        kind = t.kind
+        if kind is spaces or kind is newline:
+            j += 1
+        elif expect_item:
+            if kind is literal or is_number(t) or t.key in LITERAL_WORDS:
+                j += 1
+            elif kind is symbol and t.value in SIGNS and j+1 < end and is_number(tokens[j+1]):
+                j += 2
+            else:
+                return None
+            items += 1
+            expect_item = False
+        elif t.keyword_id == comma:
+            expect_item = True
+            j += 1
+        elif t.keyword_id == right_paren:
+            return j if items >= 2 else None
+        else:
+            return None
+    return None
+
+
+# expressions spanning fewer tokens than this are cheaper to render than to look up in a RenderCache
+CACHE_MIN_TOKENS = 8
+
+
+class LazyNode:
+    """
+    Base for nodes that don't build their children until they're first needed, e.g. for rendering. Building a node
+    only validates it and remembers the arguments for its _parse(), so finding out what's at the top of a big
+    statement doesn't parse everything underneath it too.
+
+    _parse() returns the values of the attributes named in PARSED, in order, which subclasses declare with
+    parsed_attribute(); reading any of them runs _parse(), once.
+    """
     __slots__ = (
-        "input_tokens",
-        "elements",
+        "_unparsed", # the arguments for _parse(), until it's been run
+        "_metrics", # see node_metrics()
     )
+    PARSED = ()
 
-    def __init__(self, tokens):
-        self.input_tokens = tokens
-        self.elements = self._parse(tokens)
+    def __init__(self, *unparsed):
+        self._unparsed = unparsed
+        self._metrics = None
+
+    def _ensure_parsed(self):
+        if self._unparsed is not None:
+            values = self._parse(*self._unparsed)
+            for name, value in zip(self.PARSED, values):
+                setattr(self, "_" + name, value)
+            self._unparsed = None
+
+
+def parsed_attribute(name):
+    def get(self):
+        self._ensure_parsed()
+        return getattr(self, "_" + name)
+    return property(get)
+
+
+COMMENT_KINDS = (CFTokenKind.LINE_COMMENT, CFTokenKind.BLOCK_COMMENT)
+
+
+class NodeMetrics:
+    """
+    Sizes of a node's rendered output, for layout decisions that would otherwise need a trial render:
+      - width: its length laid out on a single line, counting each line break as one character and no indentation
+      - lines: how many lines it renders as, at indent 0
+      - has_comment: whether there's a comment anywhere in it, subqueries included
+      - depth: how many levels of (compound) statement it contains, e.g. 1 for a query with no subqueries, and 0 for
+        an expression without any
+    """
+    __slots__ = (
+        "width",
+        "lines",
+        "has_comment",
+        "depth",
+    )
+
+    def __init__(self, width=0, lines=1, has_comment=False, depth=0):
+        self.width = width
+        self.lines = lines
+        self.has_comment = has_comment
+        self.depth = depth
+
+    def __repr__(self):
+        return f"NodeMetrics(width={self.width}, lines={self.lines}, has_comment={self.has_comment}, depth={self.depth})"
+
+
+def node_metrics(node):
+    """
+    The NodeMetrics of a node, worked out the first time they're asked for and then kept on it. They're computed
+    bottom-up, each node's from its children's (see _metric_children() and _measure()), in one pass over the subtree
+    (which parses all of it) driven by a stack rather than by recursion, like rendering.
+    """
+    if node._metrics is not None:
+        return node._metrics
+
+    # nodes whose children haven't been pushed yet, and None before each node whose children have been measured
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if n is None:
+            n = stack.pop()
+            n._metrics = n._measure()
+        elif n._metrics is None:
+            stack.append(n)
+            stack.append(None)
+            stack.extend(n._metric_children())
+
+    return node._metrics
+
+
+def token_metrics(token):
+    value = token.value
+    return NodeMetrics(len(value), value.count("\n") + 1, token.kind in COMMENT_KINDS)
+
+
+def subtree_elements(elements, start, end):
+    # the elements of a span that aren't tokens, i.e. subqueries
+    return [e for e in elements[start:end] if type(e) is not CFToken]
+
+
+def measure_span(elements, start, end, first=None, subquery_line_breaks=False):
+    """
+    NodeMetrics for elements[start:end] (with `first` in place of the first one, if given) rendered one after another,
+    as by Expression and JunkClause: tokens as they are, and subqueries as given by their own metrics. Newlines at the
+    very end don't count, since both of them strip those. With subquery_line_breaks, each "(" subquery ")" has a line
+    break before its ")", as in Expression.
+    """
+    width = 0
+    newlines = 0
+    trailing_newlines = 0
+    has_comment = False
+    depth = 0
+    i = start
+    while i < end:
+        e = first if (i == start and first is not None) else elements[i]
+
+        if type(e) is CFToken:
+            value = e.value
+            width += len(value)
+            if e.kind in COMMENT_KINDS:
+                has_comment = True
+            if "\n" in value:
+                body = value.rstrip("\n")
+                newlines += value.count("\n")
+                trailing_newlines = (0 if body else trailing_newlines) + len(value) - len(body)
+            elif value:
+                trailing_newlines = 0
+
+            if subquery_line_breaks and e.keyword_id == SymbolIds.LEFT_PAREN and is_parenthesized_subquery(elements, i, end):
+                child = elements[i+1]._metrics
+                width += child.width + 1 # and the ")"
+                newlines += child.lines # the subquery's own line breaks, and one before the ")"
+                has_comment = has_comment or child.has_comment
+                depth = max(depth, child.depth)
+                trailing_newlines = 0
+                i += 3
+                continue
+        else:
+            child = e._metrics
+            width += child.width
+            newlines += child.lines - 1
+            has_comment = has_comment or child.has_comment
+            depth = max(depth, child.depth)
+            trailing_newlines = 0
+
+        i += 1
+
+    return NodeMetrics(width - trailing_newlines, newlines - trailing_newlines + 1, has_comment, depth)
+
+
+def measure_clause(delimiters, expressions):
+    """
+    NodeMetrics for a clause that puts each delimiter and the expression after it on a line of its own, with a
+    delimiter's width taken as that of its token alone, not counting any padding.
+    """
+    width = len(delimiters) - 1 # a space before every delimiter but the first
+    lines = len(delimiters)
+    has_comment = False
+    depth = 0
+    for delimiter, expression in zip(delimiters, expressions):
+        width += len(delimiter.value)
+        m = expression._metrics
+        if not expression.is_empty():
+            width += 1 + m.width
+            lines += m.lines - 1
+        has_comment = has_comment or m.has_comment
+        depth = max(depth, m.depth)
+    return NodeMetrics(width, lines, has_comment, depth)
+
+
+class Expression(LazyNode):
+    """
+    A span of a shared token list. Trimming whitespace only moves the ends of the span; the one exception is a run
+    of several leading spaces losing one space, which is kept as a replacement for the span's first token.
+    """
+    __slots__ = (
+        "_tokens",
+        "_start",
+        "_end",
+        "_first", # replaces tokens[start] if not None
+    )
+    PARSED = ("tokens", "start", "end", "first")
+    tokens = parsed_attribute("tokens")
+    start = parsed_attribute("start")
+    end = parsed_attribute("end")
+    first = parsed_attribute("first")
+
+    def __init__(self, tokens, start=0, end=None):
+        if end is None:
+            end = len(tokens)
+        # an empty span may come out backwards, like an empty slice
+        super().__init__(tokens, start, max(start, end))
+
+    @property
+    def elements(self):
+        self._ensure_parsed()
+        if self._first is None:
+            return list(self._tokens[self._start:self._end])
+        return [self._first] + list(self._tokens[self._start+1:self._end])
 
     @property
     def is_whitespace(self):
-        return all([e.is_whitespace for e in self.elements])
+        self._ensure_parsed()
+        if self._first is not None and not self._first.is_whitespace:
+            return False
+        tokens = self._tokens
+        for i in range(self._start if self._first is None else self._start+1, self._end):
+            if not tokens[i].is_whitespace:
+                return False
+        return True
 
     def is_empty(self):
-        return len(self.elements) == 0
+        self._ensure_parsed()
+        return self._start == self._end
+
+    def cache_key(self, cache):
+        self._ensure_parsed()
+        if self._end - self._start < CACHE_MIN_TOKENS:
+            return None
+        return (Expression, cache.span_hash(self._tokens, self._start, self._end), self._end - self._start, self._first)
+
+    metrics = property(node_metrics)
+
+    def _metric_children(self):
+        self._ensure_parsed()
+        return subtree_elements(self._tokens, self._start, self._end)
+
+    def _measure(self):
+        self._ensure_parsed()
+        return measure_span(self._tokens, self._start, self._end, self._first, subquery_line_breaks=True)
+
+    def _starts_with_line_break(self, indent):
+        # whether this renders starting with "\n" and then `indent` spaces (for indent > 0), see SelectClause
+        self._ensure_parsed()
+        tokens, start, end = self._tokens, self._start, self._end
+        if end - start < 2 or self._first is not None or tokens[start] != Whitespace.NEWLINE:
+            return False
+        e = tokens[start+1]
+        if e.kind == CFTokenKind.NEWLINE or e.kind in COMMENT_KINDS:
+            return False
+        if e.kind == CFTokenKind.SPACES and start+2 < end and tokens[start+2].kind in COMMENT_KINDS:
+            # spaces before a comment aren't padded out to the indent
+            return len(e.value) >= indent
+        return True
 
-    def _parse(self, tokens):
-        temp = trim_trailing_whitespace(tokens)
+    def _parse(self, tokens, start, end):
+        # trim trailing whitespace
+        while end > start and tokens[end-1].is_whitespace:
+            end -= 1
 
+        first = None
         if cf_flags.FORMAT_MODE == cf_flags.FormatMode.TRIM_LEADING_WHITESPACE:
-            temp2 = trim_leading_whitespace(temp)
-        else:
-            temp2 = trim_one_leading_space(temp)
+            while start < end and tokens[start].is_whitespace:
+                start += 1
+        elif start < end and tokens[start].kind == CFTokenKind.SPACES:
+            # trim one leading space, see trim_one_leading_space()
+            if tokens[start].value == " ":
+                start += 1
+            else:
+                first = CFToken.unchecked(CFTokenKind.SPACES, " "*(len(tokens[start].value)-1))
 
         if cf_flags.FORMAT_MODE == cf_flags.FormatMode.COMPACT_EXPRESSIONS:
-            temp3 = make_compact(temp2)
-        else:
-            temp3 = temp2
+            if first is None:
+                compacted = make_compact(list(tokens[start:end]))
+            else:
+                compacted = make_compact([first] + list(tokens[start+1:end]))
+            return (compacted, 0, len(compacted), None)
 
-        return temp3
+        return (tokens, start, end, first)
 
     def render(self, indent):
-        out = ""
+        return render_to_string(self, indent)
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+    def render_steps(self, writer, indent):
+        mark = writer.mark()
+        # this expression's own text is gathered here and only written out before a subquery and at the end, since
+        # a write() per token is comparatively slow
+        parts = []
         effective_indent = indent
         immediately_after_newline = False
-        i = 0
-        while i < len(self.elements):
-            e = self.elements[i]
-            next_e = self.elements[i+1] if i+1 < len(self.elements) else None
+        self._ensure_parsed()
+        tokens = self._tokens
+        start = self._start
+        end = self._end
+        first = self._first
+
+        if cf_flags.MAX_WIDTH is not None:
+            # an expression that's too wide is broken to fit, unless it has line breaks or comments already, in which
+            # case its layout is the author's
+            metrics = self.metrics
+            if metrics.lines == 1 and not metrics.has_comment and indent + metrics.width > cf_flags.MAX_WIDTH:
+                writer.write(layout_expression(
+                    tokens, start, end, first, indent, cf_flags.MAX_WIDTH, cf_flags.FILL_LITERAL_LISTS
+                ))
+                return
+
+        i = start
+        while i < end:
+            e = first if (i == start and first is not None) else tokens[i]
+            next_e = tokens[i+1] if i+1 < end else None
 
             if immediately_after_newline:
                 if e.kind == CFTokenKind.NEWLINE:
@@ -283,84 +689,235 @@ class Expression:
                     else:
                         extra_spaces = indent - len(e.value)
                         if extra_spaces > 0:
-                            out += " " * extra_spaces
+                            parts.append(" " * extra_spaces)
                             effective_indent = extra_spaces
                 elif e.kind in (CFTokenKind.LINE_COMMENT, CFTokenKind.BLOCK_COMMENT):
                     # if a newline is immediately followed by a comment, don't add any spaces
                     pass
                 else:
                     # otherwise, add enough spaces to reach the indent
-                    out += " " * indent
+                    parts.append(" " * indent)
                     effective_indent = indent
                 immediately_after_newline = False
 
-            fragment = e.render(effective_indent)
-            out += fragment
-            effective_indent += len(fragment)
+            if type(e) is LiteralList:
+                fragment, effective_indent = e.render_in_expression(indent, effective_indent)
+                parts.append(fragment)
+            else:
+                fragment = e.render(effective_indent)
+                parts.append(fragment)
+                effective_indent += len(fragment)
 
             if e == Whitespace.NEWLINE or e.kind == CFTokenKind.LINE_COMMENT:
                 #PONDER: what if we made the newline itself responsible for adding the indent, in render()?
                 immediately_after_newline = True
-            elif e == Symbols.LEFT_PAREN and is_parenthesized_subquery(self.elements[i:i+3]):
+            elif e.keyword_id == SymbolIds.LEFT_PAREN and is_parenthesized_subquery(tokens, i, end):
                 paren_indent = effective_indent - 1
-                out += self.elements[i+1].render(effective_indent)
-                out += "\n"
-                out += " " * paren_indent
-                out += ")"
+                writer.write("".join(parts))
+                yield (tokens[i+1], writer, effective_indent)
+                parts = ["\n", " " * paren_indent, ")"]
                 i += 3 # left paren, subquery, right paren
                 continue
 
             i += 1
 
+        writer.write("".join(parts))
+
         # I'm not *quite* confident that doing this in Expresion is desirable...
-        out = out.rstrip("\n")
-        return out
+        writer.rstrip_newlines(mark)
+
+
+class LiteralList:
+    """
+    The inside of a parenthesized list of literals (see literal_list_end()), standing in for its tokens among a
+    statement's elements, so that a list of thousands of values is one element to split clauses over, compact, hash
+    and render, rather than a few tokens per value. Its text is joined in one go, and with --max-width it's laid out
+    by cflayout from its pieces().
+
+    It renders as its tokens would, or, once compacted(), as make_compact() would have left them. In an Expression,
+    line breaks in it are followed by enough spaces to reach the indent, as they would be among the tokens (see
+    render_in_expression()).
+    """
+    __slots__ = (
+        "tokens",
+        "start",
+        "end",
+        "compact",
+        "_pieces",
+        "_text",
+        "_metrics", # see node_metrics()
+    )
+    # like a token that isn't a keyword, or whitespace, or of any other kind, for when it's among tokens
+    keyword_id = 0
+    kind = None
+    is_whitespace = False
+
+    def __init__(self, tokens, start, end, compact=False):
+        self.tokens = tokens
+        self.start = start
+        self.end = end
+        self.compact = compact
+        self._pieces = None
+        self._text = None
+        self._metrics = None
+
+    def compacted(self):
+        return LiteralList(self.tokens, self.start, self.end, compact=True)
+
+    def pieces(self):
+        """
+        (leading, items, separators, trailing): any whitespace before the first item, the text of each item, the text
+        between each item and the next (a comma, and any whitespace around it), and any whitespace after the last item.
+        When compact there is no whitespace but a space after each comma that had any.
+        """
+        if self._pieces is None:
+            self._pieces = self._split()
+        return self._pieces
+
+    def _split(self):
+        tokens = self.tokens
+        spaces = CFTokenKind.SPACES
+        newline = CFTokenKind.NEWLINE
+        comma = SymbolIds.COMMA
+        leading = ""
+        items = []
+        separators = []
+        between = []
+        for i in range(self.start, self.end):
+            t = tokens[i]
+            if t.kind is spaces or t.kind is newline or t.keyword_id == comma:
+                between.append(t.value)
+            elif not between and items:
+                # the number after a sign
+                items[-1] += t.value
+            else:
+                if items:
+                    separators.append("".join(between))
+                else:
+                    leading = "".join(between)
+                items.append(t.value)
+                between = []
+        trailing = "".join(between)
+
+        if self.compact:
+            return ("", items, ["," if s.endswith(",") else ", " for s in separators], "")
+        return (leading, items, separators, trailing)
+
+    @property
+    def text(self):
+        if self._text is None:
+            if self.compact:
+                leading, items, separators, trailing = self.pieces()
+                parts = [items[0]]
+                for separator, item in zip(separators, items[1:]):
+                    parts.append(separator)
+                    parts.append(item)
+                self._text = "".join(parts)
+            else:
+                tokens = self.tokens
+                self._text = "".join([tokens[i].value for i in range(self.start, self.end)])
+        return self._text
+
+    def cache_key(self, cache):
+        # the text is all there is to it (and hashing a string is quicker than hashing its tokens)
+        return (LiteralList, self.text)
+
+    metrics = property(node_metrics)
+
+    def _metric_children(self):
+        return []
+
+    def _measure(self):
+        text = self.text
+        return NodeMetrics(len(text), text.count("\n") + 1)
+
+    def render(self, indent):
+        return self.text
+
+    def render_in_expression(self, indent, effective_indent):
+        """
+        (text, effective_indent) for this list rendered by Expression.render_steps() at `indent`, having got as far
+        as `effective_indent`, with the same padding after line breaks as its tokens would be given there, including
+        before the ")" that follows it.
+        """
+        text = self.text
+        if "\n" not in text:
+            return (text, effective_indent + len(text))
+
+        spaces = CFTokenKind.SPACES
+        newline = CFTokenKind.NEWLINE
+        tokens = self.tokens
+        parts = []
+        immediately_after_newline = False
+        for i in range(self.start, self.end):
+            t = tokens[i]
+            if immediately_after_newline:
+                if t.kind is newline:
+                    pass
+                elif t.kind is spaces:
+                    extra_spaces = indent - len(t.value)
+                    if extra_spaces > 0:
+                        parts.append(" " * extra_spaces)
+                        effective_indent = extra_spaces
+                else:
+                    parts.append(" " * indent)
+                    effective_indent = indent
+            parts.append(t.value)
+            effective_indent += len(t.value)
+            immediately_after_newline = t.kind is newline
+        if immediately_after_newline:
+            parts.append(" " * indent)
+            effective_indent = indent
+        return ("".join(parts), effective_indent)
+
+    def render_into(self, writer, indent):
+        writer.write(self.text)
 
 
 # see https://www.postgresql.org/docs/14/queries-with.html
-class WithClause:
+class WithClause(LazyNode):
     __slots__ = (
-        "input_tokens",
-        "delimiters",
-        "before_stuff", # e.g. "identifier as" or "identifier as materialized" or "identifier(<col list>) as"
-        "statements",
-        "after_stuff", # SEARCH clause for recursive CTEs, rarely used. Also used to capture broken syntax
+        "_delimiters",
+        "_before_stuff", # e.g. "identifier as" or "identifier as materialized" or "identifier(<col list>) as"
+        "_statements",
+        "_after_stuff", # SEARCH clause for recursive CTEs, rarely used. Also used to capture broken syntax
     )
+    PARSED = ("delimiters", "before_stuff", "statements", "after_stuff")
+    delimiters = parsed_attribute("delimiters")
+    before_stuff = parsed_attribute("before_stuff")
+    statements = parsed_attribute("statements")
+    after_stuff = parsed_attribute("after_stuff")
     STARTING_DELIMITER = CFToken(CFTokenKind.WORD, "with")
     OTHER_DELIMITERS = set([Symbols.COMMA])
     CTE_INDENT_SPACES = 4
 
-    def __init__(self, tokens):
-        self._validate(tokens)
+    def __init__(self, tokens, start=0, end=None, delimiter_indexes=None):
+        if end is None:
+            end = len(tokens) if tokens is not None else 0
 
-        self.input_tokens = tokens
+        self._validate(tokens, start, end)
 
-        (
-            self.delimiters,
-            self.before_stuff,
-            self.statements,
-            self.after_stuff,
-        ) = self._parse(tokens)
+        super().__init__(tokens, start, end, delimiter_indexes)
 
 
-    def _validate(self, tokens):
-        if not tokens:
+    def _validate(self, tokens, start, end):
+        if start >= end:
             raise ValueError("tokens must be non-empty")
 
-        if tokens[0] != self.STARTING_DELIMITER:
+        if tokens[start] != self.STARTING_DELIMITER:
             raise ValueError(f"WithClause must begin with \"WITH\" keyword")
 
         return True
 
 
-    def _parse_pieces(self, tokens):
-        i = 0
-        while i < len(tokens):
-            if is_parenthesized_subquery(tokens[i:i+3]):
+    def _parse_pieces(self, tokens, start, end):
+        i = start
+        while i < end:
+            if is_parenthesized_subquery(tokens, i, end):
                 # discard the parens
-                before = tokens[:i]
+                before = Expression(tokens, start, i)
                 statement = tokens[i+1]
-                after = tokens[i+3:]
+                after = Expression(tokens, i+3, end)
                 return (before, statement, after)
             i += 1
 
@@ -369,61 +926,45 @@ class WithClause:
 
         # (should log a warning?)
 
-        i = 0
+        # (the paren indexes are relative to start)
+        i = start
         left_paren_index = None
         right_paren_index = None
-        while i < len(tokens):
+        while i < end:
             if tokens[i] == Symbols.LEFT_PAREN:
-                left_paren_index = i
+                left_paren_index = i - start
             elif tokens[i] == Symbols.RIGHT_PAREN:
-                right_paren_index = i
+                right_paren_index = i - start
 
             if left_paren_index and right_paren_index:
                 # as in the well-formed case, discard the parens
-                before = tokens[:left_paren_index]
-                junk = Expression(tokens[left_paren_index+1:right_paren_index])
-                after = tokens[right_paren_index+1:]
+                before = Expression(tokens, start, start+left_paren_index)
+                junk = Expression(tokens, start+left_paren_index+1, start+right_paren_index)
+                after = Expression(tokens, start+right_paren_index+1, end)
                 return (before, junk, after)
 
             i += 1
 
         # welp.
-        raise ValueError(f"could not divide CTE tokens: {tokens}")
+        raise ValueError(f"could not divide CTE tokens: {list(tokens[start:end])}")
 
 
-    def _parse(self, tokens):
-        i = 1 # we already know token 0 is the starting delimiter
-        delimiters = [tokens[0]]
+    def _parse(self, tokens, start, end, delimiter_indexes):
+        if delimiter_indexes is None:
+            delimiter_indexes = split_clauses(tokens, start, end, self.__class__)[0][3]
+
+        delimiters = [tokens[start]] + [tokens[i] for i in delimiter_indexes]
         before_stuff = []
         statements = []
         after_stuff = []
-        paren_depth = 0
-        buffer = []
-        while i < len(tokens):
-            if paren_depth == 0 and tokens[i] in self.OTHER_DELIMITERS:
-                delimiters.append(tokens[i])
-                before_tokens, stmt, after_tokens = self._parse_pieces(buffer)
-                before_stuff.append(Expression(before_tokens))
-                statements.append(stmt)
-                after_stuff.append(Expression(after_tokens))
-                buffer = []
-            else:
-                if tokens[i] == Symbols.LEFT_PAREN:
-                    paren_depth += 1
-                elif tokens[i] == Symbols.RIGHT_PAREN:
-                    #TODO: detect unbalanced parens
-                    paren_depth -= 1
-                buffer.append(tokens[i])
-            i += 1
-        # one final expression, empty in the weird/broken case where the final token was JOIN or etc
-        if (len(buffer) > 0
-            or len(delimiters) > len(before_stuff)
-            or len(delimiters) > len(statements)
-            or len(delimiters) > len(after_stuff)):
-            before_tokens, stmt, after_tokens = self._parse_pieces(buffer)
-            before_stuff.append(Expression(before_tokens))
+        piece_start = start+1 # we already know the first token is the starting delimiter
+        # one piece after each delimiter, the last one empty in the weird/broken case where the final token was a comma
+        for piece_end in delimiter_indexes + [end]:
+            before, stmt, after = self._parse_pieces(tokens, piece_start, piece_end)
+            before_stuff.append(before)
             statements.append(stmt)
-            after_stuff.append(Expression(after_tokens))
+            after_stuff.append(after)
+            piece_start = piece_end+1
 
         assert len(delimiters) == len(before_stuff)
         assert len(delimiters) == len(statements)
@@ -432,281 +973,355 @@ class WithClause:
         return (delimiters, before_stuff, statements, after_stuff)
 
 
+    metrics = property(node_metrics)
+
+
+    def _metric_children(self):
+        return self.before_stuff + self.statements + self.after_stuff
+
+
+    def _measure(self):
+        delimiters, before_stuff, statements, after_stuff = self.delimiters, self.before_stuff, self.statements, self.after_stuff
+        width = len(delimiters) - 1
+        lines = len(delimiters)
+        has_comment = False
+        depth = 0
+        for i in range(len(delimiters)):
+            # delimiter, before stuff, "(", statement, ")", after stuff, with the statement on lines of its own
+            width += len(delimiters[i].value) + 2 + statements[i]._metrics.width + 1
+            lines += 3 + statements[i]._metrics.lines - 1
+            for m in (before_stuff[i]._metrics, after_stuff[i]._metrics):
+                if m.width > 0:
+                    width += 1 + m.width
+                    lines += m.lines - 1
+            for m in (before_stuff[i]._metrics, statements[i]._metrics, after_stuff[i]._metrics):
+                has_comment = has_comment or m.has_comment
+                depth = max(depth, m.depth)
+        return NodeMetrics(width, lines, has_comment, depth)
+
+
     def render(self, indent):
-        parts = []
+        return render_to_string(self, indent)
+
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+
+    def render_steps(self, writer, indent):
+        delimiters, before_stuff, statements, after_stuff = self.delimiters, self.before_stuff, self.statements, self.after_stuff
+        mark = writer.mark()
         i = 0
         effective_indent = indent
-        while i < len(self.delimiters):
+        while i < len(delimiters):
             # indent
             if i > 0:
-                parts.append("\n")
-                parts.append(" " * indent)
+                writer.write("\n")
+                writer.write(" " * indent)
                 effective_indent = indent
 
             # delimiter
-            fragment = self.delimiters[i].render(effective_indent)
+            fragment = delimiters[i].render(effective_indent)
             effective_indent += len(fragment)
-            parts.append(fragment)
+            writer.write(fragment)
 
-            # before stuff
-            fragment = self.before_stuff[i].render(effective_indent)
+            # before stuff (rendered on its own, since it's only preceded by a space if it isn't empty)
+            scratch = RenderWriter()
+            yield (before_stuff[i], scratch, effective_indent)
+            fragment = scratch.getvalue()
             fragment = (" " + fragment) if fragment else ""
             effective_indent += len(fragment)
-            parts.append(fragment)
+            writer.write(fragment)
 
             # open paren
-            parts.append("\n")
-            parts.append(" " * indent)
+            writer.write("\n")
+            writer.write(" " * indent)
             effective_indent = indent
-            parts.append("(")
-            parts.append("\n")
+            writer.write("(")
+            writer.write("\n")
 
             # subquery
-            parts.append(" " * (effective_indent+self.CTE_INDENT_SPACES))
-            parts.append(self.statements[i].render(effective_indent+self.CTE_INDENT_SPACES))
+            writer.write(" " * (effective_indent+self.CTE_INDENT_SPACES))
+            yield (statements[i], writer, effective_indent+self.CTE_INDENT_SPACES)
 
             # close paren
-            parts.append("\n")
-            parts.append(" " * indent)
+            writer.write("\n")
+            writer.write(" " * indent)
             effective_indent = indent
-            parts.append(")")
+            writer.write(")")
             effective_indent = effective_indent + 1
 
             # after stuff
-            fragment = self.after_stuff[i].render(effective_indent)
+            scratch = RenderWriter()
+            yield (after_stuff[i], scratch, effective_indent)
+            fragment = scratch.getvalue()
             fragment = (" " + fragment) if fragment else ""
-            parts.append(fragment)
+            writer.write(fragment)
 
             i += 1
 
-        out = "".join(parts)
-        out = out.rstrip("\n")
-        return out
+        writer.rstrip_newlines(mark)
 
 
-class BasicClause:
+class BasicClause(LazyNode):
     __slots__ = (
-        "input_tokens",
-        "delimiters",
-        "expressions",
+        "_delimiters",
+        "_expressions",
     )
+    PARSED = ("delimiters", "expressions")
+    delimiters = parsed_attribute("delimiters")
+    expressions = parsed_attribute("expressions")
     STARTING_DELIMITER = None
     OTHER_DELIMITERS = set()
     PADDING = 6
 
-    def __init__(self, tokens):
-        self._validate(tokens)
+    def __init__(self, tokens, start=0, end=None, delimiter_indexes=None):
+        if end is None:
+            end = len(tokens) if tokens is not None else 0
 
-        self.input_tokens = tokens
+        self._validate(tokens, start, end)
 
-        self.delimiters, self.expressions = self._parse(tokens)
+        super().__init__(tokens, start, end, delimiter_indexes)
 
 
-    def _validate(self, tokens):
-        if not tokens:
+    def _validate(self, tokens, start, end):
+        if start >= end:
             raise ValueError("tokens must be non-empty")
 
-        if tokens[0] != self.STARTING_DELIMITER:
+        if tokens[start] != self.STARTING_DELIMITER:
             raise ValueError(f"{self.__class__} must begin with \"{self.STARTING_DELIMITER.value}\" keyword")
 
         return True
 
 
-    def _parse(self, tokens):
-        i = 1 # we already know token 0 is the starting delimiter
-        delimiters = [tokens[0]]
-        expressions = []
-        paren_depth = 0
-        buffer = []
-        while i < len(tokens):
-            if paren_depth == 0 and tokens[i] in self.OTHER_DELIMITERS:
-                delimiters.append(tokens[i])
-                expressions.append(Expression(buffer))
-                buffer = []
-            else:
-                if tokens[i] == Symbols.LEFT_PAREN:
-                    paren_depth += 1
-                elif tokens[i] == Symbols.RIGHT_PAREN:
-                    #TODO: detect unbalanced parens
-                    paren_depth -= 1
-                buffer.append(tokens[i])
-            i += 1
-        # one final expression, empty in the weird/broken case where the final token was JOIN or etc
-        if len(buffer) > 0 or len(delimiters) > len(expressions):
-            expressions.append(Expression(buffer))
+    def _parse(self, tokens, start, end, delimiter_indexes):
+        if delimiter_indexes is None:
+            delimiter_indexes = split_clauses(tokens, start, end, self.__class__)[0][3]
+
+        # we already know the first token is the starting delimiter
+        delimiters = [tokens[start]] + [tokens[i] for i in delimiter_indexes]
+        expressions = split_expressions(tokens, start+1, end, delimiter_indexes)
 
         assert len(delimiters) == len(expressions)
 
         return (delimiters, expressions)
 
 
+    metrics = property(node_metrics)
+
+
+    def _metric_children(self):
+        return self.expressions
+
+
+    def _measure(self):
+        return measure_clause(self.delimiters, self.expressions)
+
+
     def _render_delimiter(self, delimiter):
         return delimiter.value.rjust(self.PADDING)
 
 
     def render(self, indent):
-        parts = []
+        return render_to_string(self, indent)
+
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+
+    def render_steps(self, writer, indent):
+        delimiters, expressions = self.delimiters, self.expressions
+        mark = writer.mark()
         i = 0
         effective_indent = indent
         suppress_newline = False
-        while i < len(self.delimiters):
+        while i < len(delimiters):
             if i > 0:
                 if not suppress_newline:
-                    parts.append("\n")
-                parts.append(" " * indent)
+                    writer.write("\n")
+                writer.write(" " * indent)
                 effective_indent = indent
             suppress_newline = False
 
-            delim_fragment = self._render_delimiter(self.delimiters[i])
+            delim_fragment = self._render_delimiter(delimiters[i])
             effective_indent += len(delim_fragment)
-            parts.append(delim_fragment)
+            writer.write(delim_fragment)
 
-            if not self.expressions[i].is_empty(): # don't render the expr at all if it's empty
+            if not expressions[i].is_empty(): # don't render the expr at all if it's empty
                 # always print one space after the delimiter
-                parts.append(" ")
+                writer.write(" ")
                 effective_indent += 1
 
-                expr_fragment = self.expressions[i].render(effective_indent)
-                parts.append(expr_fragment)
+                expr_mark = writer.mark()
+                yield (expressions[i], writer, effective_indent)
 
-                if expr_fragment.endswith("\n"): # happens when an Expression ends with a line comment
+                if writer.ends_with_newline(expr_mark): # happens when an Expression ends with a line comment
                     suppress_newline = True
 
             i += 1
 
-        out = "".join(parts)
-        out = out.rstrip("\n")
-        return out
+        writer.rstrip_newlines(mark)
 
 
-class SelectClause:
+class SelectClause(LazyNode):
     __slots__ = (
-        "input_tokens",
-        "delimiters",
-        "expressions",
-        "qualifier",
+        "_delimiters",
+        "_expressions",
+        "_qualifier",
     )
+    PARSED = ("delimiters", "expressions", "qualifier")
+    delimiters = parsed_attribute("delimiters")
+    expressions = parsed_attribute("expressions")
+    qualifier = parsed_attribute("qualifier")
     STARTING_DELIMITER = Keywords.SELECT
     OTHER_DELIMITERS = set([Symbols.COMMA])
     PADDING = 6
 
-    def __init__(self, tokens):
-        self._validate(tokens)
+    def __init__(self, tokens, start=0, end=None, delimiter_indexes=None):
+        if end is None:
+            end = len(tokens) if tokens is not None else 0
 
-        self.input_tokens = tokens
+        self._validate(tokens, start, end)
 
-        self.delimiters, self.expressions, self.qualifier = self._parse(tokens)
+        super().__init__(tokens, start, end, delimiter_indexes)
 
 
-    def _validate(self, tokens):
-        if not tokens:
+    def _validate(self, tokens, start, end):
+        if start >= end:
             raise ValueError("tokens must be non-empty")
 
-        if tokens[0] != Keywords.SELECT:
+        if tokens[start] != Keywords.SELECT:
             raise ValueError("SelectClause must begin with \"SELECT\" keyword")
 
         return True
 
 
-    def _parse(self, tokens):
-        i = 1
-        delimiters = [tokens[0]]
+    def _parse(self, tokens, start, end, delimiter_indexes):
+        if delimiter_indexes is None:
+            delimiter_indexes = split_clauses(tokens, start, end, self.__class__)[0][3]
+
+        i = start+1
+        delimiters = [tokens[start]]
 
         # check for ALL, DISTINCT, DISTINCT ON(...)
         qualifier = None
-        tok, pos = next_real_token_and_position(tokens[i:])
+        while i < end and tokens[i].is_whitespace:
+            i += 1
+        tok = tokens[i] if i < end else None
         if tok in (Keywords.DISTINCT, Keywords.ALL):
             qualifier = tok
-            i += pos+1
+            i += 1
         elif tok == Keywords.DISTINCT_ON:
-            i += pos+1
-            while i < len(tokens):
-                if tokens[i].is_whitespace:
-                    i += 1
-                elif tokens[i] == Symbols.LEFT_PAREN:
-                    on_clause_tokens = get_paren_block(tokens[i:])
-                    if on_clause_tokens is None:
+            i += 1
+            while i < end and tokens[i].is_whitespace:
+                i += 1
+            if i < end:
+                if tokens[i] == Symbols.LEFT_PAREN:
+                    right_paren_index = find_matching_paren(tokens, i, end)
+                    if right_paren_index is None:
                         raise Exception("broken DISTINCT ON(): unbalanced parens")
                     else:
+                        on_clause_tokens = list(tokens[i:right_paren_index+1])
                         qualifier = Expression([Keywords.DISTINCT_ON]+on_clause_tokens)
-                        i += len(on_clause_tokens)
-                        break
+                        i = right_paren_index+1
                 else:
                     raise Exception(f"broken DISTINCT ON(): expected ( found {tokens[i]}")
+        else:
+            # no qualifier, so the whitespace belongs to the first expression
+            i = start+1
 
-        # parse the remaining tokens into expressions
-        expressions = []
-        paren_depth = 0
-        buffer = []
-        while i < len(tokens):
-            if paren_depth == 0 and tokens[i] in self.OTHER_DELIMITERS:
-                delimiters.append(tokens[i])
-                expressions.append(Expression(buffer))
-                buffer = []
-            else:
-                if tokens[i] == Symbols.LEFT_PAREN:
-                    paren_depth += 1
-                elif tokens[i] == Symbols.RIGHT_PAREN:
-                    #TODO: detect unbalanced parens
-                    paren_depth -= 1
-                buffer.append(tokens[i])
-            i += 1
-        # one final expression, empty in the weird/broken case where the final token was JOIN or etc
-        if len(buffer) > 0 or len(delimiters) > len(expressions):
-            expressions.append(Expression(buffer))
+        # split the remaining tokens into expressions (any commas in the qualifier are inside its parens)
+        delimiters += [tokens[d] for d in delimiter_indexes]
+        expressions = split_expressions(tokens, i, end, delimiter_indexes)
 
         assert len(delimiters) == len(expressions), f"{len(delimiters)} delimiters : {len(expressions)} expressions"
 
         return (delimiters, expressions, qualifier)
 
 
+    metrics = property(node_metrics)
+
+
+    def _metric_children(self):
+        if isinstance(self.qualifier, Expression):
+            return self.expressions + [self.qualifier]
+        return self.expressions
+
+
+    def _measure(self):
+        delimiters, expressions, qualifier = self.delimiters, self.expressions, self.qualifier
+        metrics = measure_clause(delimiters, expressions)
+        if qualifier:
+            q = token_metrics(qualifier) if type(qualifier) is CFToken else qualifier._metrics
+            metrics.width += 1 + q.width
+            metrics.lines += q.lines - 1
+            metrics.has_comment = metrics.has_comment or q.has_comment
+            metrics.depth = max(metrics.depth, q.depth)
+            # the first expression goes on a line of its own, unless it already starts with one (see render_steps())
+            first_indent = len(self._render_delimiter(delimiters[0])) + 1
+            if not expressions[0].is_empty() and not expressions[0]._starts_with_line_break(first_indent):
+                metrics.lines += 1
+        return metrics
+
+
     def _render_delimiter(self, delimiter):
         return delimiter.value.rjust(self.PADDING)
 
     def render(self, indent):
-        parts = []
+        return render_to_string(self, indent)
+
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+
+    def render_steps(self, writer, indent):
+        delimiters, expressions, qualifier = self.delimiters, self.expressions, self.qualifier
+        mark = writer.mark()
         i = 0
         effective_indent = indent
         suppress_newline = False
-        while i < len(self.delimiters):
+        while i < len(delimiters):
             if i > 0:
                 if not suppress_newline:
-                    parts.append("\n")
-                parts.append(" " * indent)
+                    writer.write("\n")
+                writer.write(" " * indent)
                 effective_indent = indent
             suppress_newline = False
 
-            delim_fragment = self._render_delimiter(self.delimiters[i])
+            delim_fragment = self._render_delimiter(delimiters[i])
             effective_indent += len(delim_fragment)
-            parts.append(delim_fragment)
+            writer.write(delim_fragment)
 
-            if i == 0 and self.qualifier:
-                parts.append(" ")
-                parts.append(self.qualifier.render(indent))
-                if not self.expressions[0].is_empty():
-                    parts.append("\n")
-                    parts.append(" " * effective_indent)
+            if i == 0 and qualifier:
+                writer.write(" ")
+                yield (qualifier, writer, indent)
+                if not expressions[0].is_empty():
+                    writer.write("\n")
+                    writer.write(" " * effective_indent)
 
-            if not self.expressions[i].is_empty(): # don't render the expr at all if it's empty
+            if not expressions[i].is_empty(): # don't render the expr at all if it's empty
                 # always print one space after the delimiter
-                parts.append(" ")
+                writer.write(" ")
                 effective_indent += 1
 
-                expr_fragment = self.expressions[i].render(effective_indent)
-                if i == 0 and self.qualifier:
+                expr_mark = writer.mark()
+                if i == 0 and qualifier:
                     # when there's a qualifier, we add a newline and indentation (see above), but if the input was already
                     # formatted correctly, then that's redundant and we need to back it out
-                    expr_fragment = expr_fragment.removeprefix("\n" + " " * effective_indent)
-                parts.append(expr_fragment)
+                    scratch = RenderWriter()
+                    yield (expressions[i], scratch, effective_indent)
+                    writer.write(scratch.getvalue().removeprefix("\n" + " " * effective_indent))
+                else:
+                    yield (expressions[i], writer, effective_indent)
 
-                if expr_fragment.endswith("\n"): # happens when an Expression ends with a line comment
+                if writer.ends_with_newline(expr_mark): # happens when an Expression ends with a line comment
                     suppress_newline = True
 
             i += 1
 
-        out = "".join(parts)
-        out = out.rstrip("\n")
-        return out
+        writer.rstrip_newlines(mark)
 
 
 class FromClause(BasicClause):
@@ -742,52 +1357,6 @@ class WhereClause(BasicClause):
     ])
     PADDING = 6
 
-    # this is pasted from BasicClause! keep them in sync! (or figure out how to merge them)
-    def _parse(self, tokens):
-        i = 1 # we already know token 0 is the starting delimiter
-        delimiters = [tokens[0]]
-        expressions = []
-        paren_depth = 0
-        between_depth = 0
-        case_depth = 0
-        buffer = []
-        while i < len(tokens):
-            if (
-                paren_depth == 0
-                and tokens[i] in self.OTHER_DELIMITERS
-                # if we're inside BETWEEN or CASE, don't treat AND/OR as delimiters
-                and (
-                    tokens[i] not in (Keywords.AND, Keywords.OR)
-                    or (between_depth == 0 and case_depth == 0)
-                )
-            ):
-                delimiters.append(tokens[i])
-                expressions.append(Expression(buffer))
-                buffer = []
-            else:
-                if tokens[i] == Symbols.LEFT_PAREN:
-                    paren_depth += 1
-                elif tokens[i] == Symbols.RIGHT_PAREN:
-                    #TODO: detect unbalanced parens
-                    paren_depth -= 1
-                elif tokens[i] == Keywords.BETWEEN:
-                    between_depth += 1
-                elif tokens[i] == Keywords.AND and between_depth > 0:
-                    between_depth -= 1
-                elif tokens[i] == Keywords.CASE:
-                    case_depth += 1
-                elif tokens[i] == Keywords.END:
-                    case_depth -= 1
-                buffer.append(tokens[i])
-            i += 1
-        # one final expression, empty in the weird/broken case where the final token was JOIN or etc
-        if len(buffer) > 0 or len(delimiters) > len(expressions):
-            expressions.append(Expression(buffer))
-
-        assert len(delimiters) == len(expressions)
-
-        return (delimiters, expressions)
-
 
 class GroupByClause(BasicClause):
     STARTING_DELIMITER = Keywords.GROUP_BY
@@ -810,43 +1379,50 @@ class OrderByClause(BasicClause):
     PADDING = 9
 
 
-class LimitOffsetClause:
+class LimitOffsetClause(LazyNode):
     __slots__ = (
-        "input_tokens",
-        "limit_expression",
-        "offset_expression",
-        "limit_first",
+        "_limit_expression",
+        "_offset_expression",
+        "_limit_first",
     )
+    PARSED = ("limit_expression", "offset_expression", "limit_first")
+    limit_expression = parsed_attribute("limit_expression")
+    offset_expression = parsed_attribute("offset_expression")
+    limit_first = parsed_attribute("limit_first")
+    OTHER_DELIMITERS = set()
 
-    def __init__(self, tokens):
-        self._validate(tokens)
+    def __init__(self, tokens, start=0, end=None, delimiter_indexes=None):
+        if end is None:
+            end = len(tokens) if tokens is not None else 0
 
-        self.input_tokens = tokens
+        self._validate(tokens, start, end)
 
-        self.limit_expression, self.offset_expression, self.limit_first = self._parse(tokens)
+        super().__init__(tokens, start, end)
 
 
-    def _validate(self, tokens):
-        if not tokens:
+    def _validate(self, tokens, start, end):
+        if start >= end:
             raise ValueError("tokens must be non-empty")
 
-        if tokens[0] not in (Keywords.LIMIT, Keywords.OFFSET):
+        if tokens[start] not in (Keywords.LIMIT, Keywords.OFFSET):
             raise ValueError("LimitOffsetClause must begin with \"LIMIT\" or \"OFFSET\" keyword")
 
         return True
 
 
-    def _parse(self, tokens):
+    def _parse(self, tokens, start, end):
+        # LIMIT and OFFSET may each appear more than once, so these are gathered into lists rather than being spans
+        # (they're only ever a handful of tokens anyway)
         limit_buffer = []
         offset_buffer = []
 
-        if tokens[0] == Keywords.LIMIT:
+        if tokens[start] == Keywords.LIMIT:
             limit_first = True
         else:
             limit_first = False
 
-        i = 0
-        while i < len(tokens):
+        i = start
+        while i < end:
             if tokens[i] == Keywords.LIMIT:
                 target_buffer = limit_buffer
             elif tokens[i] == Keywords.OFFSET:
@@ -860,40 +1436,91 @@ class LimitOffsetClause:
         return limit_expression, offset_expression, limit_first
 
 
+    metrics = property(node_metrics)
+
+
+    def _metric_children(self):
+        return [self.limit_expression, self.offset_expression]
+
+
+    def _measure(self):
+        if self.limit_first:
+            first, second = self.limit_expression._metrics, self.offset_expression._metrics
+        else:
+            first, second = self.offset_expression._metrics, self.limit_expression._metrics
+        if second.width == 0:
+            return NodeMetrics(first.width, first.lines, first.has_comment, first.depth)
+        return NodeMetrics(
+            first.width + 1 + second.width,
+            first.lines + second.lines,
+            first.has_comment or second.has_comment,
+            max(first.depth, second.depth),
+        )
+
+
     def render(self, indent):
-        parts = []
+        return render_to_string(self, indent)
+
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+
+    def render_steps(self, writer, indent):
+        mark = writer.mark()
 
         if self.limit_first:
-            parts.append(" " * indent)
-            parts.append(" ")
-            parts.append(self.limit_expression.render(indent))
+            writer.write(" " * indent)
+            writer.write(" ")
+            yield (self.limit_expression, writer, indent)
             if not self.offset_expression.is_empty():
-                parts.append("\n")
-                parts.append(self.offset_expression.render(indent))
+                writer.write("\n")
+                yield (self.offset_expression, writer, indent)
         else:
-            parts.append(self.offset_expression.render(indent))
+            yield (self.offset_expression, writer, indent)
             if not self.limit_expression.is_empty():
-                parts.append("\n")
-                parts.append(" " * indent)
-                parts.append(" ")
-                parts.append(self.limit_expression.render(indent))
+                writer.write("\n")
+                writer.write(" " * indent)
+                writer.write(" ")
+                yield (self.limit_expression, writer, indent)
 
-        out = "".join(parts)
-        out = out.rstrip("\n")
-        return out
+        writer.rstrip_newlines(mark)
 
 
 class JunkClause:
     __slots__ = (
-        "input_tokens",
+        "tokens",
+        "start",
+        "end",
+        "_metrics", # see node_metrics()
     )
-    def __init__(self, tokens):
-        self.input_tokens = tokens
+    OTHER_DELIMITERS = set()
+
+    def __init__(self, tokens, start=0, end=None, delimiter_indexes=None):
+        self.tokens = tokens
+        self.start = start
+        self.end = len(tokens) if end is None else end
+        self._metrics = None
+
+    metrics = property(node_metrics)
+
+    def _metric_children(self):
+        return subtree_elements(self.tokens, self.start, self.end)
+
+    def _measure(self):
+        return measure_span(self.tokens, self.start, self.end)
 
     def render(self, indent):
-        out = "".join([t.render(indent) for t in self.input_tokens])
-        out = out.rstrip("\n")
-        return out
+        return render_to_string(self, indent)
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+    def render_steps(self, writer, indent):
+        mark = writer.mark()
+        for i in range(self.start, self.end):
+            yield (self.tokens[i], writer, indent)
+        writer.rstrip_newlines(mark)
 
 
 class ClauseScope(enum.IntEnum):
@@ -938,84 +1565,239 @@ SCOPE_CLAUSE_MAP = {
 }
 
 
+# the same tables, by keyword ID (see cftoken.KEYWORD_IDS), for split_clauses()
+SCOPE_BY_KEYWORD_ID = [None] * (len(KEYWORD_IDS) + 1)
+for _keyword, _scope in KEYWORD_SCOPE_MAP.items():
+    SCOPE_BY_KEYWORD_ID[_keyword.keyword_id] = _scope
+del _keyword, _scope
+
+DELIMITER_MASKS = {clause_class: keyword_mask(clause_class.OTHER_DELIMITERS) for clause_class in SCOPE_CLAUSE_MAP.values()}
+
+# every token other than a delimiter that split_clauses() has to look at
+SPLIT_MASK = keyword_mask(list(KEYWORD_SCOPE_MAP) + [
+    Symbols.LEFT_PAREN,
+    Symbols.RIGHT_PAREN,
+    Keywords.BETWEEN,
+    Keywords.AND,
+    Keywords.CASE,
+    Keywords.END,
+])
+AND_OR_MASK = keyword_mask([Keywords.AND, Keywords.OR])
+
+
+def split_clauses(elements, start, end, clause_class=None):
+    """
+    The one pass over a statement's elements: finds where each clause starts, and where each clause's delimiters
+    (its class's OTHER_DELIMITERS) are, so that clauses don't have to scan their elements again. Returns a list of
+    (scope, start, end, delimiter indexes), one per clause.
+
+    Given a clause_class, elements[start:end] is taken to be one clause of that class, and its scope is None.
+
+    Delimiters only count outside parens, and AND/OR don't count inside BETWEEN ... AND or CASE ... END.
+    """
+    clauses = []
+    if clause_class is None:
+        scope = ClauseScope.INITIAL
+        clause_class = JunkClause
+        find_scopes = True
+        i = start
+    else:
+        scope = None
+        find_scopes = False
+        i = start+1 # we already know the first token is the starting delimiter
+    delimiter_mask = DELIMITER_MASKS.get(clause_class)
+    if delimiter_mask is None:
+        delimiter_mask = keyword_mask(clause_class.OTHER_DELIMITERS)
+    delimiter_indexes = []
+    clause_start = start
+
+    left_paren = SymbolIds.LEFT_PAREN
+    right_paren = SymbolIds.RIGHT_PAREN
+    between = KeywordIds.BETWEEN
+    and_ = KeywordIds.AND
+    case = KeywordIds.CASE
+    end_ = KeywordIds.END
+
+    interesting_mask = SPLIT_MASK | delimiter_mask
+    paren_depth = 0
+    between_depth = 0
+    case_depth = 0
+    while i < end:
+        keyword_id = elements[i].keyword_id
+
+        if not interesting_mask >> keyword_id & 1:
+            # the common case: nothing to do
+            i += 1
+            continue
+
+        if keyword_id == left_paren:
+            paren_depth += 1
+        elif keyword_id == right_paren:
+            #TODO: detect unbalanced parens
+            paren_depth -= 1
+        elif paren_depth == 0 and find_scopes and SCOPE_BY_KEYWORD_ID[keyword_id] is not None:
+            # ONLY probe for a scope change if we are outside any misc parens (function calls etc)
+            potential_new_scope = SCOPE_BY_KEYWORD_ID[keyword_id]
+            if potential_new_scope == scope and scope == ClauseScope.LIMIT_OFFSET:
+                # LIMIT/OFFSET is a weird clause because OFFSET/LIMIT is also valid, so any time
+                # both keywords are used, we'll hit this case. It's normal.
+                pass
+            elif potential_new_scope <= scope:
+                raise ValueError(f"unexpected token {elements[i]} in scope {scope.name}")
+            else:
+                if i > clause_start:
+                    clauses.append((scope, clause_start, i, delimiter_indexes))
+
+                scope = potential_new_scope
+                clause_start = i
+                delimiter_mask = DELIMITER_MASKS[SCOPE_CLAUSE_MAP[scope]]
+                interesting_mask = SPLIT_MASK | delimiter_mask
+                delimiter_indexes = []
+                between_depth = 0
+                case_depth = 0
+        elif (
+            paren_depth == 0
+            and delimiter_mask >> keyword_id & 1
+            # if we're inside BETWEEN or CASE, don't treat AND/OR as delimiters
+            and (
+                not AND_OR_MASK >> keyword_id & 1
+                or (between_depth == 0 and case_depth == 0)
+            )
+        ):
+            delimiter_indexes.append(i)
+        elif keyword_id == between:
+            between_depth += 1
+        elif keyword_id == and_ and between_depth > 0:
+            between_depth -= 1
+        elif keyword_id == case:
+            case_depth += 1
+        elif keyword_id == end_:
+            case_depth -= 1
+
+        i += 1
+
+    # last clause
+    clauses.append((scope, clause_start, end, delimiter_indexes))
+
+    return clauses
+
+
+def split_expressions(tokens, start, end, delimiter_indexes):
+    # the expressions between the delimiters in tokens[start:end], the last one empty in the weird/broken case where
+    # the final token was JOIN or etc
+    expressions = []
+    for i in delimiter_indexes:
+        expressions.append(Expression(tokens, start, i))
+        start = i+1
+    expressions.append(Expression(tokens, start, end))
+    return expressions
+
+
+def parse_expression(tokens):
+    """
+    An Expression of a whole list of tokens, with each subquery and list of literals in it made a single element, as
+    in a statement (see Statement._get_elements()).
+    """
+    return Expression(Statement._get_elements(tokens, 0, len(tokens), TokenIndex(tokens)))
+
+
 class Statement:
     __slots__ = (
-        "input_tokens",
         "clause_map", # map of ClauseScope -> clause object
+        "_metrics", # see node_metrics()
     )
+    keyword_id = 0 # like a token that isn't a keyword, for when a statement is among tokens
 
-    def __init__(self, tokens):
-        self.input_tokens = tokens
+    def __init__(self, tokens, start=0, end=None, token_index=None):
+        if end is None:
+            end = len(tokens)
 
-        self.clause_map = self._parse(tokens)
+        if token_index is None:
+            token_index = TokenIndex(tokens)
 
+        # only splits this statement into clauses, which (like its subqueries) aren't parsed until they're needed
+        self.clause_map = self._parse(self._get_elements(tokens, start, end, token_index))
+        self._metrics = None
 
-    def _parse(self, tokens):
-        clause_map = {}
 
-        current_scope = ClauseScope.INITIAL
-        paren_depth = 0
-        i = 0
-        buffer = []
-        while i < len(tokens):
+    @staticmethod
+    def _get_elements(tokens, start, end, token_index):
+        # the tokens of this statement, with each subquery replaced by a single (unparsed) CompoundStatement
+        elements = []
+        i = start
+        while i < end:
             tok = tokens[i]
 
             # subqueries are not valid in all scopes but we'll punt on that for now
-            if tok == Symbols.LEFT_PAREN and next_real_token(tokens[i+1:]) in [Keywords.SELECT, Keywords.WITH]:
-                subquery_tokens = get_paren_block(tokens[i:])
-                if subquery_tokens is None:
+            if tok.keyword_id == SymbolIds.LEFT_PAREN and starts_subquery(tokens, token_index, i, end):
+                right_paren_index = subquery_right_paren(token_index, i, end)
+                if right_paren_index is None:
                     # unbalanced parens
                     pass
                 else:
-                    buffer.append(Symbols.LEFT_PAREN)
-                    buffer.append(CompoundStatement(subquery_tokens[1:-1]))
-                    buffer.append(Symbols.RIGHT_PAREN)
-                    i += len(subquery_tokens)
+                    elements.append(Symbols.LEFT_PAREN)
+                    elements.append(CompoundStatement(tokens, i+1, right_paren_index, token_index))
+                    elements.append(Symbols.RIGHT_PAREN)
+                    i = right_paren_index+1
                     continue
 
-            if tok == Symbols.LEFT_PAREN:
-                buffer.append(tok)
-                paren_depth += 1
-            elif tok == Symbols.RIGHT_PAREN:
-                buffer.append(tok)
-                paren_depth -= 1
-            elif paren_depth == 0:
-                # ONLY probe for a scope change if we are outside any misc parens (function calls etc)
-                potential_new_scope = KEYWORD_SCOPE_MAP.get(tok, None)
-                if potential_new_scope:
-                    if potential_new_scope == current_scope and current_scope == ClauseScope.LIMIT_OFFSET:
-                        # LIMIT/OFFSET is a weird clause because OFFSET/LIMIT is also valid, so any time
-                        # both keywords are used, we'll hit this case. It's normal.
-                        buffer.append(tok)
-                    elif potential_new_scope <= current_scope:
-                        raise ValueError(f"unexpected token {tok} in scope {current_scope.name}")
-                    else:
-                        if len(buffer) > 0:
-                            clause_class = SCOPE_CLAUSE_MAP[current_scope]
-                            clause_map[current_scope] = clause_class(buffer)
-
-                        current_scope = potential_new_scope
-                        buffer = [tok]
-                else:
-                    buffer.append(tok)
-            else:
-                buffer.append(tok)
+            # and so is the inside of each list of literals, e.g. `in (1, 2, ...)`
+            if tok.keyword_id == SymbolIds.LEFT_PAREN:
+                right_paren_index = literal_list_end(tokens, i, end)
+                if right_paren_index is not None:
+                    elements.append(tok)
+                    elements.append(LiteralList(tokens, i+1, right_paren_index))
+                    elements.append(tokens[right_paren_index])
+                    i = right_paren_index+1
+                    continue
 
+            elements.append(tok)
             i += 1
 
-        # last clause
-        clause_class = SCOPE_CLAUSE_MAP[current_scope]
-        clause_map[current_scope] = clause_class(buffer)
+        return elements
+
+
+    def _parse(self, elements):
+        clause_map = {}
+        for scope, start, end, delimiter_indexes in split_clauses(elements, 0, len(elements)):
+            clause_class = SCOPE_CLAUSE_MAP[scope]
+            clause_map[scope] = clause_class(elements, start, end, delimiter_indexes)
 
         return clause_map
 
 
+    metrics = property(node_metrics)
+
+
+    def _metric_children(self):
+        return list(self.clause_map.values())
+
+
+    def _measure(self):
+        # one clause after another, each starting on a new line
+        clauses = [c._metrics for c in self.clause_map.values()]
+        return NodeMetrics(
+            sum(m.width for m in clauses) + len(clauses) - 1,
+            sum(m.lines for m in clauses),
+            any(m.has_comment for m in clauses),
+            max(m.depth for m in clauses),
+        )
+
+
     @property
     def is_whitespace(self):
         return False
 
 
     def render(self, indent):
+        return render_to_string(self, indent)
+
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+
+    def render_steps(self, writer, indent):
         # the ClauseScope keys are numbered in order so sorted() does exactly what we want
         clauses_in_order = sorted(self.clause_map.items())
 
@@ -1024,16 +1806,22 @@ class Statement:
         # as a whole match the behavior of clauses.
         clause_joiner = "\n" + (" " * indent)
 
-        out = clause_joiner.join([v.render(indent) for k,v in clauses_in_order])
-        return out
+        for i, (k, v) in enumerate(clauses_in_order):
+            if i > 0:
+                writer.write(clause_joiner)
+            yield (v, writer, indent)
 
 
-class CompoundStatement:
+class CompoundStatement(LazyNode):
     __slots__ = (
-        "input_tokens",
-        "statements",
-        "set_operations",
+        "_statements",
+        "_set_operations",
+        "_span", # (tokens, start, end), for cache_key()
     )
+    keyword_id = 0 # like a token that isn't a keyword, for when a subquery is among tokens
+    PARSED = ("statements", "set_operations")
+    statements = parsed_attribute("statements")
+    set_operations = parsed_attribute("set_operations")
     SET_OP_KEYWORDS = set([
         # Postgres allows ALL and DISTINCT to be appended to any set operation...
         Keywords.UNION,
@@ -1047,44 +1835,56 @@ class CompoundStatement:
         Keywords.EXCEPT_DISTINCT,
         Keywords.MINUS, # ...but Oracle doesn't
     ])
+    SET_OP_MASK = keyword_mask(SET_OP_KEYWORDS)
 
-    def __init__(self, tokens):
-        self.input_tokens = tokens
+    def __init__(self, tokens, start=0, end=None, token_index=None):
+        if end is None:
+            end = len(tokens)
+
+        super().__init__(tokens, start, end, token_index)
+        self._span = (tokens, start, end)
+
+
+    def cache_key(self, cache):
+        tokens, start, end = self._span
+        return (CompoundStatement, cache.span_hash(tokens, start, end), end - start)
 
-        self.statements, self.set_operations = self._parse(tokens)
 
+    def _parse(self, tokens, start, end, token_index):
+        if token_index is None:
+            token_index = TokenIndex(tokens)
 
-    def _parse(self, tokens):
         statements = []
         set_operations = []
         buffer = []
         seeking_statement_start = True
-        i = 0
-        while i < len(tokens):
+        i = start
+        while i < end:
             tok = tokens[i]
             # TODO: "(statement) set_op (statement)" is allowed so some paren-awareness is needed
             if seeking_statement_start is True and tok.is_whitespace:
                 # drop any whitespace that precedes SELECT/WITH
                 pass
-            elif tok == Symbols.LEFT_PAREN and next_real_token(tokens[i+1:]) in [Keywords.SELECT, Keywords.WITH]:
-                subquery_tokens = get_paren_block(tokens[i:])
-                if subquery_tokens is None:
+            elif tok.keyword_id == SymbolIds.LEFT_PAREN and starts_subquery(tokens, token_index, i, end):
+                right_paren_index = subquery_right_paren(token_index, i, end)
+                if right_paren_index is None:
                     # unbalanced parens
                     pass
                 else:
+                    # a subquery is just a span of the same tokens, and isn't parsed until it's needed
                     buffer.append(Symbols.LEFT_PAREN)
-                    buffer.append(CompoundStatement(subquery_tokens[1:-1]))
+                    buffer.append(CompoundStatement(tokens, i+1, right_paren_index, token_index))
                     buffer.append(Symbols.RIGHT_PAREN)
-                    i += len(subquery_tokens)
+                    i = right_paren_index+1
                     continue
-            elif tok in self.SET_OP_KEYWORDS:
+            elif self.SET_OP_MASK >> tok.keyword_id & 1:
                 statements.append(Statement(buffer))
                 set_operations.append(tok)
                 buffer = []
                 seeking_statement_start = True
             else:
                 buffer.append(tok)
-                if tok in (Keywords.SELECT, Keywords.WITH):
+                if STATEMENT_START_MASK >> tok.keyword_id & 1:
                     seeking_statement_start = False
 
             i += 1
@@ -1099,12 +1899,40 @@ class CompoundStatement:
         return (statements, set_operations)
 
 
+    metrics = property(node_metrics)
+
+
+    def _metric_children(self):
+        return self.statements
+
+
+    def _measure(self):
+        # statements and set operations, each starting on a new line
+        statements = [s._metrics for s in self.statements]
+        set_operations = [token_metrics(t) for t in self.set_operations]
+        parts = statements + set_operations
+        return NodeMetrics(
+            sum(m.width for m in parts) + len(parts) - 1,
+            sum(m.lines for m in parts),
+            any(m.has_comment for m in parts),
+            1 + max(m.depth for m in statements),
+        )
+
+
     @property
     def is_whitespace(self):
         return False
 
 
     def render(self, indent):
+        return render_to_string(self, indent)
+
+
+    def render_into(self, writer, indent):
+        run_render_steps(self, writer, indent)
+
+
+    def render_steps(self, writer, indent):
         parts = [self.statements[0]]
         i = 0
         while i < len(self.set_operations):
@@ -1114,5 +1942,7 @@ class CompoundStatement:
 
         stmt_joiner = "\n" + (" " * indent)
 
-        out = stmt_joiner.join([p.render(indent) for p in parts])
-        return out
+        for i, p in enumerate(parts):
+            if i > 0:
+                writer.write(stmt_joiner)
+            yield (p, writer, indent)
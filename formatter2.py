@@ -1,29 +1,22 @@
+import os
 import sys
+import mmap
 import argparse
+import contextlib
 
 import cf_flags
+import cfinsert
 import cflexer
-from retokenize import pre_process_tokens, initial_lex, retokenize1, retokenize2, cftokenize
+import retokenize
+from cfwriter import RenderCache, RenderWriter
 from clause_formatter import CompoundStatement
 
 
-def trim_trailing_whitespace_from_lines(input_string):
-    lines = input_string.split("\n")
-    trimmed_lines = [l.rstrip() for l in lines]
-    reassembled_string = "\n".join(trimmed_lines)
-    return reassembled_string
-
-
 def get_renderable(unformatted_code, lexer_impl):
-    if lexer_impl == "pygments":        
-        initial_tokens = initial_lex(unformatted_code)
-        pre_processed_tokens = pre_process_tokens(initial_tokens)
-        tokens_after_first_pass = retokenize1(pre_processed_tokens)
-        tokens_after_second_pass = retokenize2(tokens_after_first_pass)
-        final_tokens = cftokenize(tokens_after_second_pass)
+    if lexer_impl == "pygments":
+        final_tokens = list(retokenize.iter_cftokens(unformatted_code))
     elif lexer_impl == "cflexer":
-        tokens = cflexer.lex(unformatted_code)
-        final_tokens = cflexer.collapse_identifiers(tokens)
+        final_tokens = cflexer.tokenize(unformatted_code)
     else:
         raise ValueError(f"unknown lexer_impl {lexer_impl}")
 
@@ -32,11 +25,73 @@ def get_renderable(unformatted_code, lexer_impl):
     return compound_statement
 
 
+def get_renderable_from_buffer(buffer):
+    # buffer is UTF-8 bytes or bytes-like, e.g. an mmap, and is only decoded a token at a time
+    tokens = cflexer.TokenArray.tokenize(buffer)
+    compound_statement = CompoundStatement(tokens)
+    return compound_statement
+
+
+@contextlib.contextmanager
+def map_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # can't mmap an empty file
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+
+def new_render_cache():
+    # with a maximum width, whether text fits depends on where it starts, so it can only be reused at the same indent
+    return RenderCache(single_lines_at_any_indent=cf_flags.MAX_WIDTH is None)
+
+
+def render_and_trim(renderable, stream=None, cache=None):
+    # with a stream, the output is written straight to it and nothing is returned
+    # identical subtrees are only rendered once or twice, see RenderCache; pass one in to see its stats() afterwards
+    if cache is None:
+        cache = new_render_cache()
+    writer = RenderWriter(stream, strip_trailing_whitespace=True, cache=cache)
+    renderable.render_into(writer, indent=0)
+    if stream is None:
+        return writer.getvalue()
+    writer.finish()
+
+
+def render_statements_and_trim(tokens, stream=None, cache=None):
+    # like render_and_trim(), for an iterable of tokens, whose INSERT ... VALUES statements are rendered as they're
+    # read, a row at a time (see cfinsert)
+    if cache is None:
+        cache = new_render_cache()
+    writer = RenderWriter(stream, strip_trailing_whitespace=True, cache=cache)
+    cfinsert.render_statements(tokens, writer)
+    if stream is None:
+        return writer.getvalue()
+    writer.finish()
+
+
 def do_format(unformatted_code):
-    renderable = get_renderable(unformatted_code, "cflexer")
-    rendered = renderable.render(indent=0)
-    trimmed = trim_trailing_whitespace_from_lines(rendered)
-    return trimmed
+    return render_statements_and_trim(cflexer.tokenize(unformatted_code))
+
+
+def do_format_stream(fileobj, output_stream=None, cache=None):
+    # lexing is lazy, and only anything that isn't INSERT ... VALUES has to be parsed as a whole
+    return render_statements_and_trim(cflexer.iter_tokenize(fileobj), output_stream, cache)
+
+
+def do_format_file(path, output_stream=None, cache=None):
+    # the tokens point into the mapped file, so everything has to happen before it's unmapped
+    with map_file(path) as buffer:
+        try:
+            if cfinsert.starts_with_insert(cflexer.iter_tokenize_buffer(buffer)):
+                return render_statements_and_trim(cflexer.iter_tokenize_buffer(buffer), output_stream, cache)
+            renderable = get_renderable_from_buffer(buffer)
+            return render_and_trim(renderable, output_stream, cache)
+        except cflexer.SourceError as e:
+            line, column = cflexer.byte_location(buffer, e.offset)
+            raise cflexer.SourceError(f"{path}:{line}:{column}: {e}", e.offset) from None
 
 
 def main(args):
@@ -53,14 +108,28 @@ def main(args):
     else:
         cf_flags.LOWER_CASE = False
 
-    # read
-    unformatted_code = sys.stdin.read()
-
-    # process
-    formatted_code = do_format(unformatted_code)
+    if args.dialect:
+        cf_flags.DIALECT = cf_flags.Dialect[args.dialect.upper()]
+    else:
+        cf_flags.DIALECT = cf_flags.Dialect.GENERIC
+
+    cf_flags.MAX_WIDTH = args.max_width
+    cf_flags.FILL_LITERAL_LISTS = args.fill_literal_lists
+
+    # read, process & write
+    cache = new_render_cache()
+    if args.path:
+        try:
+            do_format_file(args.path, sys.stdout, cache)
+        except cflexer.SourceError as e:
+            print(e, file=sys.stderr)
+            return 1
+    else:
+        do_format_stream(sys.stdin, sys.stdout, cache)
+    print()
 
-    # write
-    print(formatted_code)
+    if args.cache_stats:
+        print("render cache: " + ", ".join(f"{k} {v}" for k, v in cache.stats().items()), file=sys.stderr)
 
     return 0
 
@@ -73,7 +142,18 @@ if __name__ == "__main__":
     mx_group.add_argument("--compact-expressions", action="store_true", help="Remove most internal space from expressions (strictly more aggressive than --trim-leading-whitespace)")
 
     parser.add_argument("--lower-case", action="store_true", help="Lower-case everything that's not a literal")
+    parser.add_argument(
+        "--dialect",
+        choices=[d.name.lower() for d in cf_flags.Dialect if d != cf_flags.Dialect.GENERIC],
+        help="Lex according to this SQL dialect's quoting, comment and operator rules (default: a bit of everything)",
+    )
+    parser.add_argument("--max-width", type=int, metavar="N", help="Break expressions that would run past N columns (those without line breaks or comments), and line them up")
+    parser.add_argument("--fill-literal-lists", action="store_true", help="With --max-width, break lists of literals (e.g. IN lists) only where the next value doesn't fit, rather than at every comma")
+    parser.add_argument("--cache-stats", action="store_true", help="Report how often repeated subtrees were rendered from cache, on stderr")
+    parser.add_argument("path", nargs="?", help="Format this (UTF-8) file rather than stdin")
 
     args = parser.parse_args()
+    if args.max_width is not None and args.max_width < 1:
+        parser.error("--max-width must be at least 1")
 
     sys.exit(main(args))
@@ -0,0 +1,99 @@
+import benchmark
+import cf_flags
+import cflexer
+from clause_formatter import CompoundStatement
+from formatter2 import render_and_trim
+
+
+# Times rendering of single expressions with thousands of terms, with and without --max-width, at a few sizes each
+# double the last, and reports it as JSON. Layout is linear, so the time per term should stay about the same.
+
+DEFAULT_TERMS = 1000
+DEFAULT_DOUBLINGS = 3
+DEFAULT_MAX_WIDTH = 80
+
+
+### INPUTS
+
+def on_predicates(n):
+    # join u on t.c0 = u.c0 and t.c1 = u.c1 and ...
+    predicates = " and ".join([f"t.c{i} = u.c{i}" for i in range(n)])
+    return f"select a\n  from t\n  join u on {predicates}"
+
+
+def function_arguments(n):
+    # coalesce(c0, c1, ...)
+    arguments = ", ".join([f"c{i}" for i in range(n)])
+    return f"select coalesce({arguments}) as c\n  from t"
+
+
+def window_spec(n):
+    # lead(a) over(partition by c0, c1, ... order by d0, d1, ...)
+    partition = ", ".join([f"c{i}" for i in range(n // 2)])
+    order = ", ".join([f"d{i}" for i in range(n - n // 2)])
+    return f"select lead(a) over(partition by {partition} order by {order}) as b\n  from t"
+
+
+def in_list(n):
+    # where id in (0, 1, ...)
+    values = ", ".join([str(i) for i in range(n)])
+    return f"select a\n  from t\n where id in ({values})"
+
+
+WIDE_INPUTS = {
+    "on_predicates": on_predicates,
+    "function_arguments": function_arguments,
+    "window_spec": window_spec,
+    "in_list": in_list,
+}
+
+
+### MEASUREMENT
+
+def best_render_time(tokens, max_width, repeat):
+    """
+    Returns (seconds, output) for the fastest of `repeat` runs of parsing and rendering the tokens.
+    """
+    cf_flags.MAX_WIDTH = max_width
+    try:
+        return benchmark.best_time(lambda: render_and_trim(CompoundStatement(tokens)), repeat)
+    finally:
+        cf_flags.MAX_WIDTH = None
+
+
+def measure(source, terms, max_width, repeat):
+    tokens = cflexer.tokenize(source)
+    flat_seconds, _ = best_render_time(tokens, None, repeat)
+    seconds, output = best_render_time(tokens, max_width, repeat)
+    return {
+        "terms": terms,
+        "tokens": len(tokens),
+        "output_lines": output.count("\n") + 1,
+        "seconds": seconds,
+        "microseconds_per_term": seconds / terms * 1e6,
+        "seconds_without_max_width": flat_seconds,
+    }
+
+
+def run_benchmark(terms=DEFAULT_TERMS, doublings=DEFAULT_DOUBLINGS, max_width=DEFAULT_MAX_WIDTH, repeat=benchmark.DEFAULT_REPEAT):
+    def measure_sizes(make_input):
+        sizes = [measure(make_input(terms * 2**i), terms * 2**i, max_width, repeat) for i in range(doublings + 1)]
+        return {
+            "sizes": sizes,
+            # how much longer the largest input took per term than the smallest, which is about 1 when it's linear
+            "per_term_growth": sizes[-1]["microseconds_per_term"] / sizes[0]["microseconds_per_term"],
+        }
+
+    inputs = benchmark.run_inputs(WIDE_INPUTS, measure_sizes)
+    return benchmark.report(inputs, max_width=max_width, repeat=repeat)
+
+
+if __name__ == "__main__":
+    parser = benchmark.argument_parser("Time --max-width layout of expressions with thousands of terms")
+    parser.add_argument("--terms", type=int, default=DEFAULT_TERMS, help="How many terms the smallest expressions have")
+    parser.add_argument("--doublings", type=int, default=DEFAULT_DOUBLINGS, help="How many times to double the number of terms")
+    parser.add_argument("--max-width", type=int, default=DEFAULT_MAX_WIDTH, help="The width to lay the expressions out to")
+    args = parser.parse_args()
+
+    cf_flags.reset_to_defaults()
+    benchmark.write_report(run_benchmark(args.terms, args.doublings, args.max_width, args.repeat), args.output)
@@ -0,0 +1,143 @@
+import os
+
+import pygments
+
+import benchmark
+import cflexer
+import retokenize
+
+
+# Runs both lexer implementations over a corpus, reports how fast each one is, and reports where (if anywhere) their
+# final CFToken streams first disagree. Everything is local, and the output is JSON so that runs can be compared.
+
+LEXERS = {
+    "cflexer": lambda s: cflexer.collapse_identifiers(cflexer.lex(s)),
+    "pygments": lambda s: list(retokenize.iter_cftokens(s)),
+}
+
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archived", "sample.sql")
+
+DEFAULT_SCALE = 1000
+CONTEXT_TOKENS = 3
+
+
+### CORPUS
+
+def wide_select(n):
+    columns = "\n     , ".join([f"t.col_{i} as \"Col {i}\"" for i in range(n)])
+    return f"select {columns}\n  from my_schema.my_table t\n  left outer join other u on t.id = u.id"
+
+
+def string_literals(n):
+    literals = ", ".join([f"'value {i}'" for i in range(n)])
+    return f"select *\n  from t\n where x in ({literals})"
+
+
+def comments(n):
+    lines = [f"select a_{i} -- line comment {i}\n/* block\n comment {i} */ from t_{i}" for i in range(n)]
+    return "\nunion all\n".join(lines)
+
+
+def keyphrases(n):
+    predicates = "\n   and ".join([f"a_{i} is not null and b_{i} is not distinct from c_{i}" for i in range(n)])
+    return f"select a\n  from t\n where {predicates}\n group by a\n order by a"
+
+
+SYNTHETIC_INPUTS = {
+    "wide_select": wide_select,
+    "string_literals": string_literals,
+    "comments": comments,
+    "keyphrases": keyphrases,
+}
+
+
+def build_corpus(scale, paths):
+    corpus = {}
+    for path in [SAMPLE_PATH] + paths:
+        with open(path, encoding="utf-8") as f:
+            corpus[os.path.basename(path)] = f.read()
+
+    for name, make_input in SYNTHETIC_INPUTS.items():
+        corpus[name] = make_input(scale)
+
+    return corpus
+
+
+### MEASUREMENT
+
+def measure(lex, source, repeat):
+    """
+    Returns (tokens, result), where result holds the timings and peak memory, or an error if lexing failed.
+    Speed is taken from the fastest of `repeat` runs, peak memory from one more run.
+    """
+    size = len(source.encode("utf-8"))
+    try:
+        best, tokens = benchmark.best_time(lambda: lex(source), repeat)
+        peak = benchmark.peak_memory(lambda: lex(source))
+    except Exception as e:
+        return (None, {"error": f"{type(e).__name__}: {e}"})
+
+    result = {
+        "tokens": len(tokens),
+        "seconds": best,
+        "tokens_per_second": len(tokens) / best if best else None,
+        "mb_per_second": size / 1e6 / best if best else None,
+        "peak_memory_bytes": peak,
+    }
+    return (tokens, result)
+
+
+def token_json(token):
+    return [token.kind.name, token.value]
+
+
+def first_divergence(left, right):
+    """
+    Returns None if the two token lists are the same, otherwise a description of the first place they differ, with a
+    few tokens of shared context leading up to it. Tokens are compared by kind and value as written, not with ==,
+    which ignores the case of words, so that a difference in case counts.
+    """
+    length = min(len(left), len(right))
+    i = 0
+    while i < length and left[i].kind == right[i].kind and left[i].value == right[i].value:
+        i += 1
+
+    if i == len(left) == len(right):
+        return None
+
+    return {
+        "index": i,
+        "context": [token_json(t) for t in left[max(0, i - CONTEXT_TOKENS):i]],
+        "cflexer": token_json(left[i]) if i < len(left) else None,
+        "pygments": token_json(right[i]) if i < len(right) else None,
+    }
+
+
+def compare(source, repeat):
+    entry = {"bytes": len(source.encode("utf-8")), "lexers": {}}
+    outputs = {}
+    for lexer_name, lex in LEXERS.items():
+        tokens, entry["lexers"][lexer_name] = measure(lex, source, repeat)
+        outputs[lexer_name] = tokens
+
+    if outputs["cflexer"] is not None and outputs["pygments"] is not None:
+        entry["first_divergence"] = first_divergence(outputs["cflexer"], outputs["pygments"])
+        entry["agree"] = entry["first_divergence"] is None
+    else:
+        entry["agree"] = None
+        entry["first_divergence"] = None
+    return entry
+
+
+def run_benchmark(corpus, repeat=benchmark.DEFAULT_REPEAT):
+    inputs = benchmark.run_inputs(corpus, lambda source: compare(source, repeat))
+    return benchmark.report(inputs, {"pygments": pygments.__version__}, repeat=repeat)
+
+
+if __name__ == "__main__":
+    parser = benchmark.argument_parser("Compare speed, memory use and output of cflexer and the Pygments pipeline")
+    parser.add_argument("--scale", type=int, default=DEFAULT_SCALE, help="Size of the synthetic inputs, in repetitions of their basic unit")
+    parser.add_argument("paths", nargs="*", help="Additional (UTF-8) SQL files to include in the corpus")
+    args = parser.parse_args()
+
+    benchmark.write_report(run_benchmark(build_corpus(args.scale, args.paths), args.repeat), args.output)
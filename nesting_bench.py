@@ -0,0 +1,82 @@
+import sys
+
+import benchmark
+import cf_flags
+import cflexer
+from clause_formatter import CompoundStatement
+from formatter2 import render_and_trim
+
+
+# Times parsing and rendering of queries nested to a given depth, in a few different ways, and reports it as JSON.
+# Parsing and rendering don't recurse, so the depth should only be limited by memory; a RecursionError is reported
+# as an error rather than being allowed to kill the run.
+
+DEFAULT_DEPTH = 1000
+
+
+### INPUTS
+
+def from_subqueries(depth):
+    # select a from (select a from (...) s1) s0
+    query = "select a\n  from t"
+    for i in range(depth):
+        query = f"select a\n  from ({query}) s{i}"
+    return query
+
+
+def scalar_subqueries(depth):
+    # select (select (select ... 1))
+    return "select " + "(select " * depth + "1" + ")" * depth
+
+
+def ctes(depth):
+    # with c0 as (with c1 as (...) select * from c1 union all select 2) select * from c0 union all select 2
+    query = "select 1"
+    for i in range(depth):
+        query = f"with c{i} as ({query})\nselect *\n  from c{i}\n union all\nselect 2"
+    return query
+
+
+NESTED_INPUTS = {
+    "from_subqueries": from_subqueries,
+    "scalar_subqueries": scalar_subqueries,
+    "ctes": ctes,
+}
+
+
+### MEASUREMENT
+
+def measure(source, repeat):
+    """
+    Returns the best of `repeat` times for each of parsing and rendering, and the peak memory of one more run of
+    both, or an error if either failed.
+    """
+    try:
+        tokens = cflexer.tokenize(source)
+        parse_seconds, _ = benchmark.best_time(lambda: CompoundStatement(tokens), repeat)
+        render_seconds, output = benchmark.best_time(render_and_trim, repeat, setup=lambda: CompoundStatement(tokens))
+        peak = benchmark.peak_memory(lambda: render_and_trim(CompoundStatement(tokens)))
+    except (RecursionError, MemoryError) as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+    return {
+        "tokens": len(tokens),
+        "output_bytes": len(output.encode("utf-8")),
+        "parse_seconds": parse_seconds,
+        "render_seconds": render_seconds,
+        "peak_memory_bytes": peak,
+    }
+
+
+def run_benchmark(depth=DEFAULT_DEPTH, repeat=benchmark.DEFAULT_REPEAT):
+    inputs = benchmark.run_inputs(NESTED_INPUTS, lambda make_input: {"depth": depth, **measure(make_input(depth), repeat)})
+    return benchmark.report(inputs, {"recursion_limit": sys.getrecursionlimit()}, repeat=repeat)
+
+
+if __name__ == "__main__":
+    parser = benchmark.argument_parser("Time parsing and rendering of deeply nested queries")
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH, help="How many levels deep to nest each query")
+    args = parser.parse_args()
+
+    cf_flags.reset_to_defaults()
+    benchmark.write_report(run_benchmark(args.depth, args.repeat), args.output)
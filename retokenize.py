@@ -1,6 +1,7 @@
 import sys
 import re
 import argparse
+import functools
 
 import pygments
 from pygments.lexers import get_lexer_by_name
@@ -9,12 +10,16 @@ from pygments.token import Token
 from cftoken import CFToken, CFTokenKind
 
 
+# Phrases are looked up whole in the *_MAP dicts, keyed by their word tokens; the *_STARTERS sets are a cheap
+# first check so most tokens never get that far.
+
 IS_NOT_DISTINCT_FROM = [(Token.Keyword, 'is'), (Token.Keyword, 'not'), (Token.Keyword, 'distinct'), (Token.Keyword, 'from')]
 
 FOUR_WORD_PHRASES = [
     IS_NOT_DISTINCT_FROM,
 ]
-FOUR_WORD_PHRASE_STARTERS = [x[0] for x in FOUR_WORD_PHRASES]
+FOUR_WORD_PHRASE_STARTERS = {x[0] for x in FOUR_WORD_PHRASES}
+FOUR_WORD_PHRASE_MAP = {tuple(x): (Token.Keyword, ' '.join([t[1] for t in x])) for x in FOUR_WORD_PHRASES}
 
 
 LEFT_OUTER_JOIN = [(Token.Keyword, 'left'), (Token.Keyword, 'outer'), (Token.Keyword, 'join')]
@@ -40,16 +45,8 @@ THREE_WORD_PHRASES = [
     NOT_BETWEEN_SYMMETRIC,
     AT_TIME_ZONE,
 ]
-THREE_WORD_PHRASE_STARTERS = [x[0] for x in THREE_WORD_PHRASES]
-
-#THREE_WORD_PHRASE_MAP = {
-#    ((Token.Keyword, 'left'), (Token.Keyword, 'outer'), (Token.Keyword, 'join')):        (Token.Keyword, 'left outer join'),
-#    ((Token.Keyword, 'right'), (Token.Keyword, 'outer'), (Token.Keyword, 'join')):       (Token.Keyword, 'right outer join'),
-#    ((Token.Keyword, 'is'), (Token.Keyword, 'not'), (Token.Keyword, 'null')):            (Token.Keyword, 'is not null'),
-#    ((Token.Keyword, 'is'), (Token.Keyword, 'distinct'), (Token.Keyword, 'from')):       (Token.Keyword, 'is distinct from'),
-#    ((Token.Keyword, 'not'), (Token.Keyword, 'between'), (Token.Keyword, 'symmetric')):  (Token.Keyword, 'not between symmetric'),
-#    ((Token.Keyword, 'at'), (Token.Name.Builtin, 'time'), (Token.Keyword, 'zone')):      (Token.Keyword, 'at time zone'),
-#}
+THREE_WORD_PHRASE_STARTERS = {x[0] for x in THREE_WORD_PHRASES}
+THREE_WORD_PHRASE_MAP = {tuple(x): (Token.Keyword, ' '.join([t[1] for t in x])) for x in THREE_WORD_PHRASES}
 
 CROSS_JOIN = [(Token.Keyword, 'cross'), (Token.Keyword, 'join')]
 DISTINCT_ON = [(Token.Keyword, 'distinct'), (Token.Keyword, 'on')]
@@ -103,20 +100,8 @@ TWO_WORD_PHRASES = [
     INTERSECT_ALL,
     INTERSECT_DISTINCT,
 ]
-TWO_WORD_PHRASE_STARTERS = [x[0] for x in TWO_WORD_PHRASES]
-
-#TWO_WORD_PHRASE_MAP = {
-#    ((Token.Keyword, 'cross'), (Token.Keyword, 'join')):         (Token.Keyword, 'cross join'),
-#    ((Token.Keyword, 'left'), (Token.Keyword, 'join')):          (Token.Keyword, 'left join'),
-#    ((Token.Keyword, 'right'), (Token.Keyword, 'join')):         (Token.Keyword, 'right join'),
-#    ((Token.Keyword, 'group'), (Token.Keyword, 'by')):           (Token.Keyword, 'group by'),
-#    ((Token.Keyword, 'order'), (Token.Keyword, 'by')):           (Token.Keyword, 'order by'),
-#    ((Token.Keyword, 'partition'), (Token.Keyword, 'by')):       (Token.Keyword, 'partition by'),
-#    ((Token.Keyword, 'within'), (Token.Keyword, 'group')):       (Token.Keyword, 'within group'),
-#    ((Token.Keyword, 'is'), (Token.Keyword, 'null')):            (Token.Keyword, 'is null'),
-#    ((Token.Keyword, 'not'), (Token.Keyword, 'between')):        (Token.Keyword, 'not between'),
-#    ((Token.Keyword, 'between'), (Token.Keyword, 'symmetric')):  (Token.Keyword, 'between symmetric'),
-#}
+TWO_WORD_PHRASE_STARTERS = {x[0] for x in TWO_WORD_PHRASES}
+TWO_WORD_PHRASE_MAP = {tuple(x): (Token.Keyword, ' '.join([t[1] for t in x])) for x in TWO_WORD_PHRASES}
 
 
 SINGLE_QUOTE = (Token.Literal.String.Single, "'")
@@ -130,32 +115,41 @@ BLOCK_COMMENT_CLOSE = (Token.Comment.Multiline, '*/')
 
 ### FIRST PASS FUNCTIONS
 
+@functools.lru_cache(maxsize=None)
+def postgres_lexer():
+    # lexers hold no state between calls to get_tokens(), so one instance can be shared
+    return get_lexer_by_name("postgres", stripall=True)
+
+
 def initial_lex(unformatted_code):
-    lexer = get_lexer_by_name("postgres", stripall=True)
-    tokens = list(lexer.get_tokens(unformatted_code))
+    tokens = list(postgres_lexer().get_tokens(unformatted_code))
     return tokens
 
 
-def pre_process_tokens(tokenlist):
-    out = []
-    for t in tokenlist:
-        ttype, value = t
-
+def iter_pre_process_tokens(tokens):
+    """
+    Lazy version of pre_process_tokens(), accepts any iterable of tokens.
+    """
+    for ttype, value in tokens:
         # This makes dealing with keyphrases much easier, and I prefer lower-case keywords anyway.
         # If we want to support uppercasing keywords or passing them through unmodified, this would have to be removed
         # and get_key_phrase() refactored to do case-insensitive comaparisons.
         if ttype is Token.Keyword:
             value = value.lower()
 
-        out.append( (ttype, value) )
+        yield (ttype, value)
+
+
+def pre_process_tokens(tokenlist):
+    return list(iter_pre_process_tokens(tokenlist))
 
-    return out
 
+RE_WHITESPACE_PIECE = re.compile("\r\n|\n|[\t ]+")
 
 def explode_whitespace(token):
     SPACES_PER_TAB = 4 #TODO: set via CLI arg
     temp = []
-    for piece in re.findall("\r\n|\n|[\t ]+", token[1]):
+    for piece in RE_WHITESPACE_PIECE.findall(token[1]):
         if piece in ("\r\n", "\n"):
             temp.append((Token.Text.Whitespace, "\n"))
         else:
@@ -165,142 +159,135 @@ def explode_whitespace(token):
     return temp
 
 
-def get_single_quoted_literal(tokens):
+# The get_*() functions below take a list of tokens starting at the position of interest, and return the assembled
+# token and the number of tokens it consumed, or (None, None). Each is a thin wrapper around a _match_*() function
+# that does the same thing through peek(k), which returns the kth token or None past the end, so that the drivers
+# can look ahead in a token stream without slicing it.
+
+def _list_peek(tokens):
     length = len(tokens)
-    if length < 3 or tokens[0] != SINGLE_QUOTE:
+    def peek(k):
+        return tokens[k] if k < length else None
+    return peek
+
+
+def _joined(peek, tokens_in_phrase):
+    return ''.join([peek(k)[1] for k in range(tokens_in_phrase)])
+
+
+def _match_single_quoted_literal(peek):
+    if peek(2) is None or peek(0) != SINGLE_QUOTE:
         return (None, None)
 
     j = 1 # we already know the 0th token is a single quote
-    while j < length:
-        if tokens[j] == SINGLE_QUOTE:
-            phrase = tokens[0:j+1]
-            quoted_literal = ''.join([t[1] for t in phrase])
-            return ((Token.Literal.String.Single, quoted_literal), j+1)
-        else:
-            j += 1
+    token = peek(j)
+    while token is not None:
+        if token == SINGLE_QUOTE:
+            return ((Token.Literal.String.Single, _joined(peek, j+1)), j+1)
+        j += 1
+        token = peek(j)
 
     return (None, None)
 
 
-def get_dollar_quoted_literal(tokens):
-    length = len(tokens)
-    if length < 7:
+def get_single_quoted_literal(tokens):
+    return _match_single_quoted_literal(_list_peek(tokens))
+
+
+def _match_dollar_quoted_literal(peek):
+    if peek(6) is None:
         return (None, None)
-    if not (tokens[0] == DOLLAR_QUOTE and tokens[1][0] is Token.Literal.String.Delimiter and tokens[2] == DOLLAR_QUOTE):
+    if not (peek(0) == DOLLAR_QUOTE and peek(1)[0] is Token.Literal.String.Delimiter and peek(2) == DOLLAR_QUOTE):
         return (None, None)
 
-    delimiter = tokens[1]
+    delimiter = peek(1)
     j = 3 # we already know the first 3 tokens are $, delimiter, $
-    while j+2 < length:
-        if tokens[j:j+3] == [DOLLAR_QUOTE, delimiter, DOLLAR_QUOTE]:
-            phrase = tokens[0:j+3]
-            quoted_literal = ''.join([t[1] for t in phrase])
-            return ((Token.Literal.String, quoted_literal), j+3)
-        else:
-            j += 1
+    while peek(j+2) is not None:
+        if peek(j) == DOLLAR_QUOTE and peek(j+1) == delimiter and peek(j+2) == DOLLAR_QUOTE:
+            return ((Token.Literal.String, _joined(peek, j+3)), j+3)
+        j += 1
 
     return (None, None)
 
 
-def get_quoted_name(tokens):
-    length = len(tokens)
-    if length < 3 or tokens[0] not in (DOUBLE_QUOTE, BACKTICK_QUOTE):
+def get_dollar_quoted_literal(tokens):
+    return _match_dollar_quoted_literal(_list_peek(tokens))
+
+
+def _match_quoted_name(peek):
+    if peek(2) is None or peek(0) not in (DOUBLE_QUOTE, BACKTICK_QUOTE):
         return (None, None)
 
-    quote_token = tokens[0]
+    quote_token = peek(0)
     j = 1 # we already know the 0th token is quote_token
-    while j < length:
-        if tokens[j] == quote_token:
-            phrase = tokens[0:j+1]
-            quoted_name = ''.join([t[1] for t in phrase])
-            return ((Token.Literal.String.Name, quoted_name), j+1)
+    token = peek(j)
+    while token is not None:
+        if token == quote_token:
+            return ((Token.Literal.String.Name, _joined(peek, j+1)), j+1)
         j += 1
+        token = peek(j)
 
     return (None, None)
 
 
-def get_block_comment(tokens):
-    length = len(tokens)
-    if length < 2:
+def get_quoted_name(tokens):
+    return _match_quoted_name(_list_peek(tokens))
+
+
+def _match_block_comment(peek):
+    if peek(1) is None:
         return (None, None)
 
     j = 1
     nested_depth = 0
-    while j < length:
-        if tokens[j] == BLOCK_COMMENT_OPEN:
+    token = peek(j)
+    while token is not None:
+        if token == BLOCK_COMMENT_OPEN:
             nested_depth += 1
-        elif tokens[j] == BLOCK_COMMENT_CLOSE:
+        elif token == BLOCK_COMMENT_CLOSE:
             if nested_depth == 0:
-                phrase = tokens[0:j+1]
-                assembled_comment = ''.join([t[1] for t in phrase])
-                return ((Token.Comment.Multiline, assembled_comment), j+1)
+                return ((Token.Comment.Multiline, _joined(peek, j+1)), j+1)
             else:
                 nested_depth -= 1
-        elif tokens[j][0] is not Token.Comment.Multiline:
+        elif token[0] is not Token.Comment.Multiline:
             break
         j += 1
+        token = peek(j)
 
     return (None, None)
 
 
-# these three functions could be written as a single generic function,
-# but this is clearer and easier to get right
-
-def get_two_word_key_phrase(tokens):
-    length = len(tokens)
-    tokens_in_phrase = 3
-    if length < tokens_in_phrase:
-        return (None, None)
+def get_block_comment(tokens):
+    return _match_block_comment(_list_peek(tokens))
 
-    for phrase in TWO_WORD_PHRASES:
-        if (    tokens[0] == phrase[0]
-            and tokens[1][0] is Token.Text.Whitespace
-            and tokens[2] == phrase[1]
-           ):
-            assembled_phrase = ' '.join([t[1] for t in phrase])
-            return ((Token.Keyword, assembled_phrase), tokens_in_phrase)
 
-    return (None, None)
+def _match_key_phrase(peek, phrase_map, tokens_in_phrase):
+    # words alternate with whitespace, and the words as a whole are looked up in phrase_map
+    if peek(tokens_in_phrase - 1) is None:
+        return (None, None)
 
+    for k in range(1, tokens_in_phrase, 2):
+        if peek(k)[0] is not Token.Text.Whitespace:
+            return (None, None)
 
-def get_three_word_key_phrase(tokens):
-    length = len(tokens)
-    tokens_in_phrase = 5
-    if length < tokens_in_phrase:
+    words = tuple([peek(k) for k in range(0, tokens_in_phrase, 2)])
+    keyphrase = phrase_map.get(words)
+    if keyphrase is None:
         return (None, None)
 
-    for phrase in THREE_WORD_PHRASES:
-        if (    tokens[0] == phrase[0]
-            and tokens[1][0] is Token.Text.Whitespace
-            and tokens[2] == phrase[1]
-            and tokens[3][0] is Token.Text.Whitespace
-            and tokens[4] == phrase[2]
-           ):
-            assembled_phrase = ' '.join([t[1] for t in phrase])
-            return ((Token.Keyword, assembled_phrase), tokens_in_phrase)
+    return (keyphrase, tokens_in_phrase)
 
-    return (None, None)
 
+def get_two_word_key_phrase(tokens):
+    return _match_key_phrase(_list_peek(tokens), TWO_WORD_PHRASE_MAP, 3)
 
-def get_four_word_key_phrase(tokens):
-    length = len(tokens)
-    tokens_in_phrase = 7
-    if length < tokens_in_phrase:
-        return (None, None)
 
-    for phrase in FOUR_WORD_PHRASES:
-        if (    tokens[0] == phrase[0]
-            and tokens[1][0] is Token.Text.Whitespace
-            and tokens[2] == phrase[1]
-            and tokens[3][0] is Token.Text.Whitespace
-            and tokens[4] == phrase[2]
-            and tokens[5][0] is Token.Text.Whitespace
-            and tokens[6] == phrase[3]
-           ):
-            assembled_phrase = ' '.join([t[1] for t in phrase])
-            return ((Token.Keyword, assembled_phrase), tokens_in_phrase)
+def get_three_word_key_phrase(tokens):
+    return _match_key_phrase(_list_peek(tokens), THREE_WORD_PHRASE_MAP, 5)
+
 
-    return (None, None)
+def get_four_word_key_phrase(tokens):
+    return _match_key_phrase(_list_peek(tokens), FOUR_WORD_PHRASE_MAP, 7)
 
 
 ### SECOND PASS FUNCTIONS
@@ -328,33 +315,32 @@ def get_qualified_identifier(tokens):
 
 ### TRANSLATION FUNCTION(S)
 
+# token types that always translate to the same kind; the rest depend on the value as well
+PYGMENTS_KIND_MAP = {
+    Token.Comment.Multiline:      CFTokenKind.BLOCK_COMMENT,
+    Token.Comment.Single:         CFTokenKind.LINE_COMMENT,
+    Token.Keyword:                CFTokenKind.WORD,
+    Token.Literal.Number.Float:   CFTokenKind.LITERAL,
+    Token.Literal.String.Single:  CFTokenKind.LITERAL,
+    Token.Name.Builtin:           CFTokenKind.WORD,
+    Token.Operator:               CFTokenKind.SYMBOL,
+    Token.Punctuation:            CFTokenKind.SYMBOL,
+}
+
+
 def pygments_token_to_cftoken(token):
     ttype, value = token
 
+    kind = PYGMENTS_KIND_MAP.get(ttype)
+    if kind is not None:
+        return CFToken(kind, value)
+
     # cases are alphabetical
-    if ttype == Token.Comment.Multiline:
-        return CFToken(CFTokenKind.BLOCK_COMMENT, value)
-    elif ttype == Token.Comment.Single:
-        return CFToken(CFTokenKind.LINE_COMMENT, value)
-    elif ttype == Token.Keyword:
-        return CFToken(CFTokenKind.WORD, value)
-    elif ttype == Token.Literal.Number.Float:
-        return CFToken(CFTokenKind.LITERAL, value)
-    #elif ttype == Token.Literal.String.Name:
-    #    pass
-    elif ttype == Token.Literal.String.Single:
-        return CFToken(CFTokenKind.LITERAL, value)
-    elif ttype == Token.Name:
+    if ttype == Token.Name:
         if '"' in value or '`' in value:
             return CFToken(CFTokenKind.LITERAL, value)
         else:
             return CFToken(CFTokenKind.WORD, value)
-    elif ttype == Token.Name.Builtin:
-        return CFToken(CFTokenKind.WORD, value)
-    elif ttype == Token.Operator:
-        return CFToken(CFTokenKind.SYMBOL, value)
-    elif ttype == Token.Punctuation:
-        return CFToken(CFTokenKind.SYMBOL, value)
     elif ttype == Token.Error and value == "$":
         return CFToken(CFTokenKind.SYMBOL, value)
     elif ttype == Token.Text.Whitespace:
@@ -371,96 +357,169 @@ def pygments_token_to_cftoken(token):
 
 ### DRIVER FUNCTIONS
 
-def retokenize1(tokens):
-    out = []
-    i = 0
-    length = len(tokens)
-    while i < length:
+class _Lookahead:
+    """
+    Buffers a token stream so that the drivers can peek arbitrarily far ahead of the current position.
+    """
+    __slots__ = ("_tokens", "_buffer", "_head")
+
+
+    def __init__(self, tokens):
+        self._tokens = iter(tokens)
+        self._buffer = []
+        self._head = 0
+
+
+    def peek(self, k):
+        index = self._head + k
+        buffer = self._buffer
+        while len(buffer) <= index:
+            token = next(self._tokens, None)
+            if token is None:
+                return None
+            buffer.append(token)
+        return buffer[index]
+
+
+    def advance(self, n):
+        self._head += n
+        # drop consumed tokens once they're the bulk of the buffer, which keeps this amortized O(1)
+        if self._head > 1024 and 2*self._head > len(self._buffer):
+            del self._buffer[:self._head]
+            self._head = 0
+
+
+def iter_retokenize1(tokens):
+    """
+    Lazy version of retokenize1(), accepts any iterable of tokens.
+    """
+    lookahead = _Lookahead(tokens)
+    peek = lookahead.peek
+
+    # An unmatched quote searches all the way to the end of the input, so once a quote (or dollar-quote delimiter)
+    # has come up unmatched, every later one will too, and there's no need to search again.
+    unmatched_quotes = set()
+    unmatched_delimiters = set()
+
+    token = peek(0)
+    while token is not None:
         # single-quoted string literals
         #TODO: support affixed literals E'...', B'...', U&'...', x'...'
-        if tokens[i] == SINGLE_QUOTE:
-            quoted_literal, tokens_consumed = get_single_quoted_literal(tokens[i:])
+        if token == SINGLE_QUOTE and token not in unmatched_quotes:
+            quoted_literal, tokens_consumed = _match_single_quoted_literal(peek)
             if quoted_literal:
-                out.append(quoted_literal)
-                i += tokens_consumed
+                yield quoted_literal
+                lookahead.advance(tokens_consumed)
+                token = peek(0)
                 continue
+            unmatched_quotes.add(token)
 
         # dollar-quoted string literals
-        if tokens[i] == DOLLAR_QUOTE:
-            quoted_literal, tokens_consumed = get_dollar_quoted_literal(tokens[i:])
+        if token == DOLLAR_QUOTE and peek(1) not in unmatched_delimiters:
+            quoted_literal, tokens_consumed = _match_dollar_quoted_literal(peek)
             if quoted_literal:
-                out.append(quoted_literal)
-                i += tokens_consumed
+                yield quoted_literal
+                lookahead.advance(tokens_consumed)
+                token = peek(0)
                 continue
+            delimiter = peek(1)
+            if delimiter is not None and delimiter[0] is Token.Literal.String.Delimiter and peek(2) == DOLLAR_QUOTE:
+                unmatched_delimiters.add(delimiter)
 
         # double-quoted/backtick-quoted identifiers
-        if tokens[i] in (DOUBLE_QUOTE, BACKTICK_QUOTE):
-            quoted_name, tokens_consumed = get_quoted_name(tokens[i:])
+        if token in (DOUBLE_QUOTE, BACKTICK_QUOTE) and token not in unmatched_quotes:
+            quoted_name, tokens_consumed = _match_quoted_name(peek)
             if quoted_name:
-                out.append(quoted_name)
-                i += tokens_consumed
+                yield quoted_name
+                lookahead.advance(tokens_consumed)
+                token = peek(0)
                 continue
+            unmatched_quotes.add(token)
 
         # multi-keyword phrases
         keyphrase = None
-        if i+6 < length and tokens[i] in (FOUR_WORD_PHRASE_STARTERS):
-            keyphrase, tokens_consumed = get_four_word_key_phrase(tokens[i:])
+        if token in FOUR_WORD_PHRASE_STARTERS:
+            keyphrase, tokens_consumed = _match_key_phrase(peek, FOUR_WORD_PHRASE_MAP, 7)
 
-        if not keyphrase and i+4 < length and tokens[i] in (THREE_WORD_PHRASE_STARTERS):
-            keyphrase, tokens_consumed = get_three_word_key_phrase(tokens[i:])
+        if not keyphrase and token in THREE_WORD_PHRASE_STARTERS:
+            keyphrase, tokens_consumed = _match_key_phrase(peek, THREE_WORD_PHRASE_MAP, 5)
 
-        if not keyphrase and i+2 < length and tokens[i] in (TWO_WORD_PHRASE_STARTERS):
-            keyphrase, tokens_consumed = get_two_word_key_phrase(tokens[i:])
+        if not keyphrase and token in TWO_WORD_PHRASE_STARTERS:
+            keyphrase, tokens_consumed = _match_key_phrase(peek, TWO_WORD_PHRASE_MAP, 3)
 
         if keyphrase:
-            out.append(keyphrase)
-            i += tokens_consumed
+            yield keyphrase
+            lookahead.advance(tokens_consumed)
+            token = peek(0)
             continue
 
         # block comments
-        if i+2 < length and tokens[i] == BLOCK_COMMENT_OPEN:
-            block_comment, tokens_consumed = get_block_comment(tokens[i:])
+        if token == BLOCK_COMMENT_OPEN and peek(2) is not None:
+            block_comment, tokens_consumed = _match_block_comment(peek)
             if block_comment:
-                out.append(block_comment)
-                i += tokens_consumed
+                yield block_comment
+                lookahead.advance(tokens_consumed)
+                token = peek(0)
                 continue
 
         # whitespace
-        if tokens[i][0] is Token.Text.Whitespace:
-            out += explode_whitespace(tokens[i])
-            i += 1
-            continue
+        if token[0] is Token.Text.Whitespace:
+            yield from explode_whitespace(token)
+        else:
+            # everything else passes through unmodified
+            yield token
 
-        # everything else passes through unmodified
-        out.append(tokens[i])
-        i += 1
+        lookahead.advance(1)
+        token = peek(0)
 
-    return out
 
+def retokenize1(tokens):
+    return list(iter_retokenize1(tokens))
 
-def retokenize2(tokens):
-    out = []
-    i = 0
-    length = len(tokens)
-    while i < length:
-        if i+2 < length: # qualified identifiers
-            phrase = tokens[i:i+5]
+
+def iter_retokenize2(tokens):
+    """
+    Lazy version of retokenize2(), accepts any iterable of tokens.
+    """
+    lookahead = _Lookahead(tokens)
+    peek = lookahead.peek
+
+    token = peek(0)
+    while token is not None:
+        if peek(2) is not None: # qualified identifiers
+            phrase = [t for t in map(peek, range(5)) if t is not None]
             qualified_identifier, tokens_consumed = get_qualified_identifier(phrase)
             if qualified_identifier:
-                out.append(qualified_identifier)
-                i += tokens_consumed
+                yield qualified_identifier
+                lookahead.advance(tokens_consumed)
+                token = peek(0)
                 continue
 
-        out.append(tokens[i])
-        i += 1
+        yield token
+        lookahead.advance(1)
+        token = peek(0)
 
-    return out
+
+def retokenize2(tokens):
+    return list(iter_retokenize2(tokens))
 
 
 def cftokenize(tokens):
     return [pygments_token_to_cftoken(t) for t in tokens]
 
 
+def iter_cftokens(unformatted_code):
+    """
+    Runs the whole pipeline, from initial_lex() through cftokenize(), as a single lazy pass: each Pygments token goes
+    through every stage before the next one is lexed, and no intermediate lists are built.
+    """
+    tokens = postgres_lexer().get_tokens(unformatted_code)
+    tokens = iter_pre_process_tokens(tokens)
+    tokens = iter_retokenize1(tokens)
+    tokens = iter_retokenize2(tokens)
+    return map(pygments_token_to_cftoken, tokens)
+
+
 def tokens_for_cli_output(unformatted_code, func_name):
     tokens = initial_lex(unformatted_code)
     if func_name == "initial_lex":
@@ -0,0 +1,69 @@
+import io
+import json
+import contextlib
+
+import pytest
+
+import benchmark
+import layout_bench
+import lexer_bench
+import nesting_bench
+
+
+def test_best_time():
+    calls = []
+    seconds, result = benchmark.best_time(lambda: calls.append(1) or len(calls), repeat=3)
+    assert 3 == result
+    assert seconds >= 0
+
+
+def test_best_time_with_setup():
+    # only run() is timed, and it's given what setup() made
+    made = []
+    seconds, result = benchmark.best_time(lambda x: x * 2, repeat=2, setup=lambda: made.append(1) or len(made))
+    assert [1, 1] == made
+    assert 4 == result
+
+
+def test_peak_memory():
+    assert benchmark.peak_memory(lambda: bytearray(1_000_000)) >= 1_000_000
+
+
+def test_run_inputs():
+    entries = benchmark.run_inputs({"b": 2, "a": 1}, lambda n: {"twice": n * 2})
+    assert [{"name": "b", "twice": 4}, {"name": "a", "twice": 2}] == entries
+
+
+def test_report():
+    report = benchmark.report([{"name": "a"}], {"extra": 1}, repeat=3)
+    assert ["environment", "repeat", "inputs"] == list(report)
+    assert {"python", "platform", "extra"} == set(report["environment"])
+    assert [{"name": "a"}] == report["inputs"]
+
+
+def test_write_report(tmp_path):
+    report = benchmark.report([], repeat=1)
+    path = tmp_path / "report.json"
+    benchmark.write_report(report, str(path))
+    assert report == json.loads(path.read_text(encoding="utf-8"))
+
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        benchmark.write_report(report)
+    assert report == json.loads(stdout.getvalue())
+
+
+def test_argument_parser():
+    args = benchmark.argument_parser("test").parse_args(["--repeat", "5"])
+    assert 5 == args.repeat
+    assert args.output is None
+
+
+@pytest.mark.parametrize(
+    "inputs",
+    [lexer_bench.SYNTHETIC_INPUTS, nesting_bench.NESTED_INPUTS, layout_bench.WIDE_INPUTS],
+    ids=["lexer", "nesting", "layout"],
+)
+def test_inputs_grow(inputs):
+    for make_input in inputs.values():
+        assert len(make_input(3)) < len(make_input(6))
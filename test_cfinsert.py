@@ -0,0 +1,175 @@
+import io
+
+import pytest
+
+import cf_flags
+import cfinsert
+import cflexer
+from cfwriter import RenderWriter
+from clause_formatter import CompoundStatement
+from formatter2 import do_format, render_and_trim
+
+
+# pytest magic
+def setup_module():
+    cf_flags.reset_to_defaults()
+
+
+@pytest.fixture
+def max_width():
+    def set_max_width(width):
+        cf_flags.MAX_WIDTH = width
+    yield set_max_width
+    cf_flags.MAX_WIDTH = None
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("-- x\n insert into t values (1)", True),
+    ("select 1", False),
+    ("", False),
+])
+def test_starts_with_insert(sql, expected):
+    assert cfinsert.starts_with_insert(cflexer.tokenize(sql)) == expected
+
+
+def test_read_header():
+    tokens = iter(cflexer.tokenize("insert into t (a, b) values (1, 2)"))
+    consumed, start = cfinsert.read_header(tokens)
+    assert start == 0
+    assert "".join(t.value for t in consumed) == "insert into t (a, b) values"
+    assert next(tokens).value == " "
+
+    # reading stops as soon as it's clear that it's something else
+    tokens = iter(cflexer.tokenize("insert into t select * from u"))
+    consumed, start = cfinsert.read_header(tokens)
+    assert start is None
+    assert "".join(t.value for t in consumed) == "insert into t select"
+
+
+def test_insert_select_is_left_alone():
+    sql = "insert into t select a, b from u"
+    assert do_format(sql) == render_and_trim(CompoundStatement(cflexer.tokenize(sql)))
+
+
+def test_no_column_list():
+    assert do_format("insert into t values(1,2),(3,4)") == (
+        "insert into t\n"
+        "values (1,2)\n"
+        "     , (3,4)"
+    )
+
+
+def test_comments():
+    sql = (
+        "insert into t values -- the rows\n"
+        "(1), /* one */ (2)\n"
+        "-- and three\n"
+        ", (3) -- the last\n"
+        ";"
+    )
+    assert do_format(sql) == (
+        "insert into t\n"
+        "values -- the rows\n"
+        "       (1) /* one */\n"
+        "     , (2)\n"
+        "     -- and three\n"
+        "     , (3) -- the last\n"
+        ";"
+    )
+
+
+def test_trailing_comma():
+    # kept with the last row, even with a comment after it
+    assert do_format("insert into t (a, b) values (1, 2), (3, 4),;") == (
+        "insert into t (a\n"
+        "             , b)\n"
+        "values (1, 2)\n"
+        "     , (3, 4),;"
+    )
+    assert do_format("insert into t values (1), (2) -- two\n,;") == (
+        "insert into t\n"
+        "values (1)\n"
+        "     , (2), -- two\n"
+        ";"
+    )
+
+
+def test_rows_across_lines():
+    # joined onto one line, unless a line comment needs its line break
+    sql = (
+        "insert into t values (\n"
+        "  1,\n"
+        "  'one'\n"
+        "), (2,\n"
+        "    f(2) -- two\n"
+        ")"
+    )
+    assert do_format(sql) == (
+        "insert into t\n"
+        "values (1, 'one')\n"
+        "     , (2,\n"
+        "       f(2) -- two\n"
+        "       )"
+    )
+    rows = cflexer.tokenize("(\n  1 ,\n  2\n)")
+    assert [t.value for t in cfinsert.join_lines(rows)] == ["(", "1", " ", ",", " ", "2", ")"]
+
+
+def test_default_values():
+    # no rows, so the VALUES stays with the rest of the header
+    assert do_format("insert into t default values;\ninsert into t values (1), (2);") == (
+        "insert into t default values;\n"
+        "insert into t\n"
+        "values (1)\n"
+        "     , (2);"
+    )
+    assert do_format("insert into t DEFAULT VALUES returning id;") == (
+        "insert into t DEFAULT VALUES\n"
+        "returning id;"
+    )
+
+
+def test_max_width(max_width):
+    max_width(24)
+    assert do_format("insert into t values (1, 2, 3), (4444, 5555, 6666, 7777)") == (
+        "insert into t\n"
+        "values (1, 2, 3)\n"
+        "     , (4444\n"
+        "       , 5555\n"
+        "       , 6666\n"
+        "       , 7777)"
+    )
+
+
+def test_statements_after():
+    assert do_format("insert into t values (1);\nselect a from t") == (
+        "insert into t\n"
+        "values (1);\n"
+        "select a\n"
+        "  from t"
+    )
+
+
+def test_rows_are_streamed():
+    # each row is written out before the one after the next has been lexed
+    rows_lexed = 0
+    def tokens():
+        nonlocal rows_lexed
+        yield from cflexer.tokenize("insert into t values ")
+        for i in range(100):
+            rows_lexed += 1
+            yield from cflexer.tokenize(f"({i}, 'row {i}'), "[: None if i < 99 else -2])
+
+    class Stream(io.StringIO):
+        def write(self, text):
+            if text.startswith("     , ("):
+                row = int(text[len("     , ("):text.index(",", len("     , ("))])
+                assert rows_lexed <= row + 2
+            return super().write(text)
+
+    stream = Stream()
+    writer = RenderWriter(stream, strip_trailing_whitespace=True)
+    cfinsert.render_statements(tokens(), writer)
+    writer.finish()
+    assert rows_lexed == 100
+    assert stream.getvalue().count("\n") == 100
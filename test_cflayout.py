@@ -0,0 +1,194 @@
+import pytest
+
+import cf_flags
+import cflexer
+from cflayout import BEGIN, BREAK, END, FILL, TEXT, build_document, layout_expression, measure_document
+from clause_formatter import LiteralList
+from formatter2 import do_format
+
+
+# pytest magic
+def setup_module():
+    cf_flags.reset_to_defaults()
+
+
+@pytest.fixture
+def max_width():
+    def set_max_width(width):
+        cf_flags.MAX_WIDTH = width
+    yield set_max_width
+    cf_flags.MAX_WIDTH = None
+
+
+def layout(source, column, width):
+    tokens = cflexer.tokenize(source)
+    return layout_expression(tokens, 0, len(tokens), None, column, width)
+
+
+def test_document():
+    tokens = cflexer.tokenize("f(a, b)")
+    ops = build_document(tokens, 0, len(tokens))
+    assert ops == [
+        (BEGIN,), (BEGIN,), (BEGIN,), (TEXT, "f"), (TEXT, "("),
+            (BEGIN,), (BEGIN,), (BEGIN,), (TEXT, "a"), (END,),
+            (BREAK, ", ", ", ", 2),
+            (BEGIN,), (TEXT, "b"),
+        (END,), (END,), (END,), (TEXT, ")"), (END,), (END,), (END,),
+    ]
+
+    sizes, trails = measure_document(ops)
+    assert sizes[0] == len("f(a, b)")
+    assert sizes[5] == len("a, b")
+    assert trails[7] == 0 # a comma comes right after "a"
+    assert trails[11] == len(")")
+
+
+def test_fits():
+    assert "f(a, b) and c" == layout("f(a, b) and c", 0, 13)
+
+
+def test_function_call():
+    assert layout("coalesce(aaaa, bbbb, cccc)", 7, 20) == (
+        "coalesce(aaaa\n"
+        "              , bbbb\n"
+        "              , cccc)"
+    )
+
+
+def test_only_what_does_not_fit_is_broken():
+    assert layout("x = 1 and g(cccccccccccccccccccccccccccccccc, d) = f(a, b)", 0, 40) == (
+        "x = 1\n"
+        "and g(cccccccccccccccccccccccccccccccc\n"
+        "    , d) = f(a, b)"
+    )
+
+
+def test_between_and_case():
+    # the ANDs of BETWEEN and of CASE are left alone (and no line starts left of where the expression did)
+    assert layout("x between 1 and 2 and case when a and b then 1 end = 1", 4, 20) == (
+        "x between 1 and 2\n"
+        "    and case when a and b then 1 end = 1"
+    )
+
+
+def test_window_spec(max_width):
+    max_width(60)
+    actual = do_format(
+        "select lead(page, 1) over(partition by user_id, request_time::date, some_other_thing "
+        "order by request_time, and_something_else) as nxt\n"
+        "  from t"
+    )
+    assert actual == (
+        "select lead(page, 1) over(partition by user_id\n"
+        "                                     , request_time::date\n"
+        "                                     , some_other_thing\n"
+        "                          order by request_time\n"
+        "                                 , and_something_else) as nxt\n"
+        "  from t"
+    )
+
+
+def test_on_clause(max_width):
+    max_width(50)
+    actual = do_format(
+        "select a\n"
+        "  from t\n"
+        "  join some_table u on t.id = u.id and t.other_column = u.other_column and t.x between 1 and 2\n"
+        "  join v on (t.id = v.id and t.other_column = v.other_column)\n"
+    )
+    assert actual == (
+        "select a\n"
+        "  from t\n"
+        "  join some_table u on t.id = u.id\n"
+        "                   and t.other_column = u.other_column\n"
+        "                   and t.x between 1 and 2\n"
+        "  join v on (t.id = v.id\n"
+        "         and t.other_column = v.other_column)"
+    )
+
+
+def test_author_layout_is_kept(max_width):
+    # expressions with line breaks or comments are left as they are, however wide
+    max_width(30)
+    sql = (
+        "select a\n"
+        "  from t\n"
+        "  join some_table u on t.id = u.id and t.x = u.x -- comment\n"
+        " where f(aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa, bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb,\n"
+        "       ccc)"
+    )
+    assert do_format(sql) == sql
+
+
+def test_idempotent(max_width):
+    max_width(40)
+    formatted = do_format("select coalesce(aaaaaaaaaa, bbbbbbbbbb, f(cccccccccc, dddddddddd), eeeeeeeeee) as x from t")
+    assert formatted.count("\n") > 3
+    assert do_format(formatted) == formatted
+
+
+def test_literal_list_document():
+    tokens = cflexer.tokenize("(1, 2)")
+    elements = [tokens[0], LiteralList(tokens, 1, 5), tokens[5]]
+    assert build_document(elements, 0, 3) == [
+        (BEGIN,), (BEGIN,), (BEGIN,), (TEXT, "("),
+            (BEGIN,), (BEGIN,), (BEGIN,), (TEXT, "1"), (END,),
+            (BREAK, ", ", ", ", 2),
+            (BEGIN,), (TEXT, "2"),
+        (END,), (END,), (END,), (TEXT, ")"), (END,), (END,), (END,),
+    ]
+    assert build_document(elements, 0, 3, fill_literal_lists=True) == [
+        (BEGIN,), (BEGIN,), (BEGIN,), (TEXT, "("),
+            (BEGIN,), (BEGIN,), (BEGIN,), (TEXT, "1"), (FILL, ", ", ", ", 2), (TEXT, "2"),
+        (END,), (END,), (END,), (TEXT, ")"), (END,), (END,), (END,),
+    ]
+
+
+def test_literal_lists(max_width):
+    max_width(30)
+    sql = "select a\n  from t\n where id in (1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12) and b = 1"
+    # a list of literals is broken at every comma, just as if it weren't one
+    assert do_format(sql) == (
+        "select a\n"
+        "  from t\n"
+        " where id in (1\n"
+        "            , 2\n"
+        "            , 3\n"
+        "            , 4\n"
+        "            , 5\n"
+        "            , 6\n"
+        "            , 7\n"
+        "            , 8\n"
+        "            , 9\n"
+        "            , 10\n"
+        "            , 11\n"
+        "            , 12)\n"
+        "   and b = 1"
+    )
+
+    # unless it's to be filled
+    cf_flags.FILL_LITERAL_LISTS = True
+    try:
+        assert do_format(sql) == (
+            "select a\n"
+            "  from t\n"
+            " where id in (1, 2, 3, 4, 5, 6\n"
+            "            , 7, 8, 9, 10, 11\n"
+            "            , 12)\n"
+            "   and b = 1"
+        )
+    finally:
+        cf_flags.FILL_LITERAL_LISTS = False
+
+
+def test_linear():
+    # a document has a constant number of ops per token, however deeply nested
+    for source in ["f(" * 1000 + "a" + ")" * 1000, " and ".join(["a = b"] * 1000)]:
+        tokens = cflexer.tokenize(source)
+        assert len(build_document(tokens, 0, len(tokens))) < 6 * len(tokens)
+        # and laying it out only changes whitespace
+        assert layout(source, 0, 40).replace("\n", "").replace(" ", "") == source.replace(" ", "")
+    # including lists of literals, which don't need any tokens
+    tokens = cflexer.tokenize("(" + ", ".join(["1"] * 1000) + ")")
+    elements = [tokens[0], LiteralList(tokens, 1, len(tokens) - 1), tokens[-1]]
+    assert len(build_document(elements, 0, 3, fill_literal_lists=True)) < 2 * 1000 + 20
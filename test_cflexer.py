@@ -1,5 +1,10 @@
+import io
+import time
+import itertools
+
 import pytest
 
+import cf_flags
 import cflexer
 from cftoken import CFToken, CFTokenKind
 
@@ -395,3 +400,445 @@ def test_collapse_identifiers():
     for t in actual_tokens:
         print(t)
     assert expected_tokens == actual_tokens
+
+
+def test_trailing_dot():
+    text = "foo."
+    expected = [CFToken(CFTokenKind.WORD, "foo"), CFToken(CFTokenKind.SYMBOL, ".")]
+    actual = cflexer.lex(text)
+    assert expected == actual
+
+
+def test_sloppy_numeric_literal():
+    text = "1.e37E5e.8. .5 ¹2"
+    expected = [
+        CFToken(CFTokenKind.WORD, "1.e37E5e.8."),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, ".5"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "¹2"),
+    ]
+    actual = cflexer.lex(text)
+    assert expected == actual
+
+
+def test_dollar_quoted_literal():
+    text = "$body$ it's $$ fine $body$$$x$$"
+    expected = [
+        CFToken(CFTokenKind.LITERAL, "$body$ it's $$ fine $body$"),
+        CFToken(CFTokenKind.LITERAL, "$$x$$"),
+    ]
+    actual = cflexer.lex(text)
+    assert expected == actual
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_iter_lex_matches_lex(chunk_size):
+    text = (
+        "select 'it''s', \"Foo\"\"Bar\", `a``b`, $body$ x $$ y $body$, $1\n"
+        "  from foo /* block\ncomment */ -- line comment\n"
+        " where a is not distinct from b\n"
+        "   and c is  not null\n"
+        " group by 1.5e3, .5\n"
+        " order by 'unterminated"
+    )
+    expected = cflexer.lex(text)
+    actual = list(cflexer.iter_lex(io.StringIO(text), chunk_size=chunk_size))
+    assert expected == actual
+    assert [t.value for t in expected] == [t.value for t in actual]
+
+
+def test_iter_lex_empty():
+    assert [] == list(cflexer.iter_lex(io.StringIO("")))
+
+
+def test_iter_collapse_identifiers_is_lazy():
+    def token_generator():
+        yield from cflexer.lex("a.b +") # exactly one window of five tokens
+        raise AssertionError("read too far")
+
+    tokens = cflexer.iter_collapse_identifiers(token_generator())
+    assert CFToken(CFTokenKind.WORD, "a.b") == next(tokens)
+
+
+RELEX_TEXT = (
+    "select 'it''s' as x, \"Foo\".bar\n"
+    "  from foo /* block\ncomment */ -- line comment\n"
+    " where a is not distinct from b\n"
+    " group by 1.5e3, .5\n"
+)
+
+
+@pytest.mark.parametrize(
+    "edit_start,edit_end,new_text",
+    [
+        (0, 0, "--"),                # comment out the first line
+        (7, 7, "'"),                 # break a string literal
+        (10, 11, ""),                # un-double a quote
+        (14, 14, "x"),               # insert at a token boundary
+        (51, 51, "*/"),              # close the block comment early
+        (60, 60, " group"),          # insert a word mid-comment
+        (88, 89, "t"),               # break a keyphrase
+        (90, 94, ""),                # turn one keyphrase into another
+        (len(RELEX_TEXT), len(RELEX_TEXT), " limit 1"),
+        (0, len(RELEX_TEXT), "select 1"),
+    ]
+)
+def test_relex(edit_start, edit_end, new_text):
+    previous = cflexer.scan(RELEX_TEXT, lower_case=False)
+    expected = cflexer.scan(RELEX_TEXT[:edit_start] + new_text + RELEX_TEXT[edit_end:], lower_case=False)
+    actual = cflexer.relex(previous, edit_start, edit_end, new_text)
+    assert expected == actual
+    assert [t.value for t in expected] == [t.value for t in actual]
+
+
+def test_relex_reuses_tokens_outside_the_edit():
+    previous = cflexer.scan(RELEX_TEXT, lower_case=False)
+    actual = cflexer.relex(previous, 88, 88, "z")
+    assert actual[0] is previous[0]
+    assert actual[-1] is previous[-1]
+
+
+def test_relex_invalid_range():
+    previous = cflexer.scan("select 1", lower_case=False)
+    with pytest.raises(ValueError):
+        cflexer.relex(previous, 5, 100, "x")
+
+
+def test_relex_with_offsets():
+    text = RELEX_TEXT * 50
+    tokens = cflexer.scan(text, lower_case=False)
+    offsets = cflexer.TokenOffsets(tokens)
+    for edit_start, edit_end, new_text in [(5000, 5000, "'"), (10, 11, ""), (88, 89, "t"), (5000, 5001, ""), (0, 60, "")]:
+        text = text[:edit_start] + new_text + text[edit_end:]
+        assert cflexer.relex(tokens, edit_start, edit_end, new_text, offsets) is tokens
+        assert cflexer.scan(text, lower_case=False) == tokens
+        assert list(itertools.accumulate((len(t.value) for t in tokens), initial=0)) == list(offsets)
+
+
+def test_relex_with_offsets_only_looks_at_the_edit():
+    # with offsets kept from one edit to the next, how much of the token list an edit looks at doesn't depend on
+    # the size of the text
+    class CountingList(list):
+        reads = 0
+        def __getitem__(self, i):
+            CountingList.reads += 1
+            return super().__getitem__(i)
+
+    reads = []
+    for copies in [100, 1000]:
+        text = RELEX_TEXT * copies
+        tokens = CountingList(cflexer.scan(text, lower_case=False))
+        offsets = cflexer.TokenOffsets(tokens)
+        CountingList.reads = 0
+        middle = len(RELEX_TEXT) * (copies // 2) + 14
+        cflexer.relex(tokens, middle, middle, "x", offsets)
+        reads.append(CountingList.reads)
+        assert cflexer.scan(text[:middle] + "x" + text[middle:], lower_case=False) == tokens
+    assert reads[0] == reads[1]
+
+
+def test_token_array_matches_lex():
+    text = RELEX_TEXT + "select A.b, \"X\".Y, a.b.c.d from T"
+    token_array = cflexer.TokenArray.lex(text)
+    assert cflexer.lex(text) == list(token_array)
+    assert len(cflexer.lex(text)) == len(token_array)
+    assert cflexer.collapse_identifiers(cflexer.lex(text)) == list(token_array.collapse_identifiers())
+
+
+def test_token_array_slices_are_views():
+    token_array = cflexer.TokenArray.lex("select a, b from c")
+    view = token_array[2:]
+    assert isinstance(view, cflexer.TokenArray)
+    assert view.kinds is token_array.kinds
+    assert CFToken(CFTokenKind.WORD, "a") == view[0]
+    assert CFToken(CFTokenKind.WORD, "c") == view[-1]
+    assert list(token_array)[2:5] == list(view[:3])
+    with pytest.raises(IndexError):
+        view[100]
+
+
+def test_token_array_lower_case():
+    cf_flags.LOWER_CASE = True
+    try:
+        token_array = cflexer.TokenArray.lex('SELECT Foo."Bar"')
+        expected = [
+            CFToken(CFTokenKind.WORD, "select"),
+            CFToken(CFTokenKind.SPACES, " "),
+            CFToken(CFTokenKind.LITERAL, 'foo."Bar"'),
+        ]
+        assert expected == list(token_array.collapse_identifiers())
+        assert ['select', ' ', 'foo."Bar"'] == [t.value for t in token_array.collapse_identifiers()]
+    finally:
+        cf_flags.reset_to_defaults()
+
+
+def test_key_phrases_with_any_whitespace():
+    for text in ["group  by", "group\nby", "GROUP\n    BY", "group \n\n by"]:
+        expected = [CFToken(CFTokenKind.WORD, "group by")]
+        actual = cflexer.lex(text)
+        assert expected == actual
+    assert ["GROUP BY"] == [t.value for t in cflexer.lex("GROUP\n    BY")]
+
+
+def test_key_phrase_with_comments():
+    text = "is /* a */ not -- b\n null"
+    expected = [
+        CFToken(CFTokenKind.WORD, "is not null"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.BLOCK_COMMENT, "/* a */"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.LINE_COMMENT, "-- b\n"),
+    ]
+    actual = cflexer.lex(text)
+    assert expected == actual
+
+
+def test_longest_key_phrase_wins():
+    text = "is not distinct from is not distinct"
+    expected = [
+        CFToken(CFTokenKind.WORD, "is not distinct from"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "is"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "not"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "distinct"),
+    ]
+    actual = cflexer.lex(text)
+    assert expected == actual
+
+
+def test_key_phrases_are_whole_words():
+    text = "is nullable"
+    expected = [
+        CFToken(CFTokenKind.WORD, "is"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "nullable"),
+    ]
+    actual = cflexer.lex(text)
+    assert expected == actual
+
+
+def test_tokenize_assembles_qualified_identifiers():
+    text = 'select a.b, "X".y, `Z`."w""v", a.b.c.d, a . b, a.1 from t'
+    expected = [
+        CFToken(CFTokenKind.WORD, "select"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "a.b"),
+        CFToken(CFTokenKind.SYMBOL, ","),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.LITERAL, '"X".y'),
+        CFToken(CFTokenKind.SYMBOL, ","),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.LITERAL, '`Z`."w""v"'),
+        CFToken(CFTokenKind.SYMBOL, ","),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "a.b.c.d"), # unlike collapse_identifiers(), which stops after three parts
+        CFToken(CFTokenKind.SYMBOL, ","),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "a"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.SYMBOL, "."),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "b"),
+        CFToken(CFTokenKind.SYMBOL, ","),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "a"),
+        CFToken(CFTokenKind.WORD, ".1"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "from"),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.WORD, "t"),
+    ]
+    actual = cflexer.tokenize(text)
+    assert expected == actual
+
+
+def test_tokenize_matches_collapse_identifiers():
+    text = RELEX_TEXT + "select A.b, \"X\".Y, a.b.c from T group by t.x order by 1"
+    assert cflexer.collapse_identifiers(cflexer.lex(text)) == cflexer.tokenize(text)
+
+
+def test_tokenize_lower_case():
+    cf_flags.LOWER_CASE = True
+    try:
+        actual = [t.value for t in cflexer.tokenize('SELECT Foo."Bar".BAZ, "A.B"."C"')]
+        assert ['select', ' ', 'foo."Bar".baz', ',', ' ', '"A.B"."C"'] == actual
+    finally:
+        cf_flags.reset_to_defaults()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_iter_tokenize_matches_tokenize(chunk_size):
+    text = RELEX_TEXT + 'select a.b.c, "X".\n"Y", `Z`."w""v"."u" from s.t'
+    expected = cflexer.tokenize(text)
+    actual = list(cflexer.iter_tokenize(io.StringIO(text), chunk_size=chunk_size))
+    assert expected == actual
+
+
+@pytest.mark.parametrize(
+    "text,expected_kind",
+    [
+        ("'it''s", CFTokenKind.LITERAL),
+        ('"Foo\\', CFTokenKind.LITERAL),
+        ("`a``", CFTokenKind.LITERAL),
+        ("$body$ select 1 $body", CFTokenKind.LITERAL),
+        ("/* select 1 *", CFTokenKind.BLOCK_COMMENT),
+    ]
+)
+def test_unterminated_runs_to_end(text, expected_kind):
+    expected = [CFToken(CFTokenKind.WORD, "select"), CFToken(CFTokenKind.SPACES, " "), CFToken(expected_kind, text)]
+    actual = cflexer.lex("select " + text)
+    assert expected == actual
+
+
+def test_escape_allows_newline():
+    text = "'a\\\nb'"
+    expected = [CFToken(CFTokenKind.LITERAL, text)]
+    actual = cflexer.lex(text)
+    assert expected == actual
+
+
+MEGABYTE = 1_000_000
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "'" + "\\'" * (MEGABYTE // 2),
+        "select '" + "x" * MEGABYTE,
+        "/*" + "x" * MEGABYTE,
+        "".join(f"$t{i}$ " for i in range(MEGABYTE // 8)),
+        "insert into t values ('" + '{"k": "v\\"", "n": [1, 2]} ' * (MEGABYTE // 25) + "')",
+    ],
+    ids=["escaped-quotes", "unterminated-quote", "unterminated-comment", "dollar-tags", "giant-literal"],
+)
+def test_pathological_input_is_linear(text):
+    # a quadratic lexer takes minutes on these
+    start = time.perf_counter()
+    tokens = cflexer.lex(text)
+    assert time.perf_counter() - start < 5
+    assert text == "".join([t.value for t in tokens])
+
+
+def test_token_array_over_bytes():
+    text = RELEX_TEXT + "select 日本.\"é\", ¹2, .٣ from t -- ✓\n"
+    token_array = cflexer.TokenArray.tokenize(text.encode())
+    assert cflexer.tokenize(text) == list(token_array)
+    assert cflexer.TokenArray.lex(text) == cflexer.TokenArray.lex(text.encode())
+    # offsets are in bytes
+    assert len(text.encode()) == token_array.ends[-1]
+
+
+def test_token_array_over_bytes_invalid_utf8():
+    source = "select 'ok'\n  from é".encode() + b"\xff"
+    with pytest.raises(cflexer.SourceError) as excinfo:
+        cflexer.TokenArray.lex(source)
+    assert 21 == excinfo.value.offset
+    assert (2, 9) == cflexer.byte_location(source, excinfo.value.offset)
+
+    # inside a literal it's only noticed once the token is looked at
+    source = b"select 'o\xffk'"
+    token_array = cflexer.TokenArray.lex(source)
+    with pytest.raises(cflexer.SourceError) as excinfo:
+        token_array[-1]
+    assert 9 == excinfo.value.offset
+
+
+def test_iter_tokenize_buffer():
+    text = RELEX_TEXT + "select 日本.\"é\", ¹2, .٣ from t -- ✓\n"
+    assert cflexer.tokenize(text) == list(cflexer.iter_tokenize_buffer(text.encode()))
+
+    # offsets are in bytes, as with TokenArray, and everything before the error has been yielded
+    tokens = cflexer.iter_tokenize_buffer(b"select 'o\xffk'")
+    assert "select" == next(tokens).value
+    with pytest.raises(cflexer.SourceError) as excinfo:
+        list(tokens)
+    assert 9 == excinfo.value.offset
+
+
+def test_byte_location():
+    source = "ab\ncé\n\nd".encode()
+    assert (1, 1) == cflexer.byte_location(source, 0)
+    assert (2, 1) == cflexer.byte_location(source, 3)
+    assert (2, 3) == cflexer.byte_location(source, 6)
+    assert (4, 1) == cflexer.byte_location(source, 8)
+
+
+@pytest.mark.parametrize(
+    "dialect,text,expected_values",
+    [
+        (cf_flags.Dialect.GENERIC, "a->>'k'", ["a", "-", ">", ">", "'k'"]),
+        (cf_flags.Dialect.POSTGRES, "a->>'k'::text", ["a", "->>", "'k'", "::", "text"]),
+        (cf_flags.Dialect.POSTGRES, "'C:\\' || $x$ y $x$", ["'C:\\'", " ", "||", " ", "$x$ y $x$"]),
+        (cf_flags.Dialect.ANSI, "a <> `b`", ["a", " ", "<>", " ", "`", "b", "`"]),
+        (cf_flags.Dialect.MYSQL, "a <=> b # c\n", ["a", " ", "<=>", " ", "b", " ", "# c\n"]),
+        (cf_flags.Dialect.BIGQUERY, "'''it's'''||x", ["'''it's'''", "||", "x"]),
+        (cf_flags.Dialect.SNOWFLAKE, "f(a => $$x$$) // c", ["f", "(", "a", " ", "=>", " ", "$$x$$", ")", " ", "// c"]),
+    ]
+)
+def test_dialects(dialect, text, expected_values):
+    cf_flags.DIALECT = dialect
+    try:
+        actual = cflexer.lex(text)
+        assert expected_values == [t.value for t in actual]
+        # same tables, same answers, whichever way we lex
+        assert actual == list(cflexer.TokenArray.lex(text.encode()))
+        assert actual == list(cflexer.iter_lex(io.StringIO(text), chunk_size=1))
+    finally:
+        cf_flags.reset_to_defaults()
+
+
+@pytest.mark.parametrize(
+    "dialect,text,expected_value",
+    [
+        # a backslash escapes a quote in a generic identifier, but not a Postgres one
+        (cf_flags.Dialect.GENERIC, 'Foo."a\\"b".BAR', 'foo."a\\"b".bar'),
+        (cf_flags.Dialect.POSTGRES, 'Foo."C:\\".BAR', 'foo."C:\\".bar'),
+        (cf_flags.Dialect.MYSQL, "Foo.`Bar`.BAZ", "foo.`Bar`.baz"),
+    ]
+)
+def test_dialect_lower_case(dialect, text, expected_value):
+    cf_flags.DIALECT = dialect
+    cf_flags.LOWER_CASE = True
+    try:
+        assert [expected_value] == [t.value for t in cflexer.tokenize(text)]
+        assert [expected_value] == [t.value for t in cflexer.iter_tokenize(io.StringIO(text), chunk_size=1)]
+        assert [expected_value] == [t.value for t in cflexer.iter_tokenize_buffer(text.encode())]
+        assert [expected_value] == [t.value for t in cflexer.TokenArray.tokenize(text.encode())]
+    finally:
+        cf_flags.reset_to_defaults()
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "select \"Foo\".bar, a.b.c, `x`.y from t group by a",
+        "select a . b, a.\"B\", 'x'.y from t left outer join u on t.id = u.id",
+        "select x.$1, a.b -- c.d\n from t order by 1",
+    ]
+)
+def test_tokenize_matches_collapse_identifiers(text):
+    assert [(t.kind, t.value) for t in cflexer.collapse_identifiers(cflexer.lex(text))] == [
+        (t.kind, t.value) for t in cflexer.tokenize(text)
+    ]
+
+
+@pytest.mark.parametrize(
+    "text,old_values,new_values",
+    [
+        ("a.b.c.d", ["a.b.c", ".", "d"], ["a.b.c.d"]),
+        ("$$x$$.y", ["$$x$$.y"], ["$$x$$", ".", "y"]),
+        ("t.left join u", ["t.left join", " ", "u"], ["t.left", " ", "join", " ", "u"]),
+        ("group by.x", ["group by.x"], ["group", " ", "by.x"]),
+    ]
+)
+def test_tokenize_differs_from_collapse_identifiers(text, old_values, new_values):
+    # the differences listed in tokenize()'s docstring
+    assert old_values == [t.value for t in cflexer.collapse_identifiers(cflexer.lex(text))]
+    assert new_values == [t.value for t in cflexer.tokenize(text)]
+
+
+def test_dialect_tables_are_cached():
+    assert cflexer.lexer_tables(cf_flags.Dialect.POSTGRES) is cflexer.lexer_tables(cf_flags.Dialect.POSTGRES)
+    assert cflexer.RE_TOKEN is cflexer.lexer_tables().token
@@ -1,6 +1,8 @@
 import pytest
 
-from cftoken import CFTokenKind, CFToken
+from dataclasses import FrozenInstanceError
+
+from cftoken import CFTokenKind, CFToken, KeywordIds, Keywords, SymbolIds, Symbols, keyword_mask
 
 
 def test_word_equality():
@@ -65,3 +67,40 @@ def test_spaces_validation():
 
     with pytest.raises(ValueError):
         CFToken(CFTokenKind.SPACES, "")
+
+
+def test_interning():
+    assert CFToken(CFTokenKind.WORD, "foo") is CFToken(CFTokenKind.WORD, "foo")
+    assert CFToken(CFTokenKind.SPACES, " ") is CFToken.unchecked(CFTokenKind.SPACES, " ")
+    assert CFToken(CFTokenKind.WORD, "foo") is not CFToken(CFTokenKind.WORD, "FOO")
+    assert CFToken(CFTokenKind.LITERAL, "'foo'") is not CFToken(CFTokenKind.LITERAL, "'foo'")
+
+
+def test_key():
+    assert CFToken(CFTokenKind.WORD, "FOO").key == "foo"
+    assert CFToken(CFTokenKind.LITERAL, '"FOO"').key == '"FOO"'
+
+
+def test_keyword_id():
+    assert CFToken(CFTokenKind.WORD, "SELECT").keyword_id == Keywords.SELECT.keyword_id == KeywordIds.SELECT != 0
+    assert CFToken(CFTokenKind.WORD, "Group By").keyword_id == KeywordIds.GROUP_BY
+    assert CFToken(CFTokenKind.SYMBOL, ",").keyword_id == SymbolIds.COMMA != 0
+    assert CFToken(CFTokenKind.WORD, "foo").keyword_id == 0
+    assert CFToken(CFTokenKind.LITERAL, "select").keyword_id == 0
+    assert len(set(vars(KeywordIds).values()) | set(vars(SymbolIds).values())) == len(vars(Keywords)) + len(vars(Symbols))
+
+
+def test_keyword_mask():
+    mask = keyword_mask([Keywords.AND, Keywords.OR])
+    assert mask >> CFToken(CFTokenKind.WORD, "OR").keyword_id & 1
+    assert not mask >> Keywords.NOT.keyword_id & 1
+    assert not mask >> CFToken(CFTokenKind.WORD, "foo").keyword_id & 1
+
+    with pytest.raises(ValueError):
+        keyword_mask([CFToken(CFTokenKind.WORD, "foo")])
+
+
+def test_immutable():
+    token = CFToken(CFTokenKind.WORD, "foo")
+    with pytest.raises(FrozenInstanceError):
+        token.value = "bar"
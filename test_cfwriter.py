@@ -0,0 +1,154 @@
+import io
+
+import pytest
+
+import cflexer
+from cfwriter import RenderCache, RenderWriter
+
+
+def test_fragments():
+    writer = RenderWriter()
+    writer.write("select a")
+    writer.write("")
+    writer.write("\n  from t")
+    assert "select a\n  from t" == writer.getvalue()
+
+
+def test_stream():
+    stream = io.StringIO()
+    writer = RenderWriter(stream)
+    writer.write("select a\n")
+    assert "" == stream.getvalue() # the newline is held back...
+    writer.write("  from t")
+    assert "select a\n" == stream.getvalue() # ...until something follows it, and lines are passed on when complete
+    writer.finish()
+    assert "select a\n  from t" == stream.getvalue()
+    with pytest.raises(ValueError):
+        writer.getvalue()
+
+
+def test_column():
+    writer = RenderWriter()
+    assert 0 == writer.column
+    writer.write("select a")
+    assert 8 == writer.column
+    writer.write(", b\n")
+    assert 0 == writer.column
+    writer.write("  from t")
+    assert 8 == writer.column
+    writer.write("\n /* two\n lines */ ")
+    assert 10 == writer.column
+
+
+class TestRstripNewlines:
+    def test_only_since_mark(self):
+        writer = RenderWriter()
+        writer.write("a\n")
+        mark = writer.mark()
+        writer.write("\n\n")
+        writer.rstrip_newlines(mark)
+        assert "a\n" == writer.getvalue()
+
+
+    def test_after_text(self):
+        writer = RenderWriter()
+        writer.write("a\n")
+        mark = writer.mark()
+        writer.write("b\n\n")
+        assert writer.ends_with_newline(mark)
+        writer.rstrip_newlines(mark)
+        assert not writer.ends_with_newline(mark)
+        assert 1 == writer.column
+        writer.write("c")
+        assert "a\nbc" == writer.getvalue()
+
+
+    def test_newlines_followed_by_spaces_are_kept(self):
+        writer = RenderWriter()
+        mark = writer.mark()
+        writer.write("a\n  ")
+        writer.rstrip_newlines(mark)
+        assert "a\n  " == writer.getvalue()
+
+
+@pytest.mark.parametrize("fragments", [
+    ["select a  \n  from t \n"],
+    ["select a", "  ", "\n", "  from t", " ", "\n"],
+    ["select a ", " \n  ", "from t \t", "\n"],
+    ["  \n\n   \n", "a", "  "],
+    ["a\t", " b", "\r\n", "c"],
+])
+def test_strip_trailing_whitespace(fragments):
+    text = "".join(fragments)
+    expected = "\n".join([line.rstrip() for line in text.split("\n")])
+
+    writer = RenderWriter(strip_trailing_whitespace=True)
+    for f in fragments:
+        writer.write(f)
+    assert expected == writer.getvalue()
+
+
+class TestRenderCache:
+    def test_span_hash(self):
+        cache = RenderCache()
+        left = ["select", " ", "a", ",", " ", "b"]
+        right = ["b", " ", "a", ",", " ", "b", " "]
+        assert cache.span_hash(left, 2, 6) == cache.span_hash(right, 2, 6)
+        assert cache.span_hash(left, 2, 6) != cache.span_hash(right, 1, 5)
+        assert cache.span_hash(left, 3, 3) == cache.span_hash(right, 0, 0)
+
+
+    def test_span_hash_of_tokens_keeps_case(self):
+        cache = RenderCache()
+        tokens = cflexer.tokenize("MyCol + 1, mycol + 1")
+        assert tokens[0] == tokens[7]
+        assert cache.span_hash(tokens, 0, 5) != cache.span_hash(tokens, 7, 12)
+        assert cache.span_hash(tokens, 2, 5) == cache.span_hash(tokens, 9, 12)
+
+
+    def test_span_hash_of_long_spans(self):
+        # spans longer than a block are hashed from prefix hashes, which only so many blocks of are kept
+        cache = RenderCache()
+        length = (RenderCache.MAX_BLOCKS + 10) * RenderCache.BLOCK
+        elements = [str(i % 1000) for i in range(length)]
+        for start, end in [(0, 3000), (1000, 4000), (500, 2500), (1500, 3500), (0, length), (5, 3000)]:
+            assert cache.span_hash(elements, start, end) == cache._hash_elements(elements, start, end)
+        assert cache.span_hash(elements, 0, 2000) == cache.span_hash(elements, 1000, 3000)
+        assert cache.span_hash(elements, 0, 2000) != cache.span_hash(elements, 1001, 3001)
+        assert len(cache._block_hashes) <= RenderCache.MAX_BLOCKS
+        assert len(cache._list_hashes) == 1
+
+
+    def test_stored_the_second_time(self):
+        cache = RenderCache()
+        assert (None, False) == cache.lookup("k", 4)
+        assert (None, True) == cache.lookup("k", 4)
+        cache.store("k", 4, "a\n    b")
+        assert ("a\n    b", False) == cache.lookup("k", 4)
+        assert {"hits": 1, "misses": 2, "evictions": 0, "entries": 1} == cache.stats()
+
+
+    def test_other_indent(self):
+        cache = RenderCache()
+        cache.store("one line", 4, "a b")
+        cache.store("two lines", 4, "a\n    b")
+        assert ("a b", False) == cache.lookup("one line", 8)
+        assert (None, True) == cache.lookup("two lines", 8)
+
+
+    def test_single_lines_only_at_their_indent(self):
+        cache = RenderCache(single_lines_at_any_indent=False)
+        cache.store("one line", 4, "a b")
+        assert ("a b", False) == cache.lookup("one line", 4)
+        assert (None, True) == cache.lookup("one line", 8)
+
+
+    def test_least_recently_used_is_evicted(self):
+        cache = RenderCache(max_entries=2)
+        cache.store("a", 0, "a")
+        cache.store("b", 0, "b")
+        cache.lookup("a", 0)
+        cache.store("c", 0, "c")
+        assert ("a", False) == cache.lookup("a", 0)
+        assert (None, False) == cache.lookup("b", 0)
+        assert 2 == cache.stats()["evictions"] # b, then c when b came back
@@ -11,7 +11,9 @@ from clause_formatter import (
     trim_leading_whitespace,
     trim_one_leading_space,
     get_paren_block,
+    find_matching_paren,
     make_compact,
+    TokenIndex,
 )
 
 
@@ -304,6 +306,61 @@ class TestGetParenBlock:
         assert expected == actual
 
 
+class TestTokenIndex:
+    # f ( a , ( b ) )   ) ( c
+    tokens = [
+        CFToken(CFTokenKind.WORD, "f"),
+        CFToken(CFTokenKind.SYMBOL, "("),
+        CFToken(CFTokenKind.WORD, "a"),
+        CFToken(CFTokenKind.SYMBOL, ","),
+        CFToken(CFTokenKind.SPACES, " "),
+        CFToken(CFTokenKind.SYMBOL, "("),
+        CFToken(CFTokenKind.WORD, "b"),
+        CFToken(CFTokenKind.SYMBOL, ")"),
+        CFToken(CFTokenKind.SYMBOL, ")"),
+        CFToken(CFTokenKind.NEWLINE, "\n"),
+        CFToken(CFTokenKind.SPACES, "  "),
+        CFToken(CFTokenKind.SYMBOL, ")"),
+        CFToken(CFTokenKind.SYMBOL, "("),
+        CFToken(CFTokenKind.WORD, "c"),
+        CFToken(CFTokenKind.SPACES, " "),
+    ]
+
+    def test_matching_paren(self):
+        token_index = TokenIndex(self.tokens)
+        assert 8 == token_index.matching_paren(1)
+        assert 7 == token_index.matching_paren(5)
+        assert token_index.matching_paren(12) is None
+
+
+    def test_matches_get_paren_block(self):
+        token_index = TokenIndex(self.tokens)
+        for i in (1, 5, 12):
+            block = get_paren_block(self.tokens[i:])
+            right_paren_index = token_index.matching_paren(i)
+            if block is None:
+                assert right_paren_index is None
+            else:
+                assert block == self.tokens[i:right_paren_index+1]
+
+
+    def test_next_real(self):
+        token_index = TokenIndex(self.tokens)
+        assert 0 == token_index.next_real(0)
+        assert 5 == token_index.next_real(4)
+        assert 11 == token_index.next_real(9)
+        assert 15 == token_index.next_real(14) # none left
+        assert 15 == token_index.next_real(15)
+
+
+    def test_find_matching_paren(self):
+        assert 8 == find_matching_paren(self.tokens, 1)
+        assert 7 == find_matching_paren(self.tokens, 5)
+        assert find_matching_paren(self.tokens, 1, 8) is None # f( ... ) minus the ")"
+        assert 7 == find_matching_paren(self.tokens, 5, 8)
+        assert find_matching_paren(self.tokens, 12) is None
+
+
 class TestMakeCompact:
     def test_empty(self):
         expected = []
@@ -914,3 +971,91 @@ class TestMakeCompact:
         for t in actual:
             print(t)
         assert expected == actual
+
+
+    def test_function_call_with_newline_then_spaces(self):
+        # max
+        #   (foo)
+        tokens = [
+            CFToken(CFTokenKind.WORD, "max"),
+            CFToken(CFTokenKind.NEWLINE, "\n"),
+            CFToken(CFTokenKind.SPACES, "   "),
+            CFToken(CFTokenKind.SYMBOL, "("),
+            CFToken(CFTokenKind.WORD, "foo"),
+            CFToken(CFTokenKind.SYMBOL, ")"),
+        ]
+        original = tokens.copy()
+
+        # max(foo)
+        expected = [
+            CFToken(CFTokenKind.WORD, "max"),
+            CFToken(CFTokenKind.SYMBOL, "("),
+            CFToken(CFTokenKind.WORD, "foo"),
+            CFToken(CFTokenKind.SYMBOL, ")"),
+        ]
+        actual = make_compact(tokens)
+        assert expected == actual
+        assert original == tokens
+
+
+    def test_long_expression(self):
+        # x in ( 0 ,\n  1 ,\n  2 ... ), the kind of machine-generated list that compact mode is used to clean up:
+        # 400k tokens, which a make_compact that was quadratic in the length of the expression would take minutes over
+        item = [
+            CFToken(CFTokenKind.SPACES, " "),
+            CFToken(CFTokenKind.SYMBOL, ","),
+            Whitespace.NEWLINE,
+            CFToken(CFTokenKind.SPACES, "  "),
+            CFToken(CFTokenKind.WORD, "1"),
+        ]
+        tokens = [
+            CFToken(CFTokenKind.WORD, "x"),
+            CFToken(CFTokenKind.SPACES, " "),
+            CFToken(CFTokenKind.WORD, "in"),
+            CFToken(CFTokenKind.SPACES, " "),
+            CFToken(CFTokenKind.SYMBOL, "("),
+            CFToken(CFTokenKind.SPACES, " "),
+            CFToken(CFTokenKind.WORD, "0"),
+        ] + item * 80_000 + [
+            CFToken(CFTokenKind.SPACES, " "),
+            CFToken(CFTokenKind.SYMBOL, ")"),
+        ]
+
+        actual = make_compact(tokens)
+        assert "".join([t.value for t in actual]) == "x in (0" + ", 1" * 80_000 + ")"
+
+
+    # Each of these only compacts fully if make_compact steps back after a change, because the change makes a
+    # pattern with the token before it: `max` is already behind the current token by the time the newline and
+    # spaces after it have been dealt with.
+    @pytest.mark.parametrize("values, expected", [
+        # "\n", " " leaves "max", " ", "("
+        (["max", "\n", "   ", "("], "max("),
+        # " ", "\n" then " ", " " leaves "max", " ", "("
+        (["max", " ", "\n", " ", "("], "max("),
+        # a newline on its own becomes " ", leaving "max", " ", "("
+        (["max", "\n", "("], "max("),
+        # ... or "(", " "
+        (["(", "\n", "a"], "(a"),
+    ])
+    def test_step_back_after_change(self, values, expected):
+        kinds = {"\n": CFTokenKind.NEWLINE, "(": CFTokenKind.SYMBOL, ")": CFTokenKind.SYMBOL}
+        tokens = [
+            CFToken(kinds.get(v, CFTokenKind.SPACES if v.isspace() else CFTokenKind.WORD), v)
+            for v in values + [")"]
+        ]
+        actual = make_compact(tokens)
+        assert "".join([t.value for t in actual]) == expected + ")"
+
+
+    def test_no_step_back_past_a_kept_space(self):
+        # the space before the newline is kept, and nothing makes a pattern with "max" afterwards
+        tokens = [
+            CFToken(CFTokenKind.WORD, "max"),
+            CFToken(CFTokenKind.SPACES, " "),
+            CFToken(CFTokenKind.NEWLINE, "\n"),
+            CFToken(CFTokenKind.SYMBOL, "("),
+            CFToken(CFTokenKind.SYMBOL, ")"),
+        ]
+        actual = make_compact(tokens)
+        assert "".join([t.value for t in actual]) == "max ()"
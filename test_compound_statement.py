@@ -1,10 +1,12 @@
 import pytest
 
 import cf_flags
+import cflexer
 from cftoken import CFToken
 from cftoken import CFTokenKind
 from cftoken import Symbols
 from cftoken import Whitespace
+from clause_formatter import ClauseScope
 from clause_formatter import CompoundStatement
 
 
@@ -270,3 +272,71 @@ class TestCompoundStatement:
 
         print(actual)
         assert expected == actual
+
+
+def test_token_array_input():
+    sql = "select a.x, b\n  from foo a\n where a.x in (select y from bar)"
+    token_list = cflexer.collapse_identifiers(cflexer.lex(sql))
+    token_array = cflexer.TokenArray.lex(sql).collapse_identifiers()
+    assert CompoundStatement(token_list).render(indent=0) == CompoundStatement(token_array).render(indent=0)
+
+
+def test_lazy_parsing():
+    sql = "select a\n  from (select b from (select c from t) s1) s0\n where a in (select d from u)"
+    statement = CompoundStatement(cflexer.tokenize(sql))
+    assert statement._unparsed is not None
+
+    # asking for the top level only splits the top level
+    from_clause = statement.statements[0].clause_map[ClauseScope.FROM]
+    assert statement._unparsed is None
+    assert from_clause._unparsed is not None
+    subquery = from_clause.expressions[0].elements[1]
+    assert isinstance(subquery, CompoundStatement)
+    assert subquery._unparsed is not None
+
+    assert statement.render(indent=0) == (
+        "select a\n"
+        "  from (select b\n"
+        "          from (select c\n"
+        "                  from t\n"
+        "               ) s1\n"
+        "       ) s0\n"
+        " where a in (select d\n"
+        "               from u\n"
+        "            )"
+    )
+    assert subquery._unparsed is None
+
+
+def test_subquery_errors_are_raised_when_rendering():
+    # the subquery's clauses are out of order, which isn't noticed until it's parsed
+    statement = CompoundStatement(cflexer.tokenize("select a from (select b where 1=1 from t) s"))
+    with pytest.raises(ValueError):
+        statement.render(indent=0)
+
+
+@pytest.mark.parametrize("sql,depth", [
+    ("select 1", 1),
+    ("select a, b -- comment\n  from t\n where x = 1 and y = 2\n union all\nselect c, d from u", 1),
+    ("select a from (select b from (select c from t) s1) s0 where a in (select d /* comment */ from u)", 3),
+    ("with c as (select 1) select distinct on (a) a, b from c order by a limit 10 offset 20", 2),
+    ("select distinct\n       a\n     , b\n  from t", 1),
+])
+def test_metrics(sql, depth):
+    # line count is what rendering gives, without rendering
+    statement = CompoundStatement(cflexer.tokenize(sql))
+    metrics = statement.metrics
+    assert statement._unparsed is None
+    rendered = statement.render(indent=0)
+    assert metrics.lines == rendered.count("\n") + 1
+    assert metrics.has_comment == ("--" in sql or "/*" in sql)
+    assert metrics.depth == depth
+    assert statement.metrics is metrics
+
+
+def test_metrics_of_deep_nesting():
+    depth = 5000
+    statement = CompoundStatement(cflexer.tokenize("select " + "(select " * depth + "1" + ")" * depth))
+    metrics = statement.metrics
+    assert metrics.depth == depth + 1
+    assert metrics.lines == depth + 1
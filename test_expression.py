@@ -1,11 +1,16 @@
 import pytest
 
 import cf_flags
+import cflexer
 from cftoken import CFToken
 from cftoken import CFTokenKind
 from cftoken import Symbols
 from cftoken import Whitespace
 from clause_formatter import Expression
+from clause_formatter import LiteralList
+from clause_formatter import Statement
+from clause_formatter import TokenIndex
+from clause_formatter import literal_list_end
 
 
 # pytest magic
@@ -239,3 +244,120 @@ class TestExpressionWhitespaceTrimmingTrailingComma:
         actual = Expression(tokens).render(indent=0)
         expected = "foo as BAR"
         assert expected == actual
+
+
+class TestSpan(SameAnyWay):
+    def actual_test(self):
+        #a + b,c
+        tokens = [
+            CFToken(CFTokenKind.WORD, "a"),
+            Whitespace.ONE_SPACE,
+            CFToken(CFTokenKind.SYMBOL, "+"),
+            Whitespace.ONE_SPACE,
+            CFToken(CFTokenKind.WORD, "b"),
+            Symbols.COMMA,
+            CFToken(CFTokenKind.WORD, "c"),
+        ]
+        assert "b" == Expression(tokens, 3, 5).render(indent=0)
+        assert "c" == Expression(tokens, 6).render(indent=0)
+        assert "" == Expression(tokens, 5, 5).render(indent=0)
+        assert Expression(tokens, 5, 5).is_empty()
+
+
+class TestMetrics:
+    @classmethod
+    def teardown_class(cls):
+        cf_flags.reset_to_defaults()
+
+    def test_default(self, mode__default):
+        # a + b -- comment
+        tokens = [
+            CFToken(CFTokenKind.WORD, "a"),
+            Whitespace.ONE_SPACE,
+            CFToken(CFTokenKind.SYMBOL, "+"),
+            Whitespace.NEWLINE,
+            CFToken(CFTokenKind.SPACES, "    "),
+            CFToken(CFTokenKind.WORD, "b"),
+            Whitespace.ONE_SPACE,
+            CFToken(CFTokenKind.LINE_COMMENT, "-- comment\n"),
+            Whitespace.NEWLINE,
+        ]
+        metrics = Expression(tokens).metrics
+        # the trailing newlines are stripped, as when rendering
+        assert "a +\n    b -- comment" == Expression(tokens).render(indent=0)
+        assert metrics.width == len("a + " + "    b -- comment")
+        assert metrics.lines == 2
+        assert metrics.has_comment
+        assert metrics.depth == 0
+
+        metrics = Expression(tokens, 0, 3).metrics
+        assert (metrics.width, metrics.lines, metrics.has_comment) == (3, 1, False)
+
+    def test_empty(self, mode__default):
+        metrics = Expression([]).metrics
+        assert (metrics.width, metrics.lines, metrics.has_comment, metrics.depth) == (0, 1, False, 0)
+
+
+class TestLiteralList:
+    @classmethod
+    def teardown_class(cls):
+        cf_flags.reset_to_defaults()
+
+    @staticmethod
+    def elements(source):
+        tokens = cflexer.tokenize(source)
+        return Statement._get_elements(tokens, 0, len(tokens), TokenIndex(tokens))
+
+    @pytest.mark.parametrize("source, is_list", [
+        ("(1, 2)", True),
+        ("( -1 ,+2.5e3,  'a', null, TRUE, \"Q\" )", True),
+        ("(1)", False), # just parens
+        ("(1, a)", False),
+        ("(1, f(2))", False),
+        ("(1,\n 2)", True),
+        ("(\n  1,\n  2\n)", True),
+        ("(1, 2 -- comment\n)", False),
+        ("(1, - 2)", False),
+        ("(1, 2", False),
+    ])
+    def test_detection(self, source, is_list):
+        tokens = cflexer.tokenize(source)
+        end = literal_list_end(tokens, 0, len(tokens))
+        assert (end == len(tokens) - 1) if is_list else (end is None)
+
+    def test_elements(self, mode__default):
+        elements = self.elements("x in ( 1 ,2, -3 ) and f(a, 1)")
+        assert [type(e) for e in elements[:7]] == [CFToken] * 5 + [LiteralList, CFToken]
+        assert [e.value for e in elements[4:5] + elements[6:]] == ["(", ")", " ", "and", " ", "f", "(", "a", ",", " ", "1", ")"]
+        assert elements[5].pieces() == (" ", ["1", "2", "-3"], [" ,", ", "], " ")
+
+    def test_default(self, mode__default):
+        elements = self.elements("x in ( 1 ,2,  -3 )")
+        assert Expression(elements).render(indent=0) == "x in ( 1 ,2,  -3 )"
+        assert Expression(elements).metrics.width == len("x in ( 1 ,2,  -3 )")
+
+    def test_trim_leading_whitespace(self, mode__trim_leading_whitespace):
+        elements = self.elements("  x in ( 1 ,2,  -3 )")
+        assert Expression(elements).render(indent=0) == "x in ( 1 ,2,  -3 )"
+
+    def test_compact_expressions(self, mode__compact_expressions):
+        # as make_compact() would leave the tokens
+        elements = self.elements("x in ( 1 ,2,  -3 ) and coalesce (1, 2)")
+        assert Expression(elements).render(indent=0) == "x in (1,2, -3) and coalesce(1, 2)"
+        assert Expression(elements).metrics.width == len("x in (1,2, -3) and coalesce(1, 2)")
+
+
+    # a machine-generated list with a value per line renders as its tokens would, padded out to the indent
+    MULTI_LINE = "x in (\n1,\n    2\n  ,3\n)"
+
+    def test_multi_line_default(self, mode__default):
+        elements = self.elements(self.MULTI_LINE)
+        assert LiteralList in [type(e) for e in elements]
+        expected = "x in (\n   1,\n    2\n   ,3\n   )"
+        assert Expression(elements).render(indent=3) == expected
+        assert Expression(elements).metrics.lines == 5
+        assert Expression(elements).metrics.width == len(self.MULTI_LINE)
+
+    def test_multi_line_compact_expressions(self, mode__compact_expressions):
+        elements = self.elements("x in\n" + self.MULTI_LINE[5:])
+        assert Expression(elements).render(indent=3) == "x in (1, 2,3)"
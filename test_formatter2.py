@@ -1,9 +1,14 @@
+import io
+
 import pytest
 
 from pathlib import Path
 
 import cf_flags
-from formatter2 import do_format
+import cflexer
+from cfwriter import RenderCache
+from clause_formatter import CompoundStatement
+from formatter2 import do_format, do_format_stream, do_format_file, render_and_trim
 
 
 # pytest magic
@@ -1170,6 +1175,58 @@ select foo
 )
 
 
+qft.insert_values = dict(
+input="""\
+-- load some rows
+INSERT INTO some_table(id,  name, score) VALUES
+  (1, 'one' ,  1.5), -- the first
+  ( 2,'two', -2),
+  (3, lower('THREE'), null)
+on conflict (id) do nothing;
+insert into other_table values (4, 'four');
+""",
+
+default="""\
+-- load some rows
+INSERT INTO some_table (id
+                      ,  name
+                      , score)
+VALUES (1, 'one' ,  1.5) -- the first
+     , ( 2,'two', -2)
+     , (3, lower('THREE'), null)
+on conflict (id) do nothing;
+insert into other_table
+values (4, 'four');
+""",
+
+trim_leading_whitespace="""\
+-- load some rows
+INSERT INTO some_table (id
+                      , name
+                      , score)
+VALUES (1, 'one' ,  1.5) -- the first
+     , ( 2,'two', -2)
+     , (3, lower('THREE'), null)
+on conflict (id) do nothing;
+insert into other_table
+values (4, 'four');
+""",
+
+compact_expressions="""\
+-- load some rows
+INSERT INTO some_table (id
+                      , name
+                      , score)
+VALUES (1, 'one', 1.5) -- the first
+     , (2,'two', -2)
+     , (3, lower('THREE'), null)
+on conflict(id) do nothing;
+insert into other_table
+values (4, 'four');
+""",
+)
+
+
 @pytest.mark.parametrize(
     "test_input,expected_output",
     zip(qft.get_inputs(), qft.get_outputs__default()),
@@ -1207,3 +1264,86 @@ def test_do_format__compact_expressions(test_input, expected_output):
     print(actual_output)
     #print(actual_output.replace(" ", "⦁"))
     assert expected_output == actual_output
+
+
+@pytest.mark.parametrize(
+    "test_input,expected_output",
+    zip(qft.get_inputs(), qft.get_outputs__default()),
+    ids=qft.get_ids()
+)
+def test_do_format_stream(test_input, expected_output):
+    cf_flags.FORMAT_MODE = cf_flags.FormatMode.DEFAULT
+    actual_output = do_format_stream(io.StringIO(test_input))
+    assert expected_output == actual_output
+
+
+@pytest.mark.parametrize(
+    "test_input,expected_output",
+    zip(qft.get_inputs(), qft.get_outputs__default()),
+    ids=qft.get_ids()
+)
+def test_do_format_stream_to_output_stream(test_input, expected_output):
+    cf_flags.FORMAT_MODE = cf_flags.FormatMode.DEFAULT
+    output_stream = io.StringIO()
+    assert do_format_stream(io.StringIO(test_input), output_stream) is None
+    assert expected_output == output_stream.getvalue()
+
+
+@pytest.mark.parametrize(
+    "test_input,expected_output",
+    zip(qft.get_inputs(), qft.get_outputs__default()),
+    ids=qft.get_ids()
+)
+def test_do_format_file(test_input, expected_output, tmp_path):
+    cf_flags.FORMAT_MODE = cf_flags.FormatMode.DEFAULT
+    path = tmp_path / "query.sql"
+    path.write_text(test_input, encoding="utf-8")
+    actual_output = do_format_file(path)
+    assert expected_output == actual_output
+
+
+def test_do_format_file_invalid_utf8(tmp_path):
+    path = tmp_path / "query.sql"
+    path.write_bytes(b"select a\n  from \xff")
+    with pytest.raises(cflexer.SourceError, match=r"query\.sql:2:8: invalid UTF-8"):
+        do_format_file(path)
+
+
+def test_render_cache():
+    cf_flags.FORMAT_MODE = cf_flags.FormatMode.DEFAULT
+    arm = "select a, b from (select a, b from t where c in (1, 2, 3)) s where a > 1"
+    tokens = cflexer.tokenize("\nunion all\n".join([arm] * 5))
+
+    cache = RenderCache()
+    assert render_and_trim(CompoundStatement(tokens), cache=RenderCache(max_entries=0)) == render_and_trim(CompoundStatement(tokens), cache=cache)
+    assert cache.hits > 0
+
+
+def test_render_cache_keeps_case():
+    # repeats that differ only in the case of words aren't the same
+    cf_flags.FORMAT_MODE = cf_flags.FormatMode.DEFAULT
+    assert do_format("select MyCol + 1 + 2 + 3 as a, mycol + 1 + 2 + 3 as a, MYCOL + 1 + 2 + 3 as a from t") == (
+        "select MyCol + 1 + 2 + 3 as a\n"
+        "     , mycol + 1 + 2 + 3 as a\n"
+        "     , MYCOL + 1 + 2 + 3 as a\n"
+        "  from t"
+    )
+    sql = " union all ".join(["(select A, B, C from T)", "(select a, b, c from t)"] * 2)
+    tokens = cflexer.tokenize(sql)
+    assert render_and_trim(CompoundStatement(tokens)) == render_and_trim(CompoundStatement(tokens), cache=RenderCache(max_entries=0))
+    assert render_and_trim(CompoundStatement(tokens)).endswith("(select a\n     , b\n     , c\n  from t)")
+
+
+def test_render_cache_with_max_width():
+    # an expression that fits the first two times, and has to be broken the third, further in
+    cf_flags.FORMAT_MODE = cf_flags.FormatMode.DEFAULT
+    cf_flags.MAX_WIDTH = 50
+    try:
+        e = "coalesce(aaaa, bbbb, cccc, dddd)"
+        sql = f"select {e} from t union all select {e} from u union all select * from (select * from (select {e} from v) s) s2"
+        tokens = cflexer.tokenize(sql)
+        actual = render_and_trim(CompoundStatement(tokens))
+        assert render_and_trim(CompoundStatement(tokens), cache=RenderCache(max_entries=0)) == actual
+        assert "coalesce(aaaa\n" in actual
+    finally:
+        cf_flags.MAX_WIDTH = None
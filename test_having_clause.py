@@ -1,6 +1,7 @@
 import pytest
 
 import cf_flags
+import cflexer
 from cftoken import CFToken, Keywords, Symbols
 from cftoken import CFTokenKind
 from clause_formatter import HavingClause
@@ -127,3 +128,19 @@ def test_render_two_expressions_ORed():
 
     print(actual)
     assert expected == actual
+
+
+def test_render_between_and_case():
+    # AND inside BETWEEN ... AND or CASE ... END doesn't start a new expression, same as in WHERE
+    tokens = cflexer.tokenize("having sum(x) between 1 and 9 and max(case when a and b then 1 end) = 1 or c")
+    clause = HavingClause(tokens=tokens)
+
+    expected = (
+        "having sum(x) between 1 and 9\n"
+        "   and max(case when a and b then 1 end) = 1\n"
+        "    or c"
+    )
+    actual = clause.render(indent=0)
+
+    print(actual)
+    assert expected == actual
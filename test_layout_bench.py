@@ -0,0 +1,19 @@
+import cf_flags
+import layout_bench
+
+
+# pytest magic
+def setup_module():
+    cf_flags.reset_to_defaults()
+
+
+def test_run_benchmark():
+    report = layout_bench.run_benchmark(terms=20, doublings=1, max_width=40, repeat=1)
+    assert list(layout_bench.WIDE_INPUTS) == [entry["name"] for entry in report["inputs"]]
+    for entry in report["inputs"]:
+        assert [20, 40] == [size["terms"] for size in entry["sizes"]]
+        for size in entry["sizes"]:
+            # every term gets a line of its own
+            assert size["output_lines"] > size["terms"]
+            assert size["seconds"] > 0
+    assert cf_flags.MAX_WIDTH is None
@@ -0,0 +1,65 @@
+import lexer_bench
+from cftoken import CFToken, CFTokenKind
+
+
+def test_first_divergence_none_when_equal():
+    tokens = [CFToken(CFTokenKind.WORD, "select"), CFToken(CFTokenKind.SPACES, " "), CFToken(CFTokenKind.WORD, "a")]
+    assert lexer_bench.first_divergence(tokens, list(tokens)) is None
+
+
+def test_first_divergence():
+    left = [CFToken(CFTokenKind.WORD, "a"), CFToken(CFTokenKind.SYMBOL, ":"), CFToken(CFTokenKind.SYMBOL, ":")]
+    right = [CFToken(CFTokenKind.WORD, "a"), CFToken(CFTokenKind.SYMBOL, "::")]
+    expected = {
+        "index": 1,
+        "context": [["WORD", "a"]],
+        "cflexer": ["SYMBOL", ":"],
+        "pygments": ["SYMBOL", "::"],
+    }
+    assert expected == lexer_bench.first_divergence(left, right)
+
+
+def test_first_divergence_in_case():
+    # == ignores the case of words, but a lexer that changes it doesn't agree
+    left = [CFToken(CFTokenKind.WORD, "select"), CFToken(CFTokenKind.SPACES, " "), CFToken(CFTokenKind.WORD, "Foo")]
+    right = left[:2] + [CFToken(CFTokenKind.WORD, "foo")]
+    assert left == right
+    expected = {
+        "index": 2,
+        "context": [["WORD", "select"], ["SPACES", " "]],
+        "cflexer": ["WORD", "Foo"],
+        "pygments": ["WORD", "foo"],
+    }
+    assert expected == lexer_bench.first_divergence(left, right)
+
+
+def test_first_divergence_different_lengths():
+    left = [CFToken(CFTokenKind.WORD, "a")]
+    right = left + [CFToken(CFTokenKind.NEWLINE, "\n")]
+    expected = {
+        "index": 1,
+        "context": [["WORD", "a"]],
+        "cflexer": None,
+        "pygments": ["NEWLINE", "\n"],
+    }
+    assert expected == lexer_bench.first_divergence(left, right)
+
+
+def test_run_benchmark():
+    corpus = lexer_bench.build_corpus(scale=3, paths=[])
+    assert ["sample.sql"] + list(lexer_bench.SYNTHETIC_INPUTS) == list(corpus)
+
+    report = lexer_bench.run_benchmark({"keyphrases": corpus["keyphrases"], "broken": "select $$x$$"}, repeat=1)
+    keyphrases, broken = report["inputs"]
+
+    for result in keyphrases["lexers"].values():
+        assert result["tokens"] > 0
+        assert result["tokens_per_second"] > 0
+        assert result["mb_per_second"] > 0
+        assert result["peak_memory_bytes"] > 0
+    assert keyphrases["agree"] is False # Pygments ends with a newline
+    assert keyphrases["first_divergence"]["pygments"] == ["NEWLINE", "\n"]
+
+    # the Pygments pipeline can't translate dollar-quoted literals
+    assert broken["lexers"]["pygments"]["error"].startswith("ValueError")
+    assert broken["agree"] is None
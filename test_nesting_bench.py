@@ -0,0 +1,26 @@
+import sys
+
+import cf_flags
+import nesting_bench
+from formatter2 import do_format
+
+
+# pytest magic
+def setup_module():
+    cf_flags.reset_to_defaults()
+
+
+def test_run_benchmark():
+    report = nesting_bench.run_benchmark(depth=3, repeat=1)
+    assert list(nesting_bench.NESTED_INPUTS) == [entry["name"] for entry in report["inputs"]]
+    for entry in report["inputs"]:
+        assert "error" not in entry
+        assert entry["tokens"] > 0
+        assert entry["output_bytes"] > 0
+        assert entry["peak_memory_bytes"] > 0
+
+
+def test_deeper_than_recursion_limit():
+    depth = sys.getrecursionlimit() + 100
+    for make_input in nesting_bench.NESTED_INPUTS.values():
+        assert do_format(make_input(depth)).count("select") == make_input(depth).count("select")
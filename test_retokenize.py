@@ -1013,3 +1013,66 @@ def test_retokenize2_qualified_identifiers():
         (Token.Text.Whitespace, '\n'),
     ]
     assert expected_tokens == actual_tokens
+
+
+def test_retokenize1_unmatched_quote():
+    # the unmatched backtick passes through, and doesn't stop later quotes being matched
+    sql = "select ` a, 'x' , `b`"
+    tokens = retokenize.initial_lex(sql)
+    actual_tokens = retokenize.retokenize1(tokens)
+    expected_tokens = [
+        (Token.Keyword, 'select'),
+        (Token.Text.Whitespace, ' '),
+        (Token.Literal.String.Name, '` a, \'x\' , `'),
+        (Token.Name, 'b'),
+        (Token.Operator, '`'),
+        (Token.Text.Whitespace, '\n'),
+    ]
+    assert expected_tokens == actual_tokens
+
+    sql = "select `a` , ` b, 'x'"
+    tokens = retokenize.initial_lex(sql)
+    actual_tokens = retokenize.retokenize1(tokens)
+    expected_tokens = [
+        (Token.Keyword, 'select'),
+        (Token.Text.Whitespace, ' '),
+        (Token.Literal.String.Name, '`a`'),
+        (Token.Text.Whitespace, ' '),
+        (Token.Punctuation, ','),
+        (Token.Text.Whitespace, ' '),
+        (Token.Operator, '`'),
+        (Token.Text.Whitespace, ' '),
+        (Token.Name, 'b'),
+        (Token.Punctuation, ','),
+        (Token.Text.Whitespace, ' '),
+        (Token.Literal.String.Single, "'x'"),
+        (Token.Text.Whitespace, '\n'),
+    ]
+    assert expected_tokens == actual_tokens
+
+
+def test_iter_retokenize1_accepts_any_iterable():
+    # long enough that the lookahead buffer gets trimmed along the way
+    sql = "select " + ", ".join([f"'{i}' is not null" for i in range(1000)])
+    tokens = retokenize.initial_lex(sql)
+    actual_tokens = list(retokenize.iter_retokenize1(iter(tokens)))
+    assert retokenize.retokenize1(tokens) == actual_tokens
+    assert (Token.Literal.String.Single, "'999'") == actual_tokens[-4]
+    assert (Token.Keyword, 'is not null') == actual_tokens[-2]
+
+
+def test_iter_cftokens():
+    sql = (
+        "select a.b, 'c', /* e */ f\n"
+        "  from \"G\".h\n"
+        " where i is not distinct from j\n"
+        "   and k at time zone 'utc' = l"
+    )
+    staged_tokens = retokenize.cftokenize(retokenize.retokenize2(retokenize.retokenize1(retokenize.pre_process_tokens(retokenize.initial_lex(sql)))))
+    actual_tokens = retokenize.iter_cftokens(sql)
+    assert iter(actual_tokens) is actual_tokens
+    assert staged_tokens == list(actual_tokens)
+
+
+def test_postgres_lexer_is_cached():
+    assert retokenize.postgres_lexer() is retokenize.postgres_lexer()
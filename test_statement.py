@@ -1,6 +1,7 @@
 import pytest
 
 import cf_flags
+import cflexer
 from cftoken import CFToken
 from cftoken import CFTokenKind
 from cftoken import Symbols
@@ -8,6 +9,8 @@ from cftoken import Whitespace
 from clause_formatter import ClauseScope
 from clause_formatter import Statement
 from clause_formatter import CompoundStatement
+from clause_formatter import WhereClause
+from clause_formatter import split_clauses
 
 
 # pytest magic
@@ -1248,3 +1251,16 @@ class TestStatement:
 
         print(actual)
         assert expected == actual
+
+
+def test_split_clauses():
+    tokens = cflexer.tokenize("select a, f(b, c) from t join u on x where p between 1 and 2 and (q or r) or s")
+    clauses = split_clauses(tokens, 0, len(tokens))
+
+    assert [ClauseScope.SELECT, ClauseScope.FROM, ClauseScope.WHERE] == [scope for scope, _, _, _ in clauses]
+    delimiters = [[tokens[i].value for i in delimiter_indexes] for _, _, _, delimiter_indexes in clauses]
+    assert [[","], ["join"], ["and", "or"]] == delimiters
+
+    # the same delimiters are found when the WHERE clause is split on its own
+    _, start, end, delimiter_indexes = clauses[2]
+    assert [(None, start, end, delimiter_indexes)] == split_clauses(tokens, start, end, WhereClause)